@@ -1,12 +1,16 @@
 import configparser
+import hashlib
 import logging
 import os
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from urllib.parse import urlparse
 
 # --- Configuration and Logging Setup ---
-CONFIG_FILE_PATH = "../config/config.ini" # Adjusted path
+CONFIG_FILE_PATH = "../../config/config.ini" # Relative to the script directory
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logger = logging.getLogger(__name__) # Define logger at module level
 
@@ -36,38 +40,195 @@ def load_config(script_dir_path, config_rel_path=CONFIG_FILE_PATH):
     return config
 
 # --- Main Acquisition Logic ---
-def download_file(url, target_dir):
-    """Downloads a file from a URL to a target directory."""
+SUPPORTED_CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256')
+_thread_local = threading.local()
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by all download threads to cap aggregate throughput.
+    A limit of 0 (or less) disables throttling.
+    """
+    def __init__(self, max_bytes_per_second):
+        self.rate = max_bytes_per_second
+        self.allowance = max_bytes_per_second
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last_check) * self.rate)
+            self.last_check = now
+            self.allowance -= num_bytes
+            wait_seconds = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+def parse_lidar_url_entry(line):
+    """
+    Parses a 'lidar_data_urls' line of the form 'URL' or 'URL | algo:hexdigest'
+    (algo is md5, sha1 or sha256). Returns (url, checksum) where checksum is an
+    (algo, hexdigest) tuple or None.
+    """
+    parts = [p.strip() for p in line.split('|')]
+    url = parts[0]
+    checksum = None
+    if len(parts) > 1 and parts[1]:
+        algo, _, digest = parts[1].partition(':')
+        algo = algo.strip().lower()
+        if algo in SUPPORTED_CHECKSUM_ALGORITHMS and digest.strip():
+            checksum = (algo, digest.strip().lower())
+        else:
+            logger.warning(f"Ignoring unrecognised checksum '{parts[1]}' for {url}. Expected e.g. 'sha256:<hex>'.")
+    return url, checksum
+
+def compute_file_checksum(filepath, algo, chunk_size=1024 * 1024):
+    """Computes the hex digest of a file with the given hashlib algorithm."""
+    digest = hashlib.new(algo)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_http_session():
+    """Returns a requests.Session bound to the current thread (connection reuse per worker)."""
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
+
+def get_remote_size(session, url, timeout=60):
+    """Returns the remote Content-Length via a HEAD request, or None if unavailable."""
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        return int(length) if length is not None else None
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+def get_expected_total_size(response, resume_from):
+    """Derives the full file size from a 200 or 206 response, or None if the server does not say."""
+    content_range = response.headers.get('Content-Range', '') # e.g. 'bytes 100-999/1000'
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None and content_length.isdigit():
+        return int(content_length) + (resume_from if response.status_code == 206 else 0)
+    return None
+
+def download_file(url, target_dir, checksum=None, chunk_size=1024 * 1024, max_retries=3, bandwidth_limiter=None, timeout=300):
+    """
+    Downloads a file from a URL to a target directory.
+    Data is written to '<name>.part' and resumed with an HTTP Range request if a partial file is
+    left over from an interrupted run. The file is only renamed to its final name once its size
+    (and checksum, if given as an (algo, hexdigest) tuple) has been verified.
+    """
     Path(target_dir).mkdir(parents=True, exist_ok=True)
     filename = Path(urlparse(url).path).name
     target_filepath = Path(target_dir) / filename
+    part_filepath = target_filepath.with_name(filename + '.part')
+    session = get_http_session()
 
     if target_filepath.exists():
-        logging.info(f"File {filename} already exists in {target_dir}. Skipping download.")
-        return True
+        if checksum:
+            if compute_file_checksum(target_filepath, checksum[0]) == checksum[1]:
+                logger.info(f"File {filename} already exists and matches its {checksum[0]} checksum. Skipping download.")
+                return True
+            logger.warning(f"Existing file {filename} fails {checksum[0]} verification. Downloading it again.")
+            target_filepath.unlink()
+        else:
+            remote_size = get_remote_size(session, url)
+            local_size = target_filepath.stat().st_size
+            if remote_size is None or remote_size == local_size:
+                logger.info(f"File {filename} already exists in {target_dir}. Skipping download.")
+                return True
+            logger.warning(f"Existing file {filename} is {local_size} bytes but the server reports {remote_size}. Resuming it.")
+            os.replace(target_filepath, part_filepath) # Treat it as a partial download
 
-    try:
-        logging.info(f"Downloading {url} to {target_filepath}...")
-        response = requests.get(url, stream=True, timeout=300) # 5 min timeout
-        response.raise_for_status()  # Raises an HTTPError for bad responses (4XX or 5XX)
-        
-        with open(target_filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        logging.info(f"Successfully downloaded {filename}.")
-        return True
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"HTTP error downloading {url}: {e}")
-    except requests.exceptions.ConnectionError as e:
-        logging.error(f"Connection error downloading {url}: {e}")
-    except requests.exceptions.Timeout as e:
-        logging.error(f"Timeout downloading {url}: {e}")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error downloading {url}: {e}")
-    except IOError as e:
-        logging.error(f"File system error writing {target_filepath}: {e}")
+    for attempt in range(1, max_retries + 1):
+        resume_from = part_filepath.stat().st_size if part_filepath.exists() else 0
+        headers = {'Range': f'bytes={resume_from}-'} if resume_from > 0 else {}
+        try:
+            if resume_from > 0:
+                logger.info(f"Resuming {filename} from byte {resume_from} (attempt {attempt}/{max_retries})...")
+            else:
+                logger.info(f"Downloading {url} to {target_filepath} (attempt {attempt}/{max_retries})...")
+            with session.get(url, stream=True, timeout=timeout, headers=headers) as response:
+                if response.status_code == 416: # Range not satisfiable: the partial file is already complete (or bogus)
+                    expected_size = get_expected_total_size(response, resume_from) or get_remote_size(session, url)
+                    if expected_size != resume_from:
+                        logger.warning(f"Server rejected resume of {filename}; discarding the partial file.")
+                        part_filepath.unlink()
+                        continue
+                else:
+                    response.raise_for_status() # Raises an HTTPError for bad responses (4XX or 5XX)
+                    if resume_from > 0 and response.status_code != 206:
+                        logger.warning(f"Server does not support range requests for {filename}; restarting from zero.")
+                        resume_from = 0
+                    expected_size = get_expected_total_size(response, resume_from)
+                    with open(part_filepath, 'ab' if resume_from > 0 else 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            if bandwidth_limiter is not None:
+                                bandwidth_limiter.consume(len(chunk))
+
+            actual_size = part_filepath.stat().st_size
+            if expected_size is not None and actual_size != expected_size:
+                raise IOError(f"incomplete download ({actual_size} of {expected_size} bytes)")
+            if checksum:
+                actual_digest = compute_file_checksum(part_filepath, checksum[0])
+                if actual_digest != checksum[1]:
+                    part_filepath.unlink() # Corrupt data cannot be resumed, start over
+                    raise IOError(f"{checksum[0]} mismatch (expected {checksum[1]}, got {actual_digest})")
+
+            os.replace(part_filepath, target_filepath) # Atomic on the same filesystem
+            logger.info(f"Successfully downloaded {filename} ({actual_size} bytes).")
+            return True
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"HTTP error downloading {url}: {e}")
+            if e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                return False # Client errors will not go away by retrying
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"Connection error downloading {url}: {e}")
+        except requests.exceptions.Timeout as e:
+            logger.error(f"Timeout downloading {url}: {e}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error downloading {url}: {e}")
+        except IOError as e:
+            logger.error(f"Error writing or verifying {filename}: {e}")
+        if attempt < max_retries:
+            time.sleep(min(60, 2 ** attempt)) # Exponential backoff before resuming
+    logger.error(f"Giving up on {url} after {max_retries} attempts. Partial data (if any) is kept in {part_filepath.name} for the next run.")
     return False
 
+def download_files_concurrently(url_entries, target_dir, max_workers=4, chunk_size=1024 * 1024, max_retries=3, max_bytes_per_second=0):
+    """
+    Downloads (url, checksum) entries with a bounded thread pool sharing one bandwidth limiter.
+    Returns (success_count, error_count).
+    """
+    bandwidth_limiter = BandwidthLimiter(max_bytes_per_second)
+    success_count = 0
+    error_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(download_file, url, target_dir, checksum, chunk_size, max_retries, bandwidth_limiter): url
+            for url, checksum in url_entries
+        }
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                logger.error(f"Unexpected error downloading {futures[future]}: {e}", exc_info=True)
+                ok = False
+            if ok:
+                success_count += 1
+            else:
+                error_count += 1
+    return success_count, error_count
+
 # --- Main Execution ---
 if __name__ == "__main__":
     SCRIPT_DIR = Path(__file__).resolve().parent
@@ -80,7 +241,7 @@ if __name__ == "__main__":
         exit(1)
 
     default_config = app_config['DEFAULT']
-    lidar_config = app_config.get('LIDAR') # Use .get to avoid error if section missing
+    lidar_config = app_config['LIDAR'] if app_config.has_section('LIDAR') else None
 
     if not lidar_config:
         print("FATAL: [LIDAR] section not found in configuration file.") # Logger not set yet
@@ -99,8 +260,9 @@ if __name__ == "__main__":
         logger.info("--- LiDAR Data Acquisition Finished (No URLs) ---")
         exit(0)
     
-    lidar_urls = [url.strip() for url in lidar_data_urls_str.splitlines() if url.strip()]
-    if not lidar_urls: # After stripping, list might be empty
+    lidar_url_entries = [parse_lidar_url_entry(line.strip()) for line in lidar_data_urls_str.splitlines()
+                         if line.strip() and not line.strip().startswith('#')]
+    if not lidar_url_entries: # After stripping, list might be empty
         logger.warning("LiDAR data URLs list is empty after parsing. Nothing to download.")
         logger.info("--- LiDAR Data Acquisition Finished (No URLs) ---")
         exit(0)
@@ -112,19 +274,19 @@ if __name__ == "__main__":
     logger.info(f"Raw LiDAR data will be downloaded to: {raw_lidar_dir_abs}")
     Path(raw_lidar_dir_abs).mkdir(parents=True, exist_ok=True)
 
-    download_count = 0
-    error_count = 0
-    for url in lidar_urls:
-        if download_file(url, raw_lidar_dir_abs): # Use absolute path
-            download_count += 1
-        else:
-            error_count += 1
-            # download_file function already logs errors for the specific URL
-            # logger.warning(f"Failed to download from URL: {url}") # Redundant
+    download_workers = lidar_config.getint('download_workers', 4)
+    chunk_size_bytes = lidar_config.getint('download_chunk_size_kb', 1024) * 1024
+    max_retries = lidar_config.getint('download_max_retries', 3)
+    max_bytes_per_second = int(lidar_config.getfloat('download_max_mbps', 0) * 1024 * 1024)
+    logger.info(f"Downloading {len(lidar_url_entries)} files with {download_workers} concurrent workers"
+                + (f", capped at {max_bytes_per_second / (1024 * 1024):.1f} MB/s." if max_bytes_per_second > 0 else "."))
+
+    download_count, error_count = download_files_concurrently(
+        lidar_url_entries, raw_lidar_dir_abs, download_workers, chunk_size_bytes, max_retries, max_bytes_per_second)
 
     if error_count > 0:
         logger.warning(f"Finished LiDAR acquisition with {error_count} download errors.")
-    if download_count == 0 and error_count == 0 and lidar_urls: # Check if lidar_urls was not empty to begin with
+    if download_count == 0 and error_count == 0 and lidar_url_entries: # Check if lidar_url_entries was not empty to begin with
         logger.info("All specified LiDAR files were already present or no new valid URLs provided. No new downloads.")
     elif download_count > 0 :
          logger.info(f"Successfully downloaded/verified {download_count} LiDAR files.")
@@ -0,0 +1,91 @@
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from preprocess_lidar import generate_hillshade
+
+# Benchmarks the in-process NumPy hillshade engine against the gdaldem subprocess path
+# and reports wall time and the pixel differences between the two outputs.
+# Usage: python benchmark_hillshade.py [--dtm path/to/dtm.tif] [--size 4000] [--multi]
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__)
+
+
+def write_synthetic_dtm(dtm_path, size, resolution=1.0, seed=0):
+    """Writes a size x size float32 DTM with smooth relief, mounds and ditches to dtm_path."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)
+    dtm = 50 + 10 * np.sin(x / 300.0) * np.cos(y / 450.0)
+    for _ in range(200): # Mound- and ditch-like features
+        cx, cy = rng.uniform(0, size, 2)
+        radius = rng.uniform(5, 40)
+        dtm += rng.choice([-1.5, 2.0]) * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius ** 2))
+    dtm += rng.normal(0, 0.05, dtm.shape)
+    dtm[:5, :5] = -9999 # A nodata patch, like gaps in a PDAL DTM
+    profile = {
+        'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'width': size, 'height': size,
+        'crs': 'EPSG:31980', 'transform': from_origin(500000, 9700000, resolution, resolution),
+        'nodata': -9999, 'compress': 'lzw'
+    }
+    with rasterio.open(dtm_path, 'w', **profile) as dst:
+        dst.write(dtm.astype(np.float32), 1)
+
+def time_engine(engine, dtm_path, out_path, multi_directional, repeat):
+    """Returns the best wall time over `repeat` runs of generate_hillshade with the given engine."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if not generate_hillshade(dtm_path, out_path, multi_directional=multi_directional, engine=engine):
+            raise RuntimeError(f"Hillshade engine '{engine}' failed; see log output.")
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def compare_outputs(path_a, path_b):
+    """Returns (max absolute difference, fraction of differing pixels) between two Byte rasters."""
+    with rasterio.open(path_a) as a_ds, rasterio.open(path_b) as b_ds:
+        diff = np.abs(a_ds.read(1).astype(np.int16) - b_ds.read(1).astype(np.int16))
+    return int(diff.max()), float(np.count_nonzero(diff)) / diff.size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NumPy vs gdaldem hillshade generation.")
+    parser.add_argument('--dtm', type=Path, help="Existing DTM GeoTIFF (default: generate a synthetic one)")
+    parser.add_argument('--size', type=int, default=4000, help="Synthetic DTM size in pixels (default: 4000)")
+    parser.add_argument('--multi', action='store_true', help="Benchmark the 4-azimuth multi-directional mode")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per engine; the best time is reported")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+    work_dir = Path(tempfile.mkdtemp(prefix="hillshade_bench_"))
+    try:
+        dtm_path = args.dtm
+        if dtm_path is None:
+            dtm_path = work_dir / "synthetic_dtm.tif"
+            write_synthetic_dtm(dtm_path, args.size)
+        mode = "multi-directional" if args.multi else "single azimuth"
+        print(f"DTM: {dtm_path} ({mode})")
+
+        numpy_out = work_dir / "hillshade_numpy.tif"
+        numpy_time = time_engine('numpy', dtm_path, numpy_out, args.multi, args.repeat)
+        print(f"numpy   : {numpy_time:.2f}s")
+
+        if shutil.which("gdaldem") is None:
+            print("gdaldem not found in PATH; skipping the subprocess comparison.")
+        else:
+            gdaldem_out = work_dir / "hillshade_gdaldem.tif"
+            gdaldem_time = time_engine('gdaldem', dtm_path, gdaldem_out, args.multi, args.repeat)
+            max_diff, diff_fraction = compare_outputs(numpy_out, gdaldem_out)
+            print(f"gdaldem : {gdaldem_time:.2f}s")
+            print(f"speed-up: {gdaldem_time / numpy_time:.1f}x")
+            print(f"max abs difference: {max_diff} DN, differing pixels: {diff_fraction:.4%}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
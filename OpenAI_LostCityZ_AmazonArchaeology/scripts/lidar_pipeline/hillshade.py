@@ -0,0 +1,98 @@
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# In-process replacement for `gdaldem hillshade` (Horn's method, no -compute_edges).
+# Gradients are computed once per block and reused for every azimuth, and the DTM is
+# processed in row blocks with a one-pixel halo so memory stays bounded on large DTMs.
+
+logger = logging.getLogger(__name__)
+
+MULTI_DIRECTIONAL_AZIMUTHS = [315, 270, 225, 180] # Same directions as the gdaldem-based multi-directional mode
+
+
+def compute_horn_gradients(dem_block, ewres, nsres):
+    """
+    Computes Horn's 3x3 gradients for the interior of dem_block, which must carry a one-pixel
+    halo on every side. ewres/nsres are the geotransform pixel sizes (nsres is negative for
+    north-up rasters), matching gdaldem's conventions.
+    Returns (x, y, invalid) where invalid marks cells whose 3x3 window touches a NaN.
+    """
+    a = dem_block[:-2, :-2]
+    b = dem_block[:-2, 1:-1]
+    c = dem_block[:-2, 2:]
+    d = dem_block[1:-1, :-2]
+    f = dem_block[1:-1, 2:]
+    g = dem_block[2:, :-2]
+    h = dem_block[2:, 1:-1]
+    i = dem_block[2:, 2:]
+    x = ((a + d + d + g) - (c + f + f + i)) / ewres
+    y = ((g + h + h + i) - (a + b + b + c)) / nsres
+    invalid = np.isnan(x) | np.isnan(y)
+    return x, y, invalid
+
+def shade_from_gradients(x, y, invalid, azimuths, altitude=45, z_factor=1):
+    """
+    Turns Horn gradients into one gdaldem-compatible hillshade per azimuth (values 1-255, 0 = nodata).
+    The slope term is evaluated once and shared by all azimuths.
+    """
+    z_scaled = z_factor / 8.0
+    alt_radians = math.radians(altitude)
+    sin_alt_254 = 254.0 * math.sin(alt_radians)
+    cos_alt_z_254 = 254.0 * math.cos(alt_radians) * z_scaled
+    with np.errstate(invalid='ignore'):
+        inv_norm = 1.0 / np.sqrt(1.0 + (z_scaled * z_scaled) * (x * x + y * y))
+    shades = []
+    for az in azimuths:
+        az_radians = math.radians(az)
+        with np.errstate(invalid='ignore'):
+            cang = (sin_alt_254 - (y * (math.cos(az_radians) * cos_alt_z_254)
+                                   - x * (math.sin(az_radians) * cos_alt_z_254))) * inv_norm
+            shade = np.where(cang <= 0.0, 1.0, 1.0 + cang)
+        # GDAL rounds to nearest when writing the float result into its Byte band
+        shade = np.floor(shade + 0.5)
+        shade[invalid] = 0
+        shades.append(shade)
+    return shades
+
+def read_block_with_halo(src, row_start, row_stop, nodata):
+    """
+    Reads rows [row_start, row_stop) of band 1 plus a one-pixel halo as float64, padding
+    outside the raster (and nodata cells) with NaN so edge cells come out as nodata like gdaldem.
+    """
+    halo_start = max(0, row_start - 1)
+    halo_stop = min(src.height, row_stop + 1)
+    data = src.read(1, window=Window(0, halo_start, src.width, halo_stop - halo_start)).astype(np.float64)
+    if nodata is not None:
+        data[data == nodata] = np.nan
+    pad_top = 1 if row_start == 0 else 0
+    pad_bottom = 1 if row_stop == src.height else 0
+    return np.pad(data, ((pad_top, pad_bottom), (1, 1)), mode='constant', constant_values=np.nan)
+
+def compute_hillshade_numpy(dtm_path, hillshade_path, azimuths, altitude=45, z_factor=1, block_rows=1024):
+    """
+    Writes a Byte hillshade of dtm_path to hillshade_path. With several azimuths the per-azimuth
+    hillshades are averaged (truncated to Byte), like the gdaldem-based multi-directional mode.
+    """
+    with rasterio.open(dtm_path) as src:
+        ewres = src.transform.a
+        nsres = src.transform.e
+        profile = src.profile.copy()
+        profile.update(dtype=rasterio.uint8, count=1, compress='lzw', nodata=0)
+        with rasterio.open(hillshade_path, 'w', **profile) as dst:
+            for row_start in range(0, src.height, block_rows):
+                row_stop = min(src.height, row_start + block_rows)
+                dem_block = read_block_with_halo(src, row_start, row_stop, src.nodata)
+                x, y, invalid = compute_horn_gradients(dem_block, ewres, nsres)
+                shades = shade_from_gradients(x, y, invalid, azimuths, altitude, z_factor)
+                if len(shades) == 1:
+                    hillshade_block = shades[0].astype(np.uint8)
+                else:
+                    hillshade_block = (np.sum(shades, axis=0) / len(shades)).astype(np.uint8)
+                dst.write(hillshade_block, 1, window=Window(0, row_start, src.width, row_stop - row_start))
+    logger.info(f"Computed hillshade in-process ({len(azimuths)} azimuth(s)): {Path(hillshade_path).name}")
+    return True
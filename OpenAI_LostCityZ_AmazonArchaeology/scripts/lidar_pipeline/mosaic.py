@@ -0,0 +1,122 @@
+import logging
+import math
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import geopandas
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds as window_from_bounds, transform as window_transform
+
+# Mosaics the per-tile DTMs into one seamless AOI DTM.
+# The tiles are referenced from a GDAL VRT (no pixel copy), which is then clipped to the AOI
+# once, block by block. Hillshade and terrain derivatives computed on the clipped mosaic read
+# across former tile borders through their halos, so no seams or duplicated edge work remain.
+
+logger = logging.getLogger(__name__)
+
+MOSAIC_NODATA = -9999.0 # Same as PDAL's writers.gdal default
+
+
+def build_dtm_vrt(dtm_paths, vrt_path):
+    """
+    Writes a VRT mosaic of the given single-band DTM tiles to vrt_path.
+    All tiles must share a CRS; the mosaic uses the finest tile resolution. Where tiles overlap,
+    valid pixels of later tiles (sorted by name) win and their nodata pixels are transparent.
+    Returns vrt_path.
+    """
+    dtm_paths = sorted(Path(p) for p in dtm_paths)
+    if not dtm_paths:
+        raise ValueError("No DTM tiles to mosaic.")
+
+    tiles = []
+    for dtm_path in dtm_paths:
+        with rasterio.open(dtm_path) as src:
+            tiles.append({
+                'path': dtm_path.resolve(), 'crs': src.crs, 'bounds': src.bounds, 'width': src.width,
+                'height': src.height, 'xres': abs(src.transform.a), 'yres': abs(src.transform.e),
+                'dtype': src.dtypes[0], 'nodata': src.nodata,
+            })
+    crs = tiles[0]['crs']
+    for tile in tiles[1:]:
+        if tile['crs'] != crs:
+            raise ValueError(f"Cannot mosaic {tile['path'].name}: CRS {tile['crs']} differs from {crs}.")
+
+    res = min(min(t['xres'], t['yres']) for t in tiles)
+    left = min(t['bounds'].left for t in tiles)
+    top = max(t['bounds'].top for t in tiles)
+    right = max(t['bounds'].right for t in tiles)
+    bottom = min(t['bounds'].bottom for t in tiles)
+    width = int(math.ceil(round((right - left) / res, 6)))
+    height = int(math.ceil(round((top - bottom) / res, 6)))
+    data_type = {'float32': 'Float32', 'float64': 'Float64'}.get(tiles[0]['dtype'], 'Float32')
+
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(root, 'SRS').text = crs.to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = f"{left!r}, {res!r}, 0.0, {top!r}, 0.0, {-res!r}"
+    band = ET.SubElement(root, 'VRTRasterBand', dataType=data_type, band='1')
+    ET.SubElement(band, 'NoDataValue').text = repr(MOSAIC_NODATA)
+    for tile in tiles:
+        source = ET.SubElement(band, 'ComplexSource')
+        ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = str(tile['path'])
+        ET.SubElement(source, 'SourceBand').text = '1'
+        ET.SubElement(source, 'SrcRect', xOff='0', yOff='0', xSize=str(tile['width']), ySize=str(tile['height']))
+        ET.SubElement(source, 'DstRect',
+                      xOff=repr((tile['bounds'].left - left) / res), yOff=repr((top - tile['bounds'].top) / res),
+                      xSize=repr(tile['width'] * tile['xres'] / res), ySize=repr(tile['height'] * tile['yres'] / res))
+        nodata = tile['nodata'] if tile['nodata'] is not None else MOSAIC_NODATA
+        ET.SubElement(source, 'NODATA').text = repr(float(nodata))
+    ET.ElementTree(root).write(vrt_path, encoding='utf-8')
+
+    logger.info(f"Built VRT mosaic of {len(tiles)} DTM tiles ({width}x{height} px at {res} m): {Path(vrt_path).name}")
+    return vrt_path
+
+def clip_mosaic_to_aoi(mosaic_path, output_path, aoi_geometries, block_size=1024):
+    """
+    Clips a (VRT) mosaic to the AOI in one pass, block by block: only the AOI's pixel window
+    is read and the AOI mask is rasterized per block. Writes a tiled float32 GeoTIFF with
+    MOSAIC_NODATA outside the AOI and in data gaps. Returns True on success, False if the AOI
+    does not overlap the mosaic.
+    """
+    with rasterio.open(mosaic_path) as src:
+        aoi_gdf = geopandas.GeoDataFrame({'geometry': aoi_geometries}, crs="EPSG:4326") # Assuming AOI is WGS84
+        if src.crs and src.crs.to_string().upper() != aoi_gdf.crs.to_string().upper():
+            aoi_gdf = aoi_gdf.to_crs(src.crs)
+        shapes = list(aoi_gdf.geometry)
+
+        # Round the window's start down and its end up, so every pixel the AOI touches is kept
+        bounds_window = window_from_bounds(*aoi_gdf.total_bounds, transform=src.transform)
+        col_start = max(0, math.floor(bounds_window.col_off))
+        row_start = max(0, math.floor(bounds_window.row_off))
+        col_stop = min(src.width, math.ceil(bounds_window.col_off + bounds_window.width))
+        row_stop = min(src.height, math.ceil(bounds_window.row_off + bounds_window.height))
+        if col_stop <= col_start or row_stop <= row_start:
+            logger.error(f"AOI does not overlap the mosaic {Path(mosaic_path).name}.")
+            return False
+        aoi_window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        out_width, out_height = int(aoi_window.width), int(aoi_window.height)
+        src_nodata = src.nodata
+
+        block = max(16, block_size // 16 * 16) # GeoTIFF tiles must be multiples of 16
+        profile = {
+            'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'width': out_width, 'height': out_height,
+            'crs': src.crs, 'transform': window_transform(aoi_window, src.transform), 'nodata': MOSAIC_NODATA,
+            'compress': 'deflate', 'predictor': 3, 'tiled': True, 'blockxsize': block, 'blockysize': block,
+            'BIGTIFF': 'IF_SAFER',
+        }
+        logger.info(f"Clipping mosaic to AOI window {out_width}x{out_height} px in {block}px blocks -> {Path(output_path).name}")
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for row_off in range(0, out_height, block):
+                for col_off in range(0, out_width, block):
+                    dst_window = Window(col_off, row_off, min(block, out_width - col_off), min(block, out_height - row_off))
+                    src_window = Window(aoi_window.col_off + col_off, aoi_window.row_off + row_off,
+                                        dst_window.width, dst_window.height)
+                    data = src.read(1, window=src_window).astype(np.float32)
+                    outside_aoi = geometry_mask(shapes, out_shape=data.shape, all_touched=True,
+                                                transform=window_transform(src_window, src.transform))
+                    if src_nodata is not None:
+                        outside_aoi |= data == src_nodata
+                    data[outside_aoi] = MOSAIC_NODATA
+                    dst.write(data, 1, window=dst_window)
+    return True
@@ -1,7 +1,10 @@
+import argparse
 import configparser
 import logging
 import os
 import json
+import subprocess
+import sys
 import pdal
 import rasterio
 from rasterio.mask import mask as rio_mask
@@ -12,10 +15,17 @@ import geopandas
 import numpy as np
 from pathlib import Path
 import laspy # For LAZ to LAS conversion if chosen
+from hillshade import compute_hillshade_numpy, MULTI_DIRECTIONAL_AZIMUTHS
+from terrain_derivatives import compute_terrain_derivatives, derivative_output_paths
+from mosaic import build_dtm_vrt, clip_mosaic_to_aoi
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # scripts/ for the shared utils package
+from utils.build_cache import BuildCache, code_version
+from utils.cog import cog_options_from_config, finalize_as_cog, write_cog
 
 
 # --- Configuration and Logging Setup ---
-CONFIG_FILE_PATH = "../config/config.ini" # Adjusted path
+CONFIG_FILE_PATH = "../../config/config.ini" # Relative to the script directory
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logger = logging.getLogger(__name__) # Define logger at module level
 
@@ -88,24 +98,54 @@ def get_aoi_geometry_from_config(app_config_default, project_root_path):
     else:
         raise ValueError("AOI not defined. Provide 'aoi_geojson_path' or 'aoi_bbox' in DEFAULT config.")
 
-def convert_laz_to_las(laz_filepath, las_filepath):
-    """Converts a LAZ file to LAS using laspy."""
+def convert_laz_to_las(laz_filepath, las_filepath, chunk_points=None):
+    """
+    Converts a LAZ file to LAS using laspy.
+    If chunk_points is given, points are decompressed and written in chunks of that many
+    points, so memory use does not grow with the size of the tile.
+    """
     try:
         logger.info(f"Converting {laz_filepath.name} to LAS format...")
-        laz = laspy.read(laz_filepath)
-        las = laspy.create(point_format=laz.header.point_format, file_version=laz.header.version)
-        las.points = laz.points
-        las.write(las_filepath)
+        if chunk_points:
+            with laspy.open(laz_filepath) as reader:
+                with laspy.open(las_filepath, mode='w', header=reader.header, do_compress=False) as writer:
+                    for points in reader.chunk_iterator(chunk_points):
+                        writer.write_points(points)
+        else:
+            laz = laspy.read(laz_filepath)
+            las = laspy.create(point_format=laz.header.point_format, file_version=laz.header.version)
+            las.points = laz.points
+            las.write(las_filepath)
         logger.info(f"Successfully converted to {las_filepath.name}")
         return True
     except Exception as e:
         logger.error(f"Error converting LAZ to LAS for {laz_filepath.name}: {e}")
+        if Path(las_filepath).exists():
+            Path(las_filepath).unlink() # Do not leave a truncated LAS to be picked up by the next run
         return False
 
+def strip_pipeline_template(pipeline_json_template_str):
+    """Removes the triple quotes that wrap multi-line pipeline templates in config.ini."""
+    return pipeline_json_template_str.strip().strip('"').strip()
+
+def build_fused_pipeline_template(gnd_pipeline_template_str, dtm_pipeline_template_str, write_ground_las=False):
+    """
+    Chains the ground-classification stages (reader, reprojection, ground filter, range) and the
+    DTM writers.gdal stage into a single pipeline template so the point cloud stays in memory.
+    The ground writers.las stage is kept only if write_ground_las is True; PDAL passes the points
+    on from a writer, so it can precede writers.gdal in the same pipeline.
+    """
+    gnd_stages = json.loads(strip_pipeline_template(gnd_pipeline_template_str))["pipeline"]
+    dtm_stages = json.loads(strip_pipeline_template(dtm_pipeline_template_str))["pipeline"]
+    fused_stages = [stage for stage in gnd_stages
+                    if write_ground_las or stage.get("type") != "writers.las"]
+    fused_stages += [stage for stage in dtm_stages if not stage.get("type", "").startswith("readers.")]
+    return json.dumps({"pipeline": fused_stages}, indent=4)
+
 def run_pdal_pipeline(input_file, output_file, pipeline_json_template_str, replacements):
     """Runs a PDAL pipeline after replacing placeholders in the JSON string."""
     try:
-        pipeline_json_str = pipeline_json_template_str
+        pipeline_json_str = strip_pipeline_template(pipeline_json_template_str)
         for placeholder, value in replacements.items():
             pipeline_json_str = pipeline_json_str.replace(placeholder, str(value))
         
@@ -143,8 +183,32 @@ def run_pdal_pipeline(input_file, output_file, pipeline_json_template_str, repla
         # logger.error(f"PDAL Pipeline that failed: {json.dumps(pipeline_json, indent=2)}")
         return False
 
-def generate_hillshade(dtm_path, hillshade_path, azimuth=315, altitude=45, z_factor=1, multi_directional=False):
-    """Generates a hillshade raster from a DTM using Rasterio (GDAL)."""
+def generate_hillshade(dtm_path, hillshade_path, azimuth=315, altitude=45, z_factor=1, multi_directional=False, engine='numpy', block_rows=1024, cog_options=None):
+    """
+    Generates a hillshade raster from a DTM.
+    engine='numpy' computes it in-process (see hillshade.py); engine='gdaldem' shells out to gdaldem.
+    With cog_options the result is rewritten as a Cloud-Optimized GeoTIFF.
+    """
+    if engine == 'gdaldem':
+        success = generate_hillshade_gdaldem(dtm_path, hillshade_path, azimuth, altitude, z_factor, multi_directional)
+    else:
+        try:
+            logger.info(f"Generating hillshade for {dtm_path.name} -> {hillshade_path.name}")
+            azimuths = MULTI_DIRECTIONAL_AZIMUTHS if multi_directional else [azimuth]
+            success = compute_hillshade_numpy(dtm_path, hillshade_path, azimuths, altitude, z_factor, block_rows)
+        except Exception as e:
+            logger.error(f"Error generating hillshade for {dtm_path.name}: {e}")
+            return False
+    if success and cog_options:
+        try:
+            finalize_as_cog(hillshade_path, **cog_options)
+        except Exception as e:
+            logger.error(f"Error converting hillshade {hillshade_path.name} to COG: {e}")
+            return False
+    return success
+
+def generate_hillshade_gdaldem(dtm_path, hillshade_path, azimuth=315, altitude=45, z_factor=1, multi_directional=False):
+    """Generates a hillshade raster from a DTM using the gdaldem command-line tool."""
     try:
         logger.info(f"Generating hillshade for {dtm_path.name} -> {hillshade_path.name}")
         with rasterio.open(dtm_path) as src_ds:
@@ -153,7 +217,7 @@ def generate_hillshade(dtm_path, hillshade_path, azimuth=315, altitude=45, z_fac
 
             if multi_directional:
                 logger.info("Generating multi-directional hillshade.")
-                azimuths = [315, 270, 225, 180] # Example directions
+                azimuths = MULTI_DIRECTIONAL_AZIMUTHS
                 altitude_val = altitude
                 hillshade_sum = np.zeros(src_ds.shape, dtype=np.float32)
                 
@@ -210,8 +274,39 @@ def generate_hillshade(dtm_path, hillshade_path, azimuth=315, altitude=45, z_fac
         logger.error(f"Error generating hillshade for {dtm_path.name}: {e}")
         return False
 
-def clip_raster(input_raster_path, output_raster_path, aoi_geometries, target_crs_epsg):
-    """Clips a raster to the AOI geometries."""
+def generate_terrain_derivatives(dtm_path, output_dir, derivative_params, cog_options=None):
+    """Computes the terrain derivative suite (see terrain_derivatives.py) for a DTM."""
+    try:
+        output_paths = compute_terrain_derivatives(dtm_path, output_dir, **derivative_params)
+        if cog_options:
+            for derivative_path in output_paths.values():
+                finalize_as_cog(derivative_path, **cog_options)
+        return True
+    except Exception as e:
+        logger.error(f"Error computing terrain derivatives for {dtm_path.name}: {e}", exc_info=True)
+        return False
+
+def build_aoi_mosaic(dtm_paths, output_dir, mosaic_name, aoi_geometries, block_size=1024, cog_options=None):
+    """
+    Mosaics the per-tile DTMs through a VRT and clips the mosaic to the AOI once (see mosaic.py).
+    Returns the path of the clipped mosaic DTM, or None on failure.
+    """
+    vrt_path = Path(output_dir) / f"{mosaic_name}_dtm_mosaic.vrt"
+    clipped_path = Path(output_dir) / f"{mosaic_name}_dtm_mosaic_clipped_aoi.tif"
+    try:
+        build_dtm_vrt(dtm_paths, vrt_path)
+        if not clip_mosaic_to_aoi(vrt_path, clipped_path, aoi_geometries, block_size):
+            return None
+        if cog_options:
+            finalize_as_cog(clipped_path, **cog_options)
+        logger.info(f"Successfully built AOI DTM mosaic {clipped_path.name}")
+        return clipped_path
+    except Exception as e:
+        logger.error(f"Error building AOI DTM mosaic from {len(dtm_paths)} tiles: {e}", exc_info=True)
+        return None
+
+def clip_raster(input_raster_path, output_raster_path, aoi_geometries, target_crs_epsg, cog_options=None):
+    """Clips a raster to the AOI geometries. With cog_options the clip is written as a Cloud-Optimized GeoTIFF."""
     try:
         logger.info(f"Clipping {input_raster_path.name} to AOI -> {output_raster_path.name}")
         with rasterio.open(input_raster_path) as src:
@@ -233,8 +328,11 @@ def clip_raster(input_raster_path, output_raster_path, aoi_geometries, target_cr
                 "crs": src.crs # CRS should be preserved from source
             })
 
-            with rasterio.open(output_raster_path, "w", **out_meta) as dest:
-                dest.write(out_image)
+            if cog_options:
+                write_cog(output_raster_path, out_image, out_meta, **cog_options)
+            else:
+                with rasterio.open(output_raster_path, "w", **out_meta) as dest:
+                    dest.write(out_image)
             logger.info(f"Successfully clipped raster to {output_raster_path.name}")
             return True
     except Exception as e:
@@ -243,6 +341,11 @@ def clip_raster(input_raster_path, output_raster_path, aoi_geometries, target_cr
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess LiDAR tiles into DTMs, hillshades and terrain derivatives.")
+    parser.add_argument('--tiles-only', action='store_true',
+                        help="Only build per-tile DTMs and skip the AOI mosaic stage (used by run_pipelines.py while tiles are still downloading)")
+    args = parser.parse_args()
+
     SCRIPT_DIR = Path(__file__).resolve().parent
     PROJECT_ROOT = SCRIPT_DIR.parent.parent
 
@@ -253,9 +356,9 @@ if __name__ == "__main__":
         exit(1)
 
     default_config = app_config['DEFAULT']
-    lidar_config = app_config.get('LIDAR')
+    lidar_config = app_config['LIDAR'] if app_config.has_section('LIDAR') else None
 
-    if not lidar_config:
+    if lidar_config is None:
         print("FATAL: [LIDAR] section not found in configuration file.") # Logger not set up
         exit(1)
 
@@ -300,78 +403,223 @@ if __name__ == "__main__":
     hs_altitude = lidar_config.getint('hillshade_altitude', 45)
     hs_z_factor = lidar_config.getfloat('hillshade_z_factor', 1.0)
     hs_multi = lidar_config.getboolean('multi_directional_hillshade', True)
+    hs_engine = lidar_config.get('hillshade_engine', 'numpy').lower()
+    hs_block_rows = lidar_config.getint('hillshade_block_rows', 1024)
+
+    cog_options = cog_options_from_config(lidar_config) # raster_output_format etc. are inherited from [DEFAULT]
+    if cog_options:
+        logger.info(f"Raster products will be written as COGs: {cog_options}")
+
+    compute_derivatives = lidar_config.getboolean('compute_terrain_derivatives', False)
+    derivative_params = {
+        'tpi_radii_m': [float(r) for r in lidar_config.get('tpi_radii_m', '3, 10, 30').split(',') if r.strip()],
+        'lrm_radius_m': lidar_config.getfloat('lrm_radius_m', 20.0),
+        'svf_radius_m': lidar_config.getfloat('svf_radius_m', 10.0),
+        'svf_directions': lidar_config.getint('svf_directions', 16),
+        'tile_size': lidar_config.getint('derivative_tile_size', 1024),
+        'max_workers': lidar_config.getint('derivative_workers', 0),
+    }
+
+    laz_input_mode = lidar_config.get('laz_input_mode', 'full').lower()
+    if laz_input_mode not in ('direct', 'stream', 'full'):
+        logger.warning(f"Unknown laz_input_mode '{laz_input_mode}'. Defaulting to 'full'.")
+        laz_input_mode = 'full'
+    laz_chunk_points = lidar_config.getint('laz_conversion_chunk_points', 2000000)
+    keep_intermediate_las = lidar_config.getboolean('keep_intermediate_las', True)
+    logger.info(f"LAZ input mode: {laz_input_mode}")
+
+    pdal_pipeline_mode = lidar_config.get('pdal_pipeline_mode', 'separate').lower()
+    write_ground_las = lidar_config.getboolean('write_ground_las', False)
+    if pdal_pipeline_mode == 'fused':
+        try:
+            fused_pipeline_template = build_fused_pipeline_template(gnd_pipeline_template, dtm_pipeline_template, write_ground_las)
+        except (json.JSONDecodeError, KeyError) as e:
+            logger.error(f"Could not build fused PDAL pipeline from the configured templates: {e}. Falling back to separate pipelines.")
+            pdal_pipeline_mode = 'separate'
+    elif pdal_pipeline_mode != 'separate':
+        logger.warning(f"Unknown pdal_pipeline_mode '{pdal_pipeline_mode}'. Defaulting to 'separate'.")
+        pdal_pipeline_mode = 'separate'
+    logger.info(f"PDAL pipeline mode: {pdal_pipeline_mode}")
+
+    # Mosaic mode: tiles only produce their unclipped DTM; clipping, hillshade and derivatives
+    # then run once on the seamless AOI mosaic instead of per tile.
+    mosaic_tiles = lidar_config.getboolean('mosaic_tiles', False)
+    mosaic_name = lidar_config.get('mosaic_name', 'aoi')
+    mosaic_block_size = lidar_config.getint('mosaic_block_size', 1024)
+    mosaic_dtm_paths = []
+    logger.info(f"Per-tile outputs: {'mosaicked to one AOI DTM' if mosaic_tiles else 'clipped per tile'}")
+
+    # Incremental builds: each output is keyed on its inputs' content, the config values it depends on
+    # and the code that produces it (see scripts/utils/build_cache.py)
+    build_cache = BuildCache(default_config.getboolean('incremental_builds', True))
+    pdal_code_version = code_version(Path(__file__))
+    raster_code_version = code_version(Path(__file__), SCRIPT_DIR / 'hillshade.py', SCRIPT_DIR / 'terrain_derivatives.py',
+                                       SCRIPT_DIR / 'mosaic.py')
+    aoi_wkt = [geom.wkt for geom in aoi_geom_list_wgs84]
+    gnd_params = {'pipeline': gnd_pipeline_template, 'crs': target_projected_crs}
+    dtm_params = {'pipeline': dtm_pipeline_template, 'resolution': dtm_resolution, 'method': dtm_interp_method,
+                  'crs': target_projected_crs}
+    clip_params = {'aoi': aoi_wkt, 'crs': target_projected_crs, 'cog': cog_options}
+    hillshade_params = {'azimuth': hs_azimuth, 'altitude': hs_altitude, 'z_factor': hs_z_factor, 'multi': hs_multi,
+                        'engine': hs_engine, 'cog': cog_options}
+    # Tiling and worker count do not change the derivative values
+    derivatives_build_params = {**{k: v for k, v in derivative_params.items() if k not in ('tile_size', 'max_workers')},
+                                'cog': cog_options}
+    logger.info(f"Incremental builds: {'enabled' if build_cache.enabled else 'disabled (existing outputs are reused as-is)'}")
+
+    def derivatives_current(dtm_path):
+        derivative_paths = derivative_output_paths(dtm_path, processed_lidar_dir_abs, derivative_params['tpi_radii_m'])
+        return all([build_cache.is_current(path, [dtm_path], derivatives_build_params, raster_code_version)
+                    for path in derivative_paths.values()])
+
+    def run_hillshade_and_derivatives(dtm_path, hillshade_path):
+        """Builds the hillshade and derivatives of dtm_path unless their build records are current."""
+        if build_cache.is_current(hillshade_path, [dtm_path], hillshade_params, raster_code_version):
+            logger.info(f"Hillshade {hillshade_path.name} is up to date. Skipping.")
+        elif generate_hillshade(dtm_path, hillshade_path, hs_azimuth, hs_altitude, hs_z_factor, hs_multi, hs_engine, hs_block_rows, cog_options):
+            build_cache.record(hillshade_path, [dtm_path], hillshade_params, raster_code_version)
+        else:
+            logger.warning(f"Failed to generate hillshade for {dtm_path.name}")
+
+        if not compute_derivatives:
+            return
+        if derivatives_current(dtm_path):
+            logger.info(f"Terrain derivatives of {dtm_path.name} are up to date. Skipping.")
+        elif generate_terrain_derivatives(dtm_path, processed_lidar_dir_abs, derivative_params, cog_options):
+            for path in derivative_output_paths(dtm_path, processed_lidar_dir_abs, derivative_params['tpi_radii_m']).values():
+                build_cache.record(path, [dtm_path], derivatives_build_params, raster_code_version)
+        else:
+            logger.warning(f"Failed to compute terrain derivatives for {dtm_path.name}")
 
     processed_files_count = 0
-    for raw_file_path in raw_lidar_dir.iterdir():
+    for raw_file_path in raw_lidar_dir_abs.iterdir():
         if not (raw_file_path.name.lower().endswith(".laz") or raw_file_path.name.lower().endswith(".las")):
             continue
 
         logger.info(f"Processing file: {raw_file_path.name}")
         base_name = raw_file_path.stem
         
-        # Determine input for PDAL (either original .las or converted .las)
+        ground_points_las = processed_lidar_dir_abs / f"{base_name}_ground.las"
+        dtm_unclipped_path = processed_lidar_dir_abs / f"{base_name}_dtm_unclipped.tif"
+        # The point cloud is only read if the first PDAL output of the chosen mode is missing or stale.
+        # Both are keyed on the raw file, so a deleted intermediate LAS does not invalidate them.
+        if pdal_pipeline_mode == 'fused':
+            point_cloud_needed = not build_cache.is_current(dtm_unclipped_path, [raw_file_path],
+                                                            {'ground': gnd_params, 'dtm': dtm_params}, pdal_code_version)
+        else:
+            point_cloud_needed = not build_cache.is_current(ground_points_las, [raw_file_path], gnd_params, pdal_code_version)
+
+        # Determine input for PDAL (original .las/.laz, or .las converted from .laz)
+        # readers.las decompresses LAZ itself, so 'direct' mode needs no intermediate file.
         input_for_pdal = raw_file_path
-        if raw_file_path.name.lower().endswith(".laz"):
-            converted_las_path = processed_lidar_dir / f"{base_name}_converted.las"
-            if not converted_las_path.exists(): # Avoid re-conversion
-                if not convert_laz_to_las(raw_file_path, converted_las_path):
+        converted_las_path = None
+        if raw_file_path.name.lower().endswith(".laz") and laz_input_mode != 'direct':
+            converted_las_path = processed_lidar_dir_abs / f"{base_name}_converted.las"
+            if point_cloud_needed and not build_cache.is_current(converted_las_path, [raw_file_path], {}, pdal_code_version): # Avoid re-conversion
+                chunk_points = laz_chunk_points if laz_input_mode == 'stream' else None
+                if not convert_laz_to_las(raw_file_path, converted_las_path, chunk_points):
                     logger.error(f"Skipping {raw_file_path.name} due to LAZ conversion error.")
                     continue
+                build_cache.record(converted_las_path, [raw_file_path], {}, pdal_code_version)
             input_for_pdal = converted_las_path
-        
-        # --- Ground Classification ---
-        ground_points_las = processed_lidar_dir / f"{base_name}_ground.las"
-        if not ground_points_las.exists(): # Avoid re-processing
-            gnd_replacements = {
-                "INPUT_FILE_PLACEHOLDER": str(input_for_pdal.resolve()), # For PDAL, ensure paths are absolute
-                "OUTPUT_GROUND_FILE_PLACEHOLDER": str(ground_points_las.resolve()),
-                "TARGET_PROJECTED_CRS_PLACEHOLDER": target_projected_crs
-            }
-            if not run_pdal_pipeline(str(input_for_pdal.resolve()), str(ground_points_las.resolve()), gnd_pipeline_template, gnd_replacements):
-                logger.error(f"Skipping DTM/hillshade for {raw_file_path.name} due to ground classification error.")
-                continue
-        else:
-            logger.info(f"Ground classified file {ground_points_las.name} already exists. Using it.")
-
-        # --- DTM Generation ---
-        dtm_unclipped_path = processed_lidar_dir / f"{base_name}_dtm_unclipped.tif"
-        if not dtm_unclipped_path.exists(): # Avoid re-processing
-            dtm_replacements = {
-                "INPUT_GROUND_POINTS_PLACEHOLDER": str(ground_points_las.resolve()),
-                "OUTPUT_DTM_FILE_PLACEHOLDER": str(dtm_unclipped_path.resolve()),
-                "DTM_RESOLUTION_PLACEHOLDER": dtm_resolution,
-                "DTM_INTERPOLATION_METHOD_PLACEHOLDER": dtm_interp_method,
-                "TARGET_PROJECTED_CRS_PLACEHOLDER": target_projected_crs
-            }
-            if not run_pdal_pipeline(str(ground_points_las.resolve()), str(dtm_unclipped_path.resolve()), dtm_pipeline_template, dtm_replacements):
-                logger.error(f"Skipping hillshade for {raw_file_path.name} due to DTM generation error.")
-                continue
+
+        gnd_replacements = {
+            "INPUT_FILE_PLACEHOLDER": str(input_for_pdal.resolve()), # For PDAL, ensure paths are absolute
+            "OUTPUT_GROUND_FILE_PLACEHOLDER": str(ground_points_las.resolve()),
+            "TARGET_PROJECTED_CRS_PLACEHOLDER": target_projected_crs
+        }
+        dtm_replacements = {
+            "INPUT_GROUND_POINTS_PLACEHOLDER": str(ground_points_las.resolve()),
+            "OUTPUT_DTM_FILE_PLACEHOLDER": str(dtm_unclipped_path.resolve()),
+            "DTM_RESOLUTION_PLACEHOLDER": dtm_resolution,
+            "DTM_INTERPOLATION_METHOD_PLACEHOLDER": dtm_interp_method,
+            "TARGET_PROJECTED_CRS_PLACEHOLDER": target_projected_crs
+        }
+
+        if pdal_pipeline_mode == 'fused':
+            # --- Ground Classification + DTM Generation in one pipeline ---
+            if point_cloud_needed:
+                fused_replacements = {**gnd_replacements, **dtm_replacements}
+                if not run_pdal_pipeline(str(input_for_pdal.resolve()), str(dtm_unclipped_path.resolve()), fused_pipeline_template, fused_replacements):
+                    logger.error(f"Skipping hillshade for {raw_file_path.name} due to fused ground/DTM pipeline error.")
+                    continue
+                build_cache.record(dtm_unclipped_path, [raw_file_path], {'ground': gnd_params, 'dtm': dtm_params}, pdal_code_version)
+            else:
+                logger.info(f"Unclipped DTM {dtm_unclipped_path.name} is up to date. Using it.")
         else:
-            logger.info(f"Unclipped DTM {dtm_unclipped_path.name} already exists. Using it.")
+            # --- Ground Classification ---
+            if point_cloud_needed: # Avoid re-processing
+                if not run_pdal_pipeline(str(input_for_pdal.resolve()), str(ground_points_las.resolve()), gnd_pipeline_template, gnd_replacements):
+                    logger.error(f"Skipping DTM/hillshade for {raw_file_path.name} due to ground classification error.")
+                    continue
+                build_cache.record(ground_points_las, [raw_file_path], gnd_params, pdal_code_version)
+            else:
+                logger.info(f"Ground classified file {ground_points_las.name} is up to date. Using it.")
+
+            # --- DTM Generation ---
+            if not build_cache.is_current(dtm_unclipped_path, [ground_points_las], dtm_params, pdal_code_version): # Avoid re-processing
+                if not run_pdal_pipeline(str(ground_points_las.resolve()), str(dtm_unclipped_path.resolve()), dtm_pipeline_template, dtm_replacements):
+                    logger.error(f"Skipping hillshade for {raw_file_path.name} due to DTM generation error.")
+                    continue
+                build_cache.record(dtm_unclipped_path, [ground_points_las], dtm_params, pdal_code_version)
+            else:
+                logger.info(f"Unclipped DTM {dtm_unclipped_path.name} is up to date. Using it.")
+
+        if converted_las_path is not None and not keep_intermediate_las and converted_las_path.exists():
+            logger.info(f"Removing intermediate LAS {converted_las_path.name}")
+            converted_las_path.unlink()
+
+        if mosaic_tiles:
+            mosaic_dtm_paths.append(dtm_unclipped_path)
+            processed_files_count += 1
+            logger.info(f"Finished DTM for {raw_file_path.name}; clipping and hillshade run on the AOI mosaic.")
+            continue
         
         # --- Clipping DTM ---
-        dtm_clipped_path = processed_lidar_dir / f"{base_name}_dtm_clipped_aoi.tif"
+        dtm_clipped_path = processed_lidar_dir_abs / f"{base_name}_dtm_clipped_aoi.tif"
         # Use target_projected_crs for clipping as DTM is in this CRS
-        if not clip_raster(dtm_unclipped_path, dtm_clipped_path, aoi_geom_list_wgs84, target_projected_crs):
+        if build_cache.is_current(dtm_clipped_path, [dtm_unclipped_path], clip_params, raster_code_version):
+            logger.info(f"Clipped DTM {dtm_clipped_path.name} is up to date. Using it.")
+            dtm_for_hillshade = dtm_clipped_path
+        elif not clip_raster(dtm_unclipped_path, dtm_clipped_path, aoi_geom_list_wgs84, target_projected_crs, cog_options):
             logger.error(f"Failed to clip DTM for {raw_file_path.name}. Hillshade will use unclipped DTM.")
             # Use unclipped DTM for hillshade if clipping fails
             dtm_for_hillshade = dtm_unclipped_path 
         else:
+            build_cache.record(dtm_clipped_path, [dtm_unclipped_path], clip_params, raster_code_version)
             dtm_for_hillshade = dtm_clipped_path
 
 
         # --- Hillshade Generation (from potentially clipped DTM) ---
-        hillshade_unclipped_path = processed_lidar_dir / f"{base_name}_hillshade_unclipped.tif" # if dtm_for_hillshade is unclipped
-        hillshade_clipped_path = processed_lidar_dir / f"{base_name}_hillshade_clipped_aoi.tif" # if dtm_for_hillshade is clipped
+        hillshade_unclipped_path = processed_lidar_dir_abs / f"{base_name}_hillshade_unclipped.tif" # if dtm_for_hillshade is unclipped
+        hillshade_clipped_path = processed_lidar_dir_abs / f"{base_name}_hillshade_clipped_aoi.tif" # if dtm_for_hillshade is clipped
         
         target_hillshade_path = hillshade_clipped_path if dtm_for_hillshade == dtm_clipped_path else hillshade_unclipped_path
 
-        if not generate_hillshade(dtm_for_hillshade, target_hillshade_path, hs_azimuth, hs_altitude, hs_z_factor, hs_multi):
-             logger.warning(f"Failed to generate hillshade for {dtm_for_hillshade.name}")
+        # --- Hillshade and Terrain Derivatives (same DTM) ---
+        run_hillshade_and_derivatives(dtm_for_hillshade, target_hillshade_path)
         
         processed_files_count +=1
         logger.info(f"Finished processing stages for: {raw_file_path.name}")
 
+    # --- AOI Mosaic: clip once, then hillshade and derivatives on the seamless DTM ---
+    if args.tiles_only and mosaic_tiles:
+        logger.info("--tiles-only: skipping the AOI mosaic stage.")
+    elif mosaic_tiles and mosaic_dtm_paths:
+        mosaic_dtm_paths = sorted(mosaic_dtm_paths)
+        mosaic_dtm_path = processed_lidar_dir_abs / f"{mosaic_name}_dtm_mosaic_clipped_aoi.tif"
+        if build_cache.is_current(mosaic_dtm_path, mosaic_dtm_paths, clip_params, raster_code_version):
+            logger.info(f"AOI DTM mosaic {mosaic_dtm_path.name} is up to date. Using it.")
+        elif build_aoi_mosaic(mosaic_dtm_paths, processed_lidar_dir_abs, mosaic_name,
+                              aoi_geom_list_wgs84, mosaic_block_size, cog_options) is not None:
+            build_cache.record(mosaic_dtm_path, mosaic_dtm_paths, clip_params, raster_code_version)
+        else:
+            mosaic_dtm_path = None
+        if mosaic_dtm_path is None:
+            logger.error("Failed to build the AOI DTM mosaic. Skipping mosaic hillshade and derivatives.")
+        else:
+            run_hillshade_and_derivatives(mosaic_dtm_path, processed_lidar_dir_abs / f"{mosaic_name}_hillshade_mosaic_clipped_aoi.tif")
+
     if processed_files_count == 0:
         logger.info("No new LiDAR files were processed in this run (either no raw files or all outputs exist).")
     else:
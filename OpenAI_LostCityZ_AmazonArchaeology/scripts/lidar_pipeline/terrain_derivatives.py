@@ -0,0 +1,203 @@
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from hillshade import compute_horn_gradients
+
+# Terrain derivatives used for earthwork detection, computed from one read of each DTM tile:
+#   slope, curvature       - share the 3x3 neighbourhood (and Horn gradients with hillshade.py)
+#   tpi_r<N>m, lrm         - share one summed-area table per tile (box means at any radius are O(1))
+#   svf, openness_pos/neg  - share one horizon-angle scan per direction
+# Tiles are processed on a process pool; each tile is read with a halo wide enough for the
+# largest neighbourhood so the mosaicked outputs have no tile seams.
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_NODATA = -9999.0
+
+
+def derivative_names(tpi_radii_px):
+    """Returns the output names produced for the given TPI radii (in pixels)."""
+    return ['slope', 'curvature', 'lrm', 'svf', 'openness_pos', 'openness_neg'] + \
+        [f"tpi_r{r}px" for r in tpi_radii_px]
+
+def derivative_output_paths(dtm_path, output_dir, tpi_radii_m=(3, 10, 30)):
+    """Returns the derivative name -> output path mapping that compute_terrain_derivatives writes for dtm_path."""
+    with rasterio.open(dtm_path) as src:
+        resolution = abs(src.transform.a)
+    tpi_radii_px = sorted({max(1, int(round(r / resolution))) for r in tpi_radii_m})
+    return {name: Path(output_dir) / f"{Path(dtm_path).stem}_{name}.tif" for name in derivative_names(tpi_radii_px)}
+
+def read_window_with_halo(src, window, halo):
+    """Reads band 1 for `window` grown by `halo` pixels as float64, NaN outside the raster and at nodata."""
+    col_start = window.col_off - halo
+    row_start = window.row_off - halo
+    col_stop = window.col_off + window.width + halo
+    row_stop = window.row_off + window.height + halo
+    read_window = Window(max(0, col_start), max(0, row_start),
+                         min(src.width, col_stop) - max(0, col_start),
+                         min(src.height, row_stop) - max(0, row_start))
+    data = src.read(1, window=read_window).astype(np.float64)
+    if src.nodata is not None:
+        data[data == src.nodata] = np.nan
+    pad = ((max(0, -row_start), max(0, row_stop - src.height)),
+           (max(0, -col_start), max(0, col_stop - src.width)))
+    return np.pad(data, pad, mode='constant', constant_values=np.nan)
+
+def summed_area_tables(dem):
+    """Returns zero-padded summed-area tables of valid values and of valid-cell counts."""
+    valid = ~np.isnan(dem)
+    values = np.where(valid, dem, 0.0)
+    sums = np.zeros((dem.shape[0] + 1, dem.shape[1] + 1))
+    counts = np.zeros_like(sums)
+    sums[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    counts[1:, 1:] = valid.cumsum(axis=0).cumsum(axis=1)
+    return sums, counts
+
+def box_mean(sums, counts, radius, halo, height, width):
+    """Mean of valid cells in a (2*radius+1)^2 window around each interior cell of a halo'd tile."""
+    top = halo - radius
+    bottom = halo + radius + 1
+    def window_total(table):
+        return (table[bottom:bottom + height, bottom:bottom + width] - table[top:top + height, bottom:bottom + width]
+                - table[bottom:bottom + height, top:top + width] + table[top:top + height, top:top + width])
+    total_counts = window_total(counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total_counts > 0, window_total(sums) / total_counts, np.nan)
+
+def horizon_means(dem, halo, resolution, radius_px, num_directions):
+    """
+    Scans num_directions directions out to radius_px pixels and returns, for each interior cell,
+    the sky-view factor and the positive and negative openness (radians), i.e. the means over the
+    directions of 1 - sin(max(horizon angle, 0)), pi/2 - horizon angle and pi/2 + nadir angle.
+    Only running sums are kept, so memory is a few tile-sized arrays whatever num_directions is.
+    """
+    height = dem.shape[0] - 2 * halo
+    width = dem.shape[1] - 2 * halo
+    center = dem[halo:halo + height, halo:halo + width]
+    sky_sum = np.zeros((height, width))
+    positive_sum = np.zeros((height, width))
+    negative_sum = np.zeros((height, width))
+    for k in range(num_directions):
+        theta = 2 * math.pi * k / num_directions
+        highest = np.full((height, width), -np.inf)
+        lowest = np.full((height, width), np.inf)
+        seen_offsets = set()
+        for step in range(1, radius_px + 1):
+            dx = int(round(step * math.sin(theta)))
+            dy = int(round(-step * math.cos(theta))) # Row index grows southwards
+            if (dx, dy) in seen_offsets or (dx, dy) == (0, 0):
+                continue
+            seen_offsets.add((dx, dy))
+            shifted = dem[halo + dy:halo + dy + height, halo + dx:halo + dx + width]
+            with np.errstate(invalid='ignore'):
+                angle = np.arctan((shifted - center) / (math.hypot(dx, dy) * resolution))
+            np.fmax(highest, angle, out=highest)
+            np.fmin(lowest, angle, out=lowest)
+        highest[np.isinf(highest)] = 0.0
+        lowest[np.isinf(lowest)] = 0.0
+        sky_sum += np.sin(np.clip(highest, 0.0, None))
+        positive_sum += math.pi / 2 - highest
+        negative_sum += math.pi / 2 + lowest
+    return 1.0 - sky_sum / num_directions, positive_sum / num_directions, negative_sum / num_directions
+
+def compute_tile_derivatives(dem, halo, resolution, tpi_radii_px, lrm_radius_px, svf_radius_px, svf_directions):
+    """
+    Computes every derivative for the interior of a halo'd DTM tile.
+    Returns a dict of float32 arrays keyed by derivative name (NaN where undefined).
+    """
+    height = dem.shape[0] - 2 * halo
+    width = dem.shape[1] - 2 * halo
+    center = dem[halo:halo + height, halo:halo + width]
+    outputs = {}
+
+    # 3x3 neighbourhood: slope (Horn) and general curvature (Zevenbergen & Thorne)
+    core = dem[halo - 1:halo + height + 1, halo - 1:halo + width + 1]
+    x, y, _ = compute_horn_gradients(core, resolution, -resolution)
+    with np.errstate(invalid='ignore'):
+        outputs['slope'] = np.degrees(np.arctan(np.hypot(x, y) / 8.0))
+        d2x = (core[1:-1, :-2] + core[1:-1, 2:]) / 2.0 - center
+        d2y = (core[:-2, 1:-1] + core[2:, 1:-1]) / 2.0 - center
+        outputs['curvature'] = -2.0 * (d2x + d2y) / (resolution * resolution) * 100.0
+
+    # Box means from one summed-area table: multi-scale TPI and the local relief model
+    offset = np.nanmean(center) if np.any(~np.isnan(center)) else 0.0 # Keeps the cumulative sums well conditioned
+    sums, counts = summed_area_tables(dem - offset)
+    for radius in tpi_radii_px:
+        outputs[f"tpi_r{radius}px"] = (center - offset) - box_mean(sums, counts, radius, halo, height, width)
+    outputs['lrm'] = (center - offset) - box_mean(sums, counts, lrm_radius_px, halo, height, width)
+
+    # One horizon scan: sky-view factor and positive/negative openness
+    svf, openness_pos, openness_neg = horizon_means(dem, halo, resolution, svf_radius_px, svf_directions)
+    outputs['svf'] = svf
+    outputs['openness_pos'] = np.degrees(openness_pos)
+    outputs['openness_neg'] = np.degrees(openness_neg)
+
+    nodata_mask = np.isnan(center)
+    for name in outputs:
+        outputs[name] = outputs[name].astype(np.float32)
+        outputs[name][nodata_mask | np.isnan(outputs[name])] = np.nan
+    return outputs
+
+def process_tile(dtm_path, window, halo, resolution, tpi_radii_px, lrm_radius_px, svf_radius_px, svf_directions):
+    """Pool worker: reads one tile with its halo and returns (window, derivative arrays)."""
+    with rasterio.open(dtm_path) as src:
+        dem = read_window_with_halo(src, window, halo)
+    return window, compute_tile_derivatives(dem, halo, resolution, tpi_radii_px, lrm_radius_px,
+                                            svf_radius_px, svf_directions)
+
+def compute_terrain_derivatives(dtm_path, output_dir, tpi_radii_m=(3, 10, 30), lrm_radius_m=20, svf_radius_m=10,
+                                svf_directions=16, tile_size=1024, max_workers=0):
+    """
+    Computes slope, curvature, multi-scale TPI, LRM, sky-view factor and openness for dtm_path and
+    writes one float32 GeoTIFF per derivative to output_dir as '<dtm stem>_<name>.tif'.
+    Radii are given in map units (metres) and converted to pixels with the DTM resolution.
+    Returns a dict of derivative name -> output path.
+    """
+    dtm_path = Path(dtm_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+
+    with rasterio.open(dtm_path) as src:
+        resolution = abs(src.transform.a)
+        width, height = src.width, src.height
+        profile = src.profile.copy()
+
+    tpi_radii_px = sorted({max(1, int(round(r / resolution))) for r in tpi_radii_m})
+    lrm_radius_px = max(1, int(round(lrm_radius_m / resolution)))
+    svf_radius_px = max(1, int(round(svf_radius_m / resolution)))
+    halo = max(tpi_radii_px + [lrm_radius_px, svf_radius_px, 1])
+    names = derivative_names(tpi_radii_px)
+
+    block = 256 if tile_size >= 256 else 16
+    tile_size = max(block, tile_size // block * block) # Tiles line up with the output's internal blocks
+    profile.update(driver='GTiff', dtype='float32', count=1, nodata=DERIVATIVE_NODATA, compress='deflate',
+                   predictor=3, tiled=True, blockxsize=block, blockysize=block, BIGTIFF='IF_SAFER')
+    output_paths = derivative_output_paths(dtm_path, output_dir, tpi_radii_m)
+    windows = [Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+               for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+    logger.info(f"Computing {len(names)} terrain derivatives for {dtm_path.name}: {len(windows)} tiles of "
+                f"{tile_size}px with {halo}px halo on {max_workers} workers.")
+
+    with ExitStack() as stack:
+        destinations = {name: stack.enter_context(rasterio.open(path, 'w', **profile))
+                        for name, path in output_paths.items()}
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+        futures = [executor.submit(process_tile, str(dtm_path), window, halo, resolution, tpi_radii_px,
+                                   lrm_radius_px, svf_radius_px, svf_directions) for window in windows]
+        for future in as_completed(futures):
+            window, tile_outputs = future.result()
+            for name, data in tile_outputs.items():
+                destinations[name].write(np.nan_to_num(data, nan=DERIVATIVE_NODATA), 1, window=window)
+
+    logger.info(f"Wrote terrain derivatives: {', '.join(p.name for p in output_paths.values())}")
+    return output_paths
@@ -0,0 +1,201 @@
+import argparse
+import configparser
+import logging
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Single entry point for the acquisition and preprocessing scripts of all three pipelines.
+# The six scripts are modelled as a dependency graph (acquire_X -> preprocess_X). Independent
+# pipelines run at the same time, so text OCR, LiDAR PDAL and Sen2Cor overlap. While an acquisition
+# stage is still downloading, its preprocessing stage is re-run whenever new complete units (LiDAR
+# tiles, .SAFE products, text sources) appear. The incremental build cache (utils/build_cache.py)
+# makes each re-run process only the new units. A final preprocessing pass runs once the
+# download finishes.
+# Usage: python run_pipelines.py [--pipelines lidar satellite text] [--no-follow] [--keep-going] [--dry-run]
+
+CONFIG_FILE_PATH = "../config/config.ini" # Relative to the scripts/ directory
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = SCRIPTS_DIR.parent
+
+
+def setup_logging(log_dir_path, log_file_name):
+    Path(log_dir_path).mkdir(parents=True, exist_ok=True)
+    log_path = Path(log_dir_path) / log_file_name
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    logging.basicConfig(filename=log_path, level=logging.INFO, format=LOG_FORMAT, filemode='a')
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(console_handler)
+
+def load_config(config_rel_path=CONFIG_FILE_PATH):
+    """Loads configuration from the INI file."""
+    resolved_config_path = (SCRIPTS_DIR / config_rel_path).resolve()
+    config = configparser.ConfigParser(interpolation=None)
+    if not resolved_config_path.exists():
+        raise FileNotFoundError(f"Configuration file not found at '{resolved_config_path}'")
+    config.read(resolved_config_path)
+    return config
+
+# --- Unit discovery (mirrors how each preprocessing script resolves its raw directory) ---
+
+def lidar_raw_units(app_config):
+    """Complete LiDAR tiles (downloads are renamed from .part only once verified)."""
+    default_config = app_config['DEFAULT']
+    lidar_config = app_config['LIDAR'] if app_config.has_section('LIDAR') else default_config
+    raw_dir = PROJECT_ROOT / default_config.get('base_raw_data_dir', 'data') / lidar_config.get('lidar_raw_suffix', 'lidar/raw')
+    if not raw_dir.exists():
+        return set()
+    return {p.name for p in raw_dir.iterdir() if p.suffix.lower() in ('.las', '.laz')}
+
+def sentinel2_raw_units(app_config):
+    """Extracted .SAFE product directories."""
+    default_config = app_config['DEFAULT']
+    raw_dir = PROJECT_ROOT / default_config.get('base_raw_data_dir', 'data') / default_config.get('s2_raw_suffix', 'sentinel2/raw')
+    if not raw_dir.exists():
+        return set()
+    return {p.name for p in raw_dir.iterdir() if p.is_dir() and p.name.endswith('.SAFE')}
+
+def text_raw_units(app_config):
+    """Raw text sources (.txt/.pdf) written by acquire_texts.py."""
+    default_config = app_config['DEFAULT']
+    text_config = app_config['TextualData'] if app_config.has_section('TextualData') else default_config
+    raw_dir = (SCRIPTS_DIR / 'text_pipeline' / default_config.get('base_raw_data_dir', '../../data')
+               / text_config.get('text_raw_suffix', 'textual/raw')).resolve()
+    if not raw_dir.exists():
+        return set()
+    return {p.name for p in raw_dir.iterdir() if p.is_file() and p.suffix.lower() in ('.txt', '.pdf')}
+
+# Stage graph: script (relative to scripts/), upstream stages, and for preprocessing stages the
+# unit discovery function and extra arguments used for the intermediate (follow) runs.
+STAGES = {
+    'acquire_lidar': {'pipeline': 'lidar', 'script': 'lidar_pipeline/acquire_lidar.py', 'after': []},
+    'preprocess_lidar': {'pipeline': 'lidar', 'script': 'lidar_pipeline/preprocess_lidar.py', 'after': ['acquire_lidar'],
+                         'units': lidar_raw_units, 'follow_args': ['--tiles-only']},
+    'acquire_sentinel2': {'pipeline': 'satellite', 'script': 'satellite_pipeline/acquire_sentinel2.py', 'after': []},
+    'preprocess_sentinel2': {'pipeline': 'satellite', 'script': 'satellite_pipeline/preprocess_sentinel2.py',
+                             'after': ['acquire_sentinel2'], 'units': sentinel2_raw_units, 'follow_args': ['--no-composite']},
+    'acquire_texts': {'pipeline': 'text', 'script': 'text_pipeline/acquire_texts.py', 'after': []},
+    'preprocess_texts': {'pipeline': 'text', 'script': 'text_pipeline/preprocess_texts.py', 'after': ['acquire_texts'],
+                         'units': text_raw_units, 'follow_args': []},
+}
+
+
+def run_script(stage_name, script_rel_path, extra_args=()):
+    """Runs one pipeline script in its own directory (where its relative config paths resolve). Returns True on exit code 0."""
+    script_path = SCRIPTS_DIR / script_rel_path
+    command = [sys.executable, str(script_path), *extra_args]
+    logger.info(f"[{stage_name}] Starting: {' '.join(command[1:])}")
+    start = time.perf_counter()
+    try:
+        returncode = subprocess.run(command, cwd=script_path.parent).returncode
+    except OSError as e:
+        logger.error(f"[{stage_name}] Could not start {script_path.name}: {e}")
+        return False
+    elapsed = time.perf_counter() - start
+    if returncode != 0:
+        logger.error(f"[{stage_name}] Failed with exit code {returncode} after {elapsed:.1f}s.")
+        return False
+    logger.info(f"[{stage_name}] Finished in {elapsed:.1f}s.")
+    return True
+
+class StageRunner:
+    """Runs the stage graph on threads; each stage waits for its upstream stages' completion events."""
+
+    def __init__(self, stages, app_config, follow=True, poll_seconds=30, keep_going=False):
+        self.stages = stages
+        self.app_config = app_config
+        self.follow = follow
+        self.poll_seconds = poll_seconds
+        self.keep_going = keep_going
+        self.done = {name: threading.Event() for name in stages}
+        self.status = {}
+
+    def follow_upstream(self, name, stage, upstream_name):
+        """Re-runs a preprocessing stage whenever new units appear while its upstream stage is still running."""
+        seen_units = set()
+        while not self.done[upstream_name].wait(self.poll_seconds):
+            units = stage['units'](self.app_config)
+            new_units = units - seen_units
+            if not new_units:
+                continue
+            logger.info(f"[{name}] {len(new_units)} new unit(s) from {upstream_name}: {', '.join(sorted(new_units)[:5])}"
+                        f"{' ...' if len(new_units) > 5 else ''}")
+            if run_script(name, stage['script'], stage['follow_args']):
+                seen_units |= units
+
+    def run_stage(self, name):
+        stage = self.stages[name]
+        try:
+            upstream = [u for u in stage['after'] if u in self.stages]
+            if self.follow and 'units' in stage and len(upstream) == 1:
+                self.follow_upstream(name, stage, upstream[0])
+            for upstream_name in upstream:
+                self.done[upstream_name].wait()
+            failed_upstream = [u for u in upstream if self.status.get(u) != 'ok']
+            if failed_upstream and not self.keep_going:
+                logger.warning(f"[{name}] Skipped: upstream stage(s) {', '.join(failed_upstream)} did not succeed (use --keep-going to run anyway).")
+                self.status[name] = 'skipped'
+                return
+            self.status[name] = 'ok' if run_script(name, stage['script']) else 'failed'
+        except Exception as e:
+            logger.error(f"[{name}] Orchestration error: {e}", exc_info=True)
+            self.status[name] = 'failed'
+        finally:
+            self.done[name].set()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=len(self.stages)) as executor:
+            for name in self.stages:
+                executor.submit(self.run_stage, name)
+        return self.status
+
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the LiDAR, Sentinel-2 and text pipelines as one dependency graph.")
+    parser.add_argument('--pipelines', nargs='+', choices=['lidar', 'satellite', 'text'],
+                        help="Pipelines to run (default: 'pipelines' in [ORCHESTRATOR])")
+    parser.add_argument('--no-follow', action='store_true',
+                        help="Preprocess only after each acquisition stage has finished")
+    parser.add_argument('--keep-going', action='store_true',
+                        help="Run preprocessing even if its acquisition stage failed (e.g. data placed manually)")
+    parser.add_argument('--dry-run', action='store_true', help="Print the stage graph and exit")
+    args = parser.parse_args()
+
+    try:
+        app_config = load_config()
+    except FileNotFoundError as e:
+        print(f"FATAL: Configuration file not found. Error: {e}")
+        exit(1)
+
+    default_config = app_config['DEFAULT']
+    orchestrator_config = app_config['ORCHESTRATOR'] if app_config.has_section('ORCHESTRATOR') else default_config
+    log_dir_abs = PROJECT_ROOT / default_config.get('log_dir', 'logs')
+    setup_logging(log_dir_abs, orchestrator_config.get('orchestrator_log_file_name', 'run_pipelines.log'))
+
+    pipelines = args.pipelines or [p.strip() for p in orchestrator_config.get('pipelines', 'lidar, satellite, text').split(',') if p.strip()]
+    follow = orchestrator_config.getboolean('follow_downloads', True) and not args.no_follow
+    poll_seconds = orchestrator_config.getint('follow_poll_seconds', 30)
+    stages = {name: stage for name, stage in STAGES.items() if stage['pipeline'] in pipelines}
+
+    if args.dry_run:
+        for name, stage in stages.items():
+            print(f"{name:22s} <- {', '.join(stage['after']) or '(start)'}{'  [follows downloads]' if follow and 'units' in stage else ''}")
+        exit(0)
+
+    logger.info(f"--- Starting pipelines: {', '.join(pipelines)} ({len(stages)} stages, follow downloads: {follow}) ---")
+    run_start = time.perf_counter()
+    status = StageRunner(stages, app_config, follow, poll_seconds, args.keep_going or orchestrator_config.getboolean('keep_going', False)).run()
+    for name in stages:
+        logger.info(f"  {name:22s} {status.get(name, 'not run')}")
+    logger.info(f"--- Pipelines finished in {time.perf_counter() - run_start:.1f}s ---")
+    exit(0 if all(s == 'ok' for s in status.values()) else 1)
@@ -1,15 +1,24 @@
 import configparser
 import logging
+import multiprocessing
 import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt, SentinelsatAPIError
+from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt, SentinelAPIError, InvalidChecksumError
+from sentinelsat.exceptions import LTAError, LTATriggered, ServerError
+
+from product_selection import format_bytes, select_products_for_coverage
 
 # --- Configuration and Logging Setup ---
 # Assuming this script is in OpenAI_LostCityZ_AmazonArchaeology/scripts/satellite_pipeline/
 # And config.ini is in OpenAI_LostCityZ_AmazonArchaeology/config/
-CONFIG_FILE_PATH = "../config/config.ini"
+CONFIG_FILE_PATH = "../../config/config.ini" # Relative to the script directory
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logger = logging.getLogger(__name__) # Define logger at module level
 
@@ -112,10 +121,202 @@ def get_aoi_footprint(app_config, project_root_path):
     else:
         raise ValueError("AOI not defined. Provide 'aoi_geojson_path' or 'aoi_bbox' in config.")
 
-def download_sentinel2_data(api, footprint, start_date_str, end_date_str, product_type, cloud_cover, download_dir):
+def extract_product_archive(zip_path, download_dir):
+    """
+    Extracts a downloaded product archive to <download_dir>/<title>.SAFE and removes the zip.
+    Extraction goes to a temporary directory first, so a .SAFE only appears once it is complete.
+    Returns the .SAFE path.
+    """
+    zip_path = Path(zip_path)
+    tmp_dir = Path(download_dir) / f".{zip_path.stem}.extracting"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    with zipfile.ZipFile(zip_path) as archive:
+        archive.extractall(tmp_dir)
+    extracted_safe = next(tmp_dir.glob('*.SAFE'), None)
+    if extracted_safe is None:
+        shutil.rmtree(tmp_dir)
+        raise ValueError(f"No .SAFE directory found in {zip_path.name}")
+    safe_path = Path(download_dir) / extracted_safe.name
+    os.replace(extracted_safe, safe_path)
+    shutil.rmtree(tmp_dir)
+    zip_path.unlink()
+    return safe_path
+
+def processed_output_check(app_config, project_root, processed_dir):
+    """
+    Returns a function mapping a product title to its processed GeoTIFF in processed_dir if that
+    exists for the current output_bands/target_resolution and was built with the current settings
+    and code (see preprocess_sentinel2.find_current_processed_output), else None.
+    """
+    # Imported here so plain acquisition only needs the raster processing stack when outputs exist
+    from preprocess_sentinel2 import find_current_processed_output, get_aoi_geometry
+
+    default_config = app_config['DEFAULT']
+    preprocessing_config = app_config['PREPROCESSING'] if app_config.has_section('PREPROCESSING') else default_config
+    aoi_geometry_wgs84 = get_aoi_geometry(app_config, project_root)
+    return lambda title: find_current_processed_output(title, processed_dir, aoi_geometry_wgs84,
+                                                       default_config, preprocessing_config)
+
+def download_settings_from_config(default_config):
+    """Reads the Sentinel-2 download settings from the [DEFAULT] section."""
+    return {
+        'max_workers': max(1, default_config.getint('s2_download_workers', 2)),
+        'max_retries': default_config.getint('s2_download_max_retries', 3),
+        'retry_backoff_seconds': default_config.getfloat('s2_download_retry_backoff_seconds', 30),
+        'lta_poll_seconds': default_config.getfloat('s2_lta_poll_minutes', 10) * 60,
+        'lta_max_wait_seconds': default_config.getfloat('s2_lta_max_wait_hours', 0) * 3600,
+        'coverage_target': default_config.getfloat('s2_coverage_target', 0),
+    }
+
+def local_product_state(title, download_dir):
+    """
+    Classifies what is on disk for a product title, following sentinelsat's storage layout:
+    'extracted' (<title>.SAFE), 'archive' (a complete <title>.zip; sentinelsat only renames the
+    download once its checksum is verified), 'partial' (<title>.zip.incomplete, which sentinelsat
+    resumes) or 'missing'.
+    """
+    download_dir = Path(download_dir)
+    if (download_dir / f"{title}.SAFE").is_dir():
+        return 'extracted'
+    if (download_dir / f"{title}.zip").is_file():
+        return 'archive'
+    if (download_dir / f"{title}.zip.incomplete").is_file():
+        return 'partial'
+    return 'missing'
+
+def download_product(api, product_id, title, download_dir, max_retries=3, retry_backoff_seconds=30):
+    """
+    Downloads one product (sentinelsat verifies its MD5 checksum and resumes a partial download)
+    and extracts it. Checksum mismatches and server errors are retried with exponential backoff.
+    Returns (.SAFE path or None, status) with status 'ok', 'lta' (offline product, retrieval
+    triggered) or 'failed'.
+    """
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            delay = retry_backoff_seconds * 2 ** (attempt - 1)
+            logging.info(f"Retrying {title} in {delay:.0f}s (attempt {attempt + 1}/{max_retries + 1}).")
+            time.sleep(delay)
+        try:
+            product_info = api.download(product_id, directory_path=download_dir, checksum=True)
+            safe_path = extract_product_archive(product_info['path'], download_dir)
+            logging.info(f"Successfully downloaded and verified: {title}")
+            return safe_path, 'ok'
+        except LTATriggered:
+            logging.info(f"Product {title} is in the Long Term Archive; retrieval has been triggered.")
+            return None, 'lta'
+        except InvalidChecksumError as e:
+            # sentinelsat has already deleted the corrupt file, so the retry starts from scratch
+            logging.warning(f"MD5 checksum mismatch for {title}: {e}")
+        except ServerError as e:
+            logging.warning(f"Server error downloading {title} (ID: {product_id}): {e}")
+        except SentinelAPIError as e:
+            logging.error(f"API Error downloading {title} (ID: {product_id}): {e}")
+            if "Product_is_not_online" in str(e) or "offline" in str(e).lower():
+                logging.warning(f"Product {title} is offline. It might become available later.")
+                return None, 'lta'
+            return None, 'failed'
+        except (zipfile.BadZipFile, ValueError) as e:
+            logging.error(f"Could not extract the archive of {title}: {e}")
+            zip_path = Path(download_dir) / f"{title}.zip"
+            if zip_path.exists():
+                zip_path.unlink() # Download it again on the next attempt
+        except Exception as e:
+            logging.error(f"An unexpected error occurred downloading {title} (ID: {product_id}): {e}")
+            return None, 'failed'
+    logging.error(f"Giving up on {title} after {max_retries + 1} attempts.")
+    return None, 'failed'
+
+def trigger_lta_retrievals(api, products):
+    """
+    Splits (product_id, title) pairs into online and offline products and triggers Long Term
+    Archive retrieval for all offline ones up front, so their restoration overlaps the online
+    downloads. Returns (online products, offline products).
+    """
+    online, offline = [], []
+    for product_id, title in products:
+        try:
+            is_online = api.is_online(product_id)
+        except SentinelAPIError as e:
+            logging.warning(f"Could not check the availability of {title}: {e}. Trying to download it.")
+            is_online = True
+        (online if is_online else offline).append((product_id, title))
+
+    for product_id, title in offline:
+        try:
+            api.trigger_offline_retrieval(product_id)
+        except LTAError as e:
+            logging.warning(f"LTA retrieval of {title} was not accepted (e.g. user quota): {e}. Will retry while polling.")
+        except SentinelAPIError as e:
+            logging.error(f"Could not trigger LTA retrieval of {title}: {e}")
+    if offline:
+        logging.info(f"{len(online)} products online, {len(offline)} in the Long Term Archive (retrieval triggered).")
+    return online, offline
+
+def download_products_concurrently(api, products, download_dir, settings, on_product_ready=None):
+    """
+    Downloads (product_id, title) pairs on settings['max_workers'] threads.
+    on_product_ready is called (from the main thread) as each product becomes available.
+    Returns (number downloaded, products that turned out to be offline, failed titles).
+    """
+    downloaded, offline, failed = 0, [], []
+    with ThreadPoolExecutor(max_workers=settings['max_workers']) as executor:
+        futures = {
+            executor.submit(download_product, api, product_id, title, download_dir,
+                            settings['max_retries'], settings['retry_backoff_seconds']): (product_id, title)
+            for product_id, title in products
+        }
+        for future in as_completed(futures):
+            product_id, title = futures[future]
+            safe_path, status = future.result()
+            if status == 'ok':
+                downloaded += 1
+                if on_product_ready is not None:
+                    on_product_ready(safe_path)
+            elif status == 'lta':
+                offline.append((product_id, title))
+            else:
+                failed.append(title)
+    return downloaded, offline, failed
+
+def wait_for_lta_products(api, products, download_dir, settings, on_product_ready=None):
     """
-    Queries and downloads Sentinel-2 products.
+    Polls offline products every lta_poll_seconds (re-triggering their retrieval) and downloads
+    them as they come online, for at most lta_max_wait_seconds.
+    Returns (number downloaded, titles still offline or failed).
     """
+    pending = list(products)
+    deadline = time.monotonic() + settings['lta_max_wait_seconds']
+    downloaded, failed = 0, []
+    while pending and time.monotonic() < deadline:
+        logging.info(f"Waiting {settings['lta_poll_seconds']:.0f}s for {len(pending)} Long Term Archive products.")
+        time.sleep(settings['lta_poll_seconds'])
+        online, pending = trigger_lta_retrievals(api, pending)
+        if online:
+            count, offline_again, failed_now = download_products_concurrently(api, online, download_dir, settings,
+                                                                              on_product_ready)
+            downloaded += count
+            pending += offline_again
+            failed += failed_now
+    if pending:
+        logging.warning(f"{len(pending)} Long Term Archive products did not come online in time: "
+                        f"{', '.join(title for _, title in pending)}")
+    return downloaded, [title for _, title in pending] + failed
+
+def download_sentinel2_data(api, footprint, start_date_str, end_date_str, product_type, cloud_cover, download_dir,
+                            on_product_ready=None, processed_check=None, download_settings=None):
+    """
+    Queries and downloads Sentinel-2 products, several at a time (see download_settings_from_config).
+    Long Term Archive products are triggered for retrieval up front and downloaded once online.
+    With a coverage_target > 0 only the products picked by select_products_for_coverage are downloaded.
+    on_product_ready, if given, is called with each .SAFE path as soon as that product is downloaded,
+    verified and extracted (or found already on disk), so processing can overlap the remaining downloads.
+    processed_check, if given, maps a product title to its up-to-date processed output (see
+    processed_output_check); products that have one are not downloaded again.
+    """
+    find_processed_output = processed_check or (lambda title: None)
+    settings = download_settings or {'max_workers': 1, 'max_retries': 3, 'retry_backoff_seconds': 30,
+                                     'lta_poll_seconds': 600, 'lta_max_wait_seconds': 0, 'coverage_target': 0}
     Path(download_dir).mkdir(parents=True, exist_ok=True)
     logging.info(f"Searching for {product_type} products...")
     logging.info(f"AOI WKT: {footprint[:100]}...") # Log a snippet of WKT
@@ -130,7 +331,7 @@ def download_sentinel2_data(api, footprint, start_date_str, end_date_str, produc
             producttype=product_type, # e.g., S2MSI2A (Level-2A) or S2MSI1C (Level-1C)
             cloudcoverpercentage=(0, cloud_cover)
         )
-    except SentinelsatAPIError as e:
+    except SentinelAPIError as e:
         logging.error(f"API Error during product query: {e}")
         if "Too Many Requests" in str(e) or "429" in str(e):
             logging.error("Consider adding a delay or checking API limits if this persists.")
@@ -149,40 +350,128 @@ def download_sentinel2_data(api, footprint, start_date_str, end_date_str, produc
     # Sort products by ingestion date or cloud cover to prioritize downloads if needed
     products_gdf = products_gdf.sort_values(['ingestiondate'], ascending=[False]) # Download newest first
 
+    if settings.get('coverage_target', 0) > 0:
+        # Products already on disk or processed cost no download, so the planner uses them first
+        free_ids = {product_id for product_id, title in products_gdf['title'].items()
+                    if local_product_state(title, download_dir) in ('extracted', 'archive')
+                    or find_processed_output(title) is not None}
+        selected_ids, summary = select_products_for_coverage(products_gdf, footprint, settings['coverage_target'], free_ids)
+        products_gdf = products_gdf[products_gdf.index.isin(selected_ids)]
+        logging.info(f"Selected {len(selected_ids)} products for an expected {summary['expected_coverage']:.1%} clear-sky AOI "
+                     f"coverage (target {settings['coverage_target']:.0%}): {format_bytes(summary['selected_bytes'])} to download, "
+                     f"{format_bytes(summary['saved_bytes'])} of {format_bytes(summary['total_bytes'])} saved.")
+
+    to_download = []
     for product_id, product_info in products_gdf.iterrows():
         title = product_info['title']
-        logging.info(f"Attempting to download product: {title} (ID: {product_id})")
+        logging.info(f"Product: {title} (ID: {product_id})")
         logging.info(f"  Cloud Cover: {product_info.get('cloudcoverpercentage', 'N/A')}%")
         logging.info(f"  Ingestion Date: {product_info.get('ingestiondate', 'N/A')}")
-        
-        # Check if already downloaded (simple check by directory name)
-        product_path = Path(download_dir) / title
-        if product_path.exists() and product_path.with_suffix(".SAFE").exists(): # Sentinel products are .SAFE folders
-             # A more robust check would be to verify integrity, e.g. using `api.is_online(product_id)`
-             # and then checking if a specific file (like manifest.safe) exists and is not corrupt.
-             # Sentinelsat also has a `check_files` option in `api.download` but it requires more setup.
+
+        # Check what is already on disk, or whether it was already processed (raw may have been deleted)
+        state = local_product_state(title, download_dir)
+        processed_output = find_processed_output(title)
+        if processed_output is not None and state != 'extracted':
+            logging.info(f"Product {title} was already processed ({processed_output.name}). Skipping download.")
+            continue
+        if state == 'extracted':
             logging.info(f"Product {title} already exists in {download_dir}. Skipping download.")
+            safe_path = Path(download_dir) / f"{title}.SAFE"
+        elif state == 'archive':
+            logging.info(f"Product {title} is downloaded but not extracted. Extracting.")
+            try:
+                safe_path = extract_product_archive(Path(download_dir) / f"{title}.zip", download_dir)
+            except (zipfile.BadZipFile, ValueError) as e:
+                logging.error(f"Could not extract the archive of {title}: {e}. Downloading it again.")
+                (Path(download_dir) / f"{title}.zip").unlink()
+                to_download.append((product_id, title))
+                continue
+        else:
+            if state == 'partial':
+                logging.info(f"Product {title} has a partial download; it will be resumed.")
+            to_download.append((product_id, title))
             continue
 
-        try:
-            api.download(product_id, directory_path=download_dir)
-            logging.info(f"Successfully downloaded: {title}")
-        except SentinelsatAPIError as e:
-            logging.error(f"API Error downloading {title} (ID: {product_id}): {e}")
-            if "Product_is_not_online" in str(e) or "offline" in str(e).lower():
-                logging.warning(f"Product {title} is offline. It might become available later. Skipping.")
-            elif "MD5 checksum" in str(e):
-                logging.error(f"MD5 checksum mismatch for {title}. Download may be corrupt. Consider retrying.")
-                # Optionally, delete the corrupted download here
-                # if product_path.with_suffix(".zip").exists(): # Downloads are often .zip
-                #    product_path.with_suffix(".zip").unlink()
-            else:
-                logging.error(f"An unexpected SentinelsatAPIError occurred: {e}")
-        except Exception as e:
-            logging.error(f"An unexpected error occurred downloading {title} (ID: {product_id}): {e}")
+        if on_product_ready is not None:
+            on_product_ready(safe_path)
+
+    if to_download:
+        online, offline = trigger_lta_retrievals(api, to_download)
+        logging.info(f"Downloading {len(online)} products with up to {settings['max_workers']} concurrent downloads.")
+        downloaded, offline_now, failed = download_products_concurrently(api, online, download_dir, settings,
+                                                                         on_product_ready)
+        offline += offline_now
+        if offline and settings['lta_max_wait_seconds'] > 0:
+            lta_downloaded, lta_failed = wait_for_lta_products(api, offline, download_dir, settings, on_product_ready)
+            downloaded += lta_downloaded
+            failed += lta_failed
+        elif offline:
+            logging.warning(f"{len(offline)} products are being restored from the Long Term Archive; "
+                            "run the acquisition again later to download them.")
+            failed += [title for _, title in offline]
+        logging.info(f"Downloaded {downloaded} of {len(to_download)} products; {len(failed)} not downloaded.")
 
     logging.info("Download process finished.")
 
+def run_pipelined_acquisition(api, footprint, start_date_str, end_date_str, product_type, cloud_cover, download_dir,
+                              app_config, script_dir, project_root, processed_dir, log_dir_abs, log_file_name,
+                              delete_raw_after_processing=False, download_settings=None):
+    """
+    Producer/consumer mode: products are downloaded (producer) and each verified
+    .SAFE is handed to a process pool running preprocess_sentinel2's handle_product (consumers) as
+    soon as it is ready. With delete_raw_after_processing the .SAFE is removed once its processed
+    output has been written, so raw disk use stays at roughly num_workers products.
+    """
+    # Imported here so plain acquisition does not need the raster processing stack
+    from preprocess_sentinel2 import (get_aoi_geometry, init_product_worker, pool_handle_product,
+                                      resolve_sen2cor_path, log_run_summary, build_s2_outputs)
+
+    default_config = app_config['DEFAULT']
+    preprocessing_config = app_config['PREPROCESSING'] if app_config.has_section('PREPROCESSING') else default_config
+    sen2cor_config = app_config['SEN2COR'] if app_config.has_section('SEN2COR') else default_config
+    aoi_geometry_wgs84 = get_aoi_geometry(app_config, project_root)
+    sen2cor_path = resolve_sen2cor_path(sen2cor_config, project_root)
+    product_type_to_process = default_config.get('product_type', 'S2MSI2A').upper()
+    num_workers = preprocessing_config.getint('num_workers', 1)
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    sen2cor_semaphore = multiprocessing.Semaphore(max(1, sen2cor_config.getint('max_concurrent_sen2cor', 1)))
+    Path(processed_dir).mkdir(parents=True, exist_ok=True)
+
+    results = []
+    results_lock = threading.Lock()
+
+    def on_processed(future, safe_path):
+        try:
+            result = future.result()
+        except Exception as e: # e.g. a worker killed by the OOM killer
+            logger.error(f"Worker failed while processing {safe_path.name}: {e}")
+            result = (safe_path.name, 'failed', f"worker error: {e}")
+        with results_lock:
+            results.append(result)
+        logger.info(f"Pipelined processing of {safe_path.name}: {result[1]}")
+        if result[1] == 'processed' and delete_raw_after_processing and safe_path.exists():
+            logger.info(f"Deleting raw product {safe_path.name} after successful processing.")
+            shutil.rmtree(safe_path, ignore_errors=True)
+
+    run_start = time.perf_counter()
+    logger.info(f"Pipelined mode: processing each product as soon as it is downloaded ({num_workers} workers, "
+                f"delete raw after processing: {delete_raw_after_processing}).")
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_product_worker,
+                             initargs=(script_dir, sen2cor_semaphore, log_dir_abs, log_file_name)) as executor:
+        def submit_product(safe_path):
+            future = executor.submit(pool_handle_product, safe_path, aoi_geometry_wgs84, product_type_to_process,
+                                     sen2cor_path, processed_dir)
+            future.add_done_callback(lambda f: on_processed(f, safe_path))
+
+        download_sentinel2_data(api, footprint, start_date_str, end_date_str, product_type, cloud_cover,
+                                download_dir, on_product_ready=submit_product,
+                                processed_check=processed_output_check(app_config, project_root, processed_dir),
+                                download_settings=download_settings)
+        logger.info("All downloads finished; waiting for the remaining products to be processed.")
+    log_run_summary(results, time.perf_counter() - run_start)
+    build_s2_outputs(processed_dir, default_config, preprocessing_config)
+
 # --- Main Execution ---
 if __name__ == "__main__":
     # Determine project root assuming script is in OpenAI_LostCityZ_AmazonArchaeology/scripts/pipeline_type/
@@ -225,7 +514,7 @@ if __name__ == "__main__":
     try:
         api = SentinelAPI(api_user, api_password, api_url)
         logger.info(f"Successfully connected to API: {api_url}")
-    except SentinelsatAPIError as e:
+    except SentinelAPIError as e:
         logger.error(f"Failed to connect to Sentinel API at {api_url}: {e}")
         logger.error("Please check your API credentials, the API URL, and your internet connection.")
         exit(1)
@@ -257,6 +546,28 @@ if __name__ == "__main__":
         logger.error("Invalid date format in config.ini. Please use YYYYMMDD (e.g., 20230101).")
         exit(1)
 
-    download_sentinel2_data(api, footprint_wkt, start_date, end_date, product_type, cloud_cover, raw_data_dir)
+    base_processed_dir_config = default_config.get('base_processed_data_dir', 'data')
+    s2_processed_suffix_config = default_config.get('s2_processed_suffix', 'sentinel2/processed')
+    processed_dir_abs = PROJECT_ROOT / base_processed_dir_config / s2_processed_suffix_config
+
+    download_settings = download_settings_from_config(default_config)
+    if default_config.getboolean('s2_pipelined_processing', False):
+        try:
+            run_pipelined_acquisition(api, footprint_wkt, start_date, end_date, product_type, cloud_cover, raw_data_dir_abs,
+                                      app_config, SCRIPT_DIR, PROJECT_ROOT, processed_dir_abs, log_dir_abs, log_file_name_config,
+                                      default_config.getboolean('s2_delete_raw_after_processing', False), download_settings)
+        except (ValueError, FileNotFoundError) as e:
+            logger.error(f"AOI configuration error: {e}")
+            exit(1)
+    else:
+        processed_check = None
+        if processed_dir_abs.exists():
+            try:
+                processed_check = processed_output_check(app_config, PROJECT_ROOT, processed_dir_abs)
+            except (ValueError, FileNotFoundError) as e:
+                logger.error(f"AOI configuration error: {e}")
+                exit(1)
+        download_sentinel2_data(api, footprint_wkt, start_date, end_date, product_type, cloud_cover, raw_data_dir_abs,
+                                processed_check=processed_check, download_settings=download_settings)
 
     logger.info("--- Sentinel-2 Data Acquisition Finished ---")
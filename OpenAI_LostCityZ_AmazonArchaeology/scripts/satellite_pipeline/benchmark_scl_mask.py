@@ -0,0 +1,72 @@
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from preprocess_sentinel2 import apply_scl_mask, scl_mask_lut
+
+# Benchmarks SCL cloud masking of an in-memory band stack: the former per-class / per-band loops
+# against the lookup-table mask applied in place (preprocess_sentinel2.apply_scl_mask).
+# Reports the best wall time and the peak memory allocated on top of the stack, and checks that
+# both produce the same stack. Defaults to a full 10980x10980 tile with four 10 m bands
+# (~1 GB of uint16 bands, ~2.2 GB RAM in total).
+# Usage: python benchmark_scl_mask.py [--size 10980] [--bands 4] [--classes 3,8,9,10,11] [--repeat 3]
+
+
+def synthetic_scene(size, num_bands, seed=0):
+    """Returns a (bands, size, size) uint16 stack and a uint8 SCL raster with realistic class frequencies."""
+    rng = np.random.default_rng(seed)
+    stack = rng.integers(1, 10000, size=(num_bands, size, size), dtype=np.uint16)
+    classes = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11], dtype=np.uint8)
+    weights = np.array([1, 1, 2, 6, 40, 8, 5, 3, 12, 15, 6, 1], dtype=float)
+    scl = rng.choice(classes, size=(size, size), p=weights / weights.sum()).astype(np.uint8)
+    return stack, scl
+
+def mask_loop(stacked_data, scl_data, scl_mask_values, nodata_val):
+    """The previous implementation: one full pass per SCL class, then one boolean-index pass per band."""
+    cloud_mask = np.ones(scl_data.shape, dtype=bool)
+    for val in scl_mask_values:
+        cloud_mask[scl_data == val] = False
+    for i in range(stacked_data.shape[0]):
+        stacked_data[i][~cloud_mask] = nodata_val
+
+def mask_lut(stacked_data, scl_data, scl_mask_values, nodata_val):
+    apply_scl_mask(stacked_data, scl_data, scl_mask_lut(scl_mask_values), nodata_val)
+
+def measure(mask_function, stack, scl, scl_mask_values, repeat):
+    """Returns (best seconds, peak extra bytes, masked stack) for mask_function over `repeat` fresh copies."""
+    timings, peaks, work = [], [], None
+    for _ in range(repeat):
+        work = stack.copy()
+        tracemalloc.start()
+        start = time.perf_counter()
+        mask_function(work, scl, scl_mask_values, 0)
+        timings.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(timings), max(peaks), work
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loop vs lookup-table SCL masking.")
+    parser.add_argument('--size', type=int, default=10980, help="Scene size in pixels (default: 10980, a full 10 m tile)")
+    parser.add_argument('--bands', type=int, default=4, help="Number of bands in the stack (default: 4)")
+    parser.add_argument('--classes', default='3,8,9,10,11', help="SCL classes to mask (default: 3,8,9,10,11)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per implementation; the best time is reported")
+    args = parser.parse_args()
+
+    scl_mask_values = [int(v) for v in args.classes.split(',')]
+    stack, scl = synthetic_scene(args.size, args.bands)
+    print(f"Stack: {args.bands}x{args.size}x{args.size} uint16 ({stack.nbytes / 1024 ** 2:.0f} MB), "
+          f"masking SCL classes {scl_mask_values}")
+
+    loop_time, loop_peak, loop_result = measure(mask_loop, stack, scl, scl_mask_values, args.repeat)
+    print(f"loop  : {loop_time:.2f}s, peak extra memory {loop_peak / 1024 ** 2:.0f} MB")
+    del loop_result # Keep only one extra copy of the stack alive at a time
+    lut_time, lut_peak, lut_result = measure(mask_lut, stack, scl, scl_mask_values, args.repeat)
+    print(f"lut   : {lut_time:.2f}s, peak extra memory {lut_peak / 1024 ** 2:.0f} MB")
+    print(f"speed-up: {loop_time / lut_time:.1f}x, memory: {loop_peak / max(1, lut_peak):.1f}x less")
+
+    mask_loop(stack, scl, scl_mask_values, 0) # Reference result, computed in place on the original
+    print(f"identical output: {np.array_equal(stack, lut_result)}")
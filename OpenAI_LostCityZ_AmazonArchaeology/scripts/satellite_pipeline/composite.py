@@ -0,0 +1,211 @@
+import logging
+import math
+import multiprocessing.util
+import os
+import warnings
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling, transform_bounds
+from rasterio.windows import Window, from_bounds as window_from_bounds
+
+# Temporal composite of the processed Sentinel-2 scenes into one analysis-ready mosaic.
+# Every scene is already SCL-masked (masked pixels hold the nodata value), so per-pixel median or
+# percentile statistics over the valid observations fill cloud gaps. Scenes may come from several
+# UTM zones and tiles: each is warped on the fly onto one common grid through a WarpedVRT, and the
+# grid is processed window by window on a process pool. The window size is derived from a memory
+# budget, so peak memory per worker is bounded regardless of the AOI size or number of scenes.
+# Scenes are opened on first use by each worker and kept in a small LRU cache (MAX_OPEN_SCENES), so
+# open file handles per worker stay bounded too; the cache is closed when the worker exits.
+
+logger = logging.getLogger(__name__)
+
+COMPOSITE_METHODS = ('median', 'percentile')
+MAX_BLOCK_SIZE = 2048
+MIN_BLOCK_SIZE = 64
+OUTPUT_TILE_SIZE = 512
+WORKING_COPIES = 3 # The stack plus nanpercentile's internal copies
+MAX_OPEN_SCENES = 32 # Scenes (dataset + WarpedVRT) kept open per worker
+
+# Per-process state set by init_composite_worker: the common grid and the open (dataset, WarpedVRT)
+# pairs in LRU order
+_worker_grid = {}
+_worker_scenes = OrderedDict()
+
+
+def composite_grid(scene_paths, resolution):
+    """
+    Derives the common output grid: the CRS most scenes share, and the union of all scene bounds
+    in that CRS snapped to multiples of resolution. Returns a dict with crs, transform, width, height.
+    """
+    crs_counts = Counter()
+    scene_info = []
+    for scene_path in scene_paths:
+        with rasterio.open(scene_path) as src:
+            crs_counts[src.crs.to_wkt()] += 1
+            scene_info.append((src.crs, src.bounds))
+    crs = CRS.from_wkt(crs_counts.most_common(1)[0][0])
+
+    all_bounds = [transform_bounds(scene_crs, crs, *bounds) for scene_crs, bounds in scene_info]
+    left = math.floor(min(b[0] for b in all_bounds) / resolution) * resolution
+    bottom = math.floor(min(b[1] for b in all_bounds) / resolution) * resolution
+    right = math.ceil(max(b[2] for b in all_bounds) / resolution) * resolution
+    top = math.ceil(max(b[3] for b in all_bounds) / resolution) * resolution
+    return {
+        'crs': crs, 'transform': Affine(resolution, 0.0, left, 0.0, -resolution, top),
+        'width': int(round((right - left) / resolution)), 'height': int(round((top - bottom) / resolution)),
+    }
+
+def block_size_for_budget(num_scenes, num_bands, memory_mb):
+    """
+    Largest square window whose float32 scene stack fits in memory_mb, as a multiple of the
+    output's 512px tiles (or of 16px below that) so windows write whole tiles.
+    """
+    bytes_per_pixel = num_scenes * num_bands * 4 * WORKING_COPIES
+    size = int(math.sqrt(memory_mb * 1024 ** 2 / max(1, bytes_per_pixel)))
+    align = OUTPUT_TILE_SIZE if size >= OUTPUT_TILE_SIZE else 16
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size // align * align))
+
+def init_composite_worker(grid):
+    """Pool initializer: stores the common grid and closes the worker's open scenes when it exits."""
+    _worker_grid.update(grid)
+    multiprocessing.util.Finalize(None, close_worker_scenes, exitpriority=10)
+
+def worker_scene(scene_path):
+    """
+    The scene warped onto the common grid, opened on first use and cached; the least recently
+    used scene is closed once more than MAX_OPEN_SCENES are open.
+    """
+    if scene_path in _worker_scenes:
+        _worker_scenes.move_to_end(scene_path)
+        return _worker_scenes[scene_path][1]
+    src = rasterio.open(scene_path)
+    vrt = WarpedVRT(
+        src, crs=_worker_grid['crs'], transform=_worker_grid['transform'], width=_worker_grid['width'],
+        height=_worker_grid['height'], resampling=Resampling.nearest, nodata=src.nodata if src.nodata is not None else 0)
+    _worker_scenes[scene_path] = (src, vrt)
+    while len(_worker_scenes) > MAX_OPEN_SCENES:
+        close_scene(*_worker_scenes.popitem(last=False)[1])
+    return vrt
+
+def close_scene(src, vrt):
+    """Closes a cached WarpedVRT and the dataset it warps."""
+    vrt.close()
+    src.close()
+
+def close_worker_scenes():
+    """Closes every scene the worker still has open."""
+    while _worker_scenes:
+        close_scene(*_worker_scenes.popitem()[1])
+
+def composite_window(scene_paths, window, method='median', percentile=50.0):
+    """
+    Pool worker: reads `window` of every given scene from the common grid and returns
+    (window, per-pixel statistic as float32 (bands, rows, cols) with NaN where no scene is valid,
+    number of valid observations per pixel).
+    """
+    layers = []
+    for scene_path in scene_paths:
+        vrt = worker_scene(str(scene_path))
+        data = vrt.read(window=window).astype(np.float32)
+        invalid = np.all(data == vrt.nodata, axis=0) # SCL-masked and outside-footprint pixels
+        data[:, invalid] = np.nan
+        layers.append(data)
+    stack = np.stack(layers)
+    valid_count = np.sum(~np.isnan(stack[:, 0]), axis=0).astype(np.uint16)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # All-NaN pixels stay NaN
+        if method == 'median':
+            result = np.nanmedian(stack, axis=0)
+        else:
+            result = np.nanpercentile(stack, percentile, axis=0)
+    return window, result.astype(np.float32), valid_count
+
+def build_composite(scene_paths, output_path, resolution, method='median', percentile=50.0, memory_mb=512,
+                    max_workers=0):
+    """
+    Composites the (SCL-masked, single-date) scenes into output_path with the per-pixel median or
+    given percentile of the valid observations. All scenes must have the same bands.
+    memory_mb bounds the scene stack held by each worker; max_workers = 0 uses every CPU core.
+    Returns the output path, or None if there is nothing to composite.
+    """
+    scene_paths = sorted(Path(p) for p in scene_paths)
+    if not scene_paths:
+        logger.warning("No processed scenes to composite.")
+        return None
+    if method not in COMPOSITE_METHODS:
+        raise ValueError(f"Unknown composite method '{method}'. Use one of {', '.join(COMPOSITE_METHODS)}.")
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+
+    with rasterio.open(scene_paths[0]) as ref:
+        num_bands, dtype = ref.count, ref.dtypes[0]
+        nodata = ref.nodata if ref.nodata is not None else 0
+        descriptions = ref.descriptions
+    grid = composite_grid(scene_paths, resolution)
+
+    # Footprint of each scene on the grid, so a window only reads the scenes that overlap it
+    scene_windows = []
+    for scene_path in scene_paths:
+        with rasterio.open(scene_path) as src:
+            if src.count != num_bands:
+                raise ValueError(f"{scene_path.name} has {src.count} bands, expected {num_bands}.")
+            bounds = transform_bounds(src.crs, grid['crs'], *src.bounds)
+        scene_windows.append((scene_path, window_from_bounds(*bounds, transform=grid['transform'])))
+
+    block = block_size_for_budget(len(scene_paths), num_bands, memory_mb)
+    windows = [Window(col, row, min(block, grid['width'] - col), min(block, grid['height'] - row))
+               for row in range(0, grid['height'], block) for col in range(0, grid['width'], block)]
+    profile = {
+        'driver': 'GTiff', 'dtype': dtype, 'count': num_bands, 'width': grid['width'], 'height': grid['height'],
+        'crs': grid['crs'], 'transform': grid['transform'], 'nodata': nodata, 'compress': 'deflate',
+        'predictor': 2 if np.issubdtype(np.dtype(dtype), np.integer) else 3, 'tiled': True,
+        'blockxsize': min(block, OUTPUT_TILE_SIZE), 'blockysize': min(block, OUTPUT_TILE_SIZE), 'BIGTIFF': 'IF_SAFER',
+    }
+    logger.info(f"Compositing {len(scene_paths)} scenes ({method}{'' if method == 'median' else f' p{percentile:g}'}) onto a "
+                f"{grid['width']}x{grid['height']} px grid: {len(windows)} windows of {block}px on {max_workers} workers.")
+
+    observations = Counter() # Number of clear observations -> pixel count
+    with rasterio.open(output_path, 'w', **profile) as dst, \
+            ProcessPoolExecutor(max_workers=max_workers, initializer=init_composite_worker,
+                                initargs=(grid,)) as executor:
+        if any(descriptions):
+            dst.descriptions = descriptions
+        pending = set()
+        window_iter = iter(windows)
+        while True:
+            # Keep at most two windows per worker in flight so finished results never pile up
+            while len(pending) < 2 * max_workers:
+                window = next(window_iter, None)
+                if window is None:
+                    break
+                overlapping = [str(p) for p, scene_window in scene_windows if windows_overlap(window, scene_window)]
+                if not overlapping:
+                    continue # Window outside every scene stays nodata
+                pending.add(executor.submit(composite_window, overlapping, window, method, percentile))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window, result, valid_count = future.result()
+                data = np.where(np.isnan(result), nodata, np.rint(result) if profile['predictor'] == 2 else result)
+                dst.write(data.astype(dtype), window=window)
+                observations.update(dict(enumerate(np.bincount(valid_count.ravel()).tolist())))
+
+    covered = sum(count for n, count in observations.items() if n > 0)
+    total = grid['width'] * grid['height']
+    mean_obs = sum(n * count for n, count in observations.items()) / max(1, covered)
+    logger.info(f"Composite has valid data for {covered / max(1, total):.1%} of the grid "
+                f"(mean {mean_obs:.1f} clear observations per covered pixel): {Path(output_path).name}")
+    return output_path
+
+def windows_overlap(window, other):
+    """True if two (possibly fractional) pixel windows intersect."""
+    return (window.col_off < other.col_off + other.width and other.col_off < window.col_off + window.width
+            and window.row_off < other.row_off + other.height and other.row_off < window.row_off + window.height)
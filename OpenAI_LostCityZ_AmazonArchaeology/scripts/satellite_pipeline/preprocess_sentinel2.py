@@ -1,18 +1,34 @@
+import argparse
 import configparser
 import logging
+import math
 import os
 import shutil
+import multiprocessing
 import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
 import rasterio
+from rasterio.features import geometry_mask
 from rasterio.mask import mask as rio_mask
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.windows import Window, from_bounds as window_from_bounds, transform as window_transform
 from shapely.geometry import box, shape
 import geopandas
 import numpy as np
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # scripts/ for the shared utils package
+from utils.build_cache import BuildCache, code_version
+from utils.cog import cog_options_from_config, finalize_as_cog, write_cog
+from composite import build_composite
+from spectral_indices import compute_indices
+
 # --- Configuration and Logging Setup ---
-CONFIG_FILE_PATH = "../config/config.ini" # Adjusted path
+CONFIG_FILE_PATH = "../../config/config.ini" # Relative to the script directory
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logger = logging.getLogger(__name__) # Define logger at module level
 
@@ -151,13 +167,226 @@ def run_sen2cor(sen2cor_path, l1c_product_path, sen2cor_threads=None):
         return None
 
 
-def process_s2_product(product_path, aoi_geom, config_default, config_preprocessing):
+def get_aoi_pixel_window(aoi_gdf, src_transform, src_width, src_height):
+    """
+    Returns the pixel window of the raster grid covering the AOI bounds (rounded outwards
+    and limited to the raster extent), or None if the AOI does not overlap the raster.
+    """
+    left, bottom, right, top = aoi_gdf.total_bounds
+    aoi_window = window_from_bounds(left, bottom, right, top, transform=src_transform)
+    col_start = max(0, math.floor(aoi_window.col_off))
+    row_start = max(0, math.floor(aoi_window.row_off))
+    col_stop = min(src_width, math.ceil(aoi_window.col_off + aoi_window.width))
+    row_stop = min(src_height, math.ceil(aoi_window.row_off + aoi_window.height))
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+def scl_mask_lut(scl_mask_values, size=256):
+    """Lookup table indexed by SCL class, True for the classes to mask (SCL is a uint8 raster)."""
+    lut = np.zeros(size, dtype=bool)
+    lut[[v for v in scl_mask_values if 0 <= v < size]] = True
+    return lut
+
+def apply_scl_mask(stacked_data, scl_data, lut, nodata_val):
+    """
+    Sets all bands of a (bands, rows, cols) stack to nodata_val where the SCL class is masked, in place.
+    The mask is a single table lookup per pixel (replacing one comparison pass per class), and it
+    is applied to every band at once without per-band temporaries: a multiply by the valid mask
+    for nodata 0, otherwise a masked np.copyto. Returns the boolean mask of masked pixels.
+    """
+    if scl_data.dtype != np.uint8 and scl_data.size and int(scl_data.max()) >= lut.size:
+        lut = np.concatenate([lut, np.zeros(int(scl_data.max()) + 1 - lut.size, dtype=bool)])
+    masked = lut[scl_data] # Fancy indexing keeps the uint8 indices (np.take would copy them to intp)
+    if nodata_val == 0:
+        np.logical_not(masked, out=masked)
+        np.multiply(stacked_data, masked, out=stacked_data, casting='unsafe')
+        np.logical_not(masked, out=masked)
+    else:
+        np.copyto(stacked_data, stacked_data.dtype.type(nodata_val), where=masked)
+    return masked
+
+S2_BAND_RESOLUTIONS = (10, 20, 60) # L2A IMG_DATA/R<res>m folders
+
+def find_band_files(granule_dir, selected_bands_list, target_resolution):
+    """
+    Finds the .jp2 of each selected band, preferring the target resolution and otherwise the
+    finest resolution the product has (e.g. B11/B12 exist only at 20m and 60m).
+    Returns a list of (band name, path); bands found at no resolution are logged and left out.
+    """
+    resolutions = [target_resolution] + sorted(r for r in S2_BAND_RESOLUTIONS if r != target_resolution)
+    band_files = {res: list(granule_dir.glob(f'IMG_DATA/R{res}m/*.jp2')) for res in resolutions}
+    found = []
+    for band_name_short in selected_bands_list: # e.g., B02
+        # L2A band names in R{res}m folders are like TILEID_YYYYMMDDTHHMMSS_BAND_RESm.jp2
+        band_path = next((bf for res in resolutions for bf in band_files[res]
+                          if f"_{band_name_short}_{res}m.jp2" in bf.name or f"_{band_name_short}.jp2" in bf.name), None)
+        if band_path is None:
+            logger.warning(f"Band {band_name_short} not found at any resolution in {granule_dir}. Skipping this band.")
+            continue
+        if f"R{target_resolution}m" != band_path.parent.name:
+            logger.info(f"Band {band_name_short} is not available at {target_resolution}m; resampling it from {band_path.parent.name}.")
+        found.append((band_name_short, band_path))
+    return found
+
+def band_target_grid(band_srcs, target_resolution):
+    """
+    Returns (crs, transform, width, height) of the target_resolution grid for a set of opened
+    bands: the grid of the first band already at that resolution, or else the first band's extent
+    resampled to it (all bands of a granule share the tile extent).
+    """
+    for src in band_srcs:
+        if math.isclose(abs(src.transform.a), target_resolution):
+            return src.crs, src.transform, src.width, src.height
+    src = band_srcs[0]
+    scale = abs(src.transform.a) / target_resolution
+    transform = src.transform * src.transform.scale(1 / scale, 1 / scale)
+    return src.crs, transform, int(round(src.width * scale)), int(round(src.height * scale))
+
+def aligned_band(src, grid, resampling=Resampling.bilinear):
+    """
+    Returns src itself if it is on the target grid, otherwise a WarpedVRT that resamples it onto
+    the grid on the fly (per read window, nothing written to disk). The caller closes the VRT.
+    """
+    crs, transform, width, height = grid
+    if src.crs == crs and src.transform == transform and (src.width, src.height) == (width, height):
+        return src
+    nodata = src.nodata if src.nodata is not None else 0 # 0 is NO_DATA in L2A band files
+    return WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                     resampling=resampling, src_nodata=nodata, nodata=nodata)
+
+def write_stack_streaming(band_paths, scl_path, scl_mask_values, aoi_geom, out_path, block_size=512,
+                          target_resolution=10, band_resampling=Resampling.bilinear):
+    """
+    Stacks bands into a tiled GeoTIFF window by window, restricted to the AOI's pixel bounds.
+    Each block reads the bands (bands at another resolution, e.g. 20m SWIR, are resampled on the fly
+    to the target_resolution grid), the SCL raster (likewise) and rasterizes the AOI mask for that
+    block only, so peak memory scales with block_size rather than with the scene size.
+    Returns True on success, False otherwise.
+    """
+    block_size = max(16, block_size // 16 * 16) # GeoTIFF tiles must be multiples of 16
+    with ExitStack() as stack:
+        raw_srcs = [stack.enter_context(rasterio.open(bp)) for bp in band_paths]
+        grid = band_target_grid(raw_srcs, target_resolution)
+        band_srcs = []
+        for src in raw_srcs:
+            aligned = aligned_band(src, grid, band_resampling)
+            band_srcs.append(aligned if aligned is src else stack.enter_context(aligned))
+        ref_src = band_srcs[0]
+        src_crs, src_transform = grid[0], grid[1]
+        src_dtype = raw_srcs[0].dtypes[0]
+        nodata_val = raw_srcs[0].nodata if raw_srcs[0].nodata is not None else 0
+
+        aoi_gdf = geopandas.GeoDataFrame({'geometry': aoi_geom}, crs="EPSG:4326") # Assuming aoi_geom is WGS84
+        if src_crs.to_string() != aoi_gdf.crs.to_string():
+            aoi_gdf = aoi_gdf.to_crs(src_crs)
+
+        aoi_window = get_aoi_pixel_window(aoi_gdf, src_transform, ref_src.width, ref_src.height)
+        if aoi_window is None:
+            logger.error(f"AOI does not overlap {Path(band_paths[0]).name}. Nothing to write.")
+            return False
+        out_transform = window_transform(aoi_window, src_transform)
+        out_width, out_height = int(aoi_window.width), int(aoi_window.height)
+        logger.info(f"Streaming {len(band_paths)} bands over AOI window {out_width}x{out_height} px (offset {aoi_window.col_off},{aoi_window.row_off}) in {block_size}px blocks.")
+
+        scl_vrt = None
+        if scl_path:
+            scl_src = stack.enter_context(rasterio.open(scl_path))
+            # Nearest-neighbour resampling of the 20m SCL onto the band grid, evaluated per read window
+            scl_vrt = stack.enter_context(WarpedVRT(
+                scl_src, crs=src_crs, transform=src_transform,
+                width=ref_src.width, height=ref_src.height, resampling=Resampling.nearest))
+        scl_lut = scl_mask_lut(scl_mask_values)
+
+        profile = {
+            'driver': 'GTiff',
+            'dtype': src_dtype,
+            'count': len(band_paths),
+            'width': out_width,
+            'height': out_height,
+            'crs': src_crs,
+            'transform': out_transform,
+            'nodata': nodata_val,
+            'compress': 'lzw',
+            'tiled': True,
+            'blockxsize': block_size,
+            'blockysize': block_size,
+            'BIGTIFF': 'IF_SAFER',
+            'photometric': 'RGB' if len(band_paths) == 3 else 'MINISBLACK'
+        }
+
+        dst = stack.enter_context(rasterio.open(out_path, 'w', **profile))
+        for row_off in range(0, out_height, block_size):
+            for col_off in range(0, out_width, block_size):
+                dst_window = Window(col_off, row_off,
+                                    min(block_size, out_width - col_off),
+                                    min(block_size, out_height - row_off))
+                src_window = Window(aoi_window.col_off + col_off, aoi_window.row_off + row_off,
+                                    dst_window.width, dst_window.height)
+
+                block = np.empty((len(band_srcs), dst_window.height, dst_window.width), dtype=src_dtype)
+                for i, src in enumerate(band_srcs):
+                    block[i] = src.read(1, window=src_window)
+
+                valid = geometry_mask(aoi_gdf.geometry, out_shape=(dst_window.height, dst_window.width),
+                                      transform=window_transform(dst_window, out_transform),
+                                      all_touched=True, invert=True) # True inside the AOI
+                if scl_vrt is not None:
+                    valid[scl_lut[scl_vrt.read(1, window=src_window)]] = False
+                block[:, ~valid] = nodata_val
+
+                dst.write(block, window=dst_window)
+    return True
+
+def processed_band_suffix(config_preprocessing):
+    """Band part of processed file names: B02,B03,B04,B08 -> 02030408."""
+    selected_bands_list = [b.strip().upper() for b in config_preprocessing.get('output_bands', 'B02,B03,B04,B08').split(',')]
+    return "".join([b.replace("B","") for b in selected_bands_list])
+
+def processed_output_path(product_name, output_dir, config_preprocessing):
+    """Output of a product: <title>_Processed_<band combination>_<resolution>m.tif in output_dir."""
+    target_resolution = config_preprocessing.getint('target_resolution', 10)
+    title = product_name[:-len('.SAFE')] if product_name.endswith('.SAFE') else product_name
+    return Path(output_dir) / f"{title}_Processed_{processed_band_suffix(config_preprocessing)}_{target_resolution}m.tif"
+
+def product_build_params(aoi_geom, config_default, config_preprocessing):
+    """Config values a processed product depends on (the build-cache parameters of process_s2_product)."""
+    band_resampling_name = config_preprocessing.get('band_resampling', 'bilinear').strip().lower()
+    return {
+        'target_resolution': config_preprocessing.getint('target_resolution', 10),
+        'output_bands': [b.strip().upper() for b in config_preprocessing.get('output_bands', 'B02,B03,B04,B08').split(',')],
+        'cloud_mask_method': config_preprocessing.get('cloud_mask_method', 'scl').lower(),
+        'scl_mask_classes': [int(v.strip()) for v in config_preprocessing.get('scl_mask_classes', '3,8,9,10,11').split(',')],
+        'band_resampling': band_resampling_name if band_resampling_name in Resampling.__members__ else 'bilinear',
+        'aoi': [geom.wkt for geom in aoi_geom],
+        'cog': cog_options_from_config(config_default),
+    }
+
+def find_current_processed_output(title, output_dir, aoi_geom, config_default, config_preprocessing):
+    """
+    The processed output of a product title if it exists for the current bands and resolution and
+    was built with the current settings and code, else None. The raw .SAFE may have been deleted
+    after processing, so its content is not checked (a product title always names the same data).
+    """
+    out_path = processed_output_path(title, output_dir, config_preprocessing)
+    if not out_path.exists():
+        return None
+    build_cache = BuildCache(config_default.getboolean('incremental_builds', True))
+    if not build_cache.matches_settings(out_path, product_build_params(aoi_geom, config_default, config_preprocessing),
+                                        code_version(Path(__file__))):
+        logger.info(f"Processed output {out_path.name} was built with other settings or code; it will be rebuilt.")
+        return None
+    return out_path
+
+def process_s2_product(product_path, aoi_geom, config_default, config_preprocessing, output_dir):
     """
     Processes a single Sentinel-2 L2A product:
     - Cloud masking
     - Band selection & resampling
     - Clipping
-    - Saves as GeoTIFF
+    - Saves as GeoTIFF (in 'streaming' stack_mode the stack is written block by block),
+      or as a Cloud-Optimized GeoTIFF when raster_output_format = cog
+    Returns True if the processed GeoTIFF was written, False otherwise.
     """
     product_name = product_path.name
     logger.info(f"Processing L2A product: {product_name}")
@@ -185,7 +414,6 @@ def process_s2_product(product_path, aoi_geom, config_default, config_preprocess
 
     # Find granule metadata (MTD_TL.xml) and band files
     granule_dir = list(product_path.glob('GRANULE/L2A_*'))[0] # Assuming one granule for simplicity
-    band_files = list(granule_dir.glob(f'IMG_DATA/R{target_resolution}m/*.jp2'))
     scl_file_path_list = list(granule_dir.glob(f'QI_DATA/MSK_CLDPRB_20m.jp2')) # Cloud prob mask
     scl_file_path_scl = list(granule_dir.glob(f'QI_DATA/*SCL_20m.jp2')) # Scene classification mask
 
@@ -201,47 +429,74 @@ def process_s2_product(product_path, aoi_geom, config_default, config_preprocess
         scl_to_use = scl_file_path_scl[0] if scl_file_path_scl else None
 
 
-    # Filter band files to match selected_bands_list
-    # L2A band names in R{res}m folders are like TILEID_YYYYMMDDTHHMMSS_BAND.jp2
-    # We need to map B02, B03 etc to the actual file names.
-    # Example: S2A_MSIL2A_20230716T142721_N0509_R025_T20NKE_20230716T203922_B02_10m.jp2
-    
-    bands_to_stack = []
-    for band_name_short in selected_bands_list: # e.g., B02
-        found_band = False
-        for bf in band_files:
-            if f"_{band_name_short}_{target_resolution}m.jp2" in bf.name or f"_{band_name_short}.jp2" in bf.name: # Check for both 10m/20m/60m naming or just BXX.jp2
-                bands_to_stack.append(bf)
-                found_band = True
-                break
-        if not found_band:
-            logger.warning(f"Band {band_name_short} at {target_resolution}m not found in {product_name}. Skipping this band.")
+    # Map B02, B03 etc. to the band files, e.g.
+    # S2A_MSIL2A_20230716T142721_N0509_R025_T20NKE_20230716T203922_B02_10m.jp2
+    bands_to_stack = [band_path for _, band_path in find_band_files(granule_dir, selected_bands_list, target_resolution)]
+    band_resampling_name = config_preprocessing.get('band_resampling', 'bilinear').strip().lower()
+    try:
+        band_resampling = Resampling[band_resampling_name]
+    except KeyError:
+        logger.warning(f"Unknown band_resampling '{band_resampling_name}'. Using bilinear.")
+        band_resampling_name, band_resampling = 'bilinear', Resampling.bilinear
 
     if not bands_to_stack:
         logger.error(f"No specified bands found for product {product_name}. Skipping processing.")
-        return
+        return False
 
     logger.info(f"Selected bands for stacking: {[b.name for b in bands_to_stack]}")
 
-    # Open first band to get profile for the stack
-    with rasterio.open(bands_to_stack[0]) as src:
-        profile = src.profile
-        src_crs = src.crs
-        src_transform = src.transform
-        src_dtype = src.dtypes[0] # Assuming all selected bands have same dtype
-
-    # Create an empty array for the band stack
-    stacked_data = np.zeros((len(bands_to_stack), profile['height'], profile['width']), dtype=src_dtype)
-
-    for i, band_path in enumerate(bands_to_stack):
-        with rasterio.open(band_path) as src:
-            # If band is not at target_resolution, reproject it (this is a simple resampling)
-            # A more robust approach uses `reproject_match` from rioxarray or gdalwarp.
-            # For now, we assume bands are either already at target_res or we use them as is.
-            # This part needs refinement if mixing resolutions significantly.
-            # The R{target_resolution}m folder implies bands are already at that resolution.
-            stacked_data[i] = src.read(1)
-    
+    out_path = processed_output_path(product_name, output_dir, config_preprocessing)
+    cog_options = cog_options_from_config(config_default)
+
+    # Skip products whose output was built from the same .SAFE content, settings and code
+    build_cache = BuildCache(config_default.getboolean('incremental_builds', True))
+    build_params = product_build_params(aoi_geom, config_default, config_preprocessing)
+    build_version = code_version(Path(__file__))
+    if build_cache.is_current(out_path, [product_path], build_params, build_version):
+        logger.info(f"Processed output {out_path.name} is up to date. Skipping.")
+        return True
+
+    stack_mode = config_preprocessing.get('stack_mode', 'in_memory').lower()
+    if stack_mode == 'streaming':
+        block_size = config_preprocessing.getint('stack_block_size', 512)
+        if not scl_to_use:
+            logger.warning("No SCL file found or specified for masking. Proceeding without cloud mask.")
+        try:
+            if write_stack_streaming(bands_to_stack, scl_to_use, scl_mask_values, aoi_geom, out_path, block_size,
+                                     target_resolution, band_resampling):
+                if cog_options:
+                    finalize_as_cog(out_path, **cog_options)
+                build_cache.record(out_path, [product_path], build_params, build_version)
+                logger.info(f"Successfully processed and saved: {out_path}")
+                return True
+        except Exception as e:
+            logger.error(f"Error during streaming stack for {product_name}: {e}", exc_info=True)
+            if out_path.exists():
+                out_path.unlink() # Do not leave a partially written stack behind
+        return False
+    elif stack_mode != 'in_memory':
+        logger.warning(f"Unknown stack_mode '{stack_mode}'. Defaulting to 'in_memory'.")
+
+    # Target grid for the stack: the target_resolution grid of the granule
+    with ExitStack() as band_stack:
+        band_srcs = [band_stack.enter_context(rasterio.open(band_path)) for band_path in bands_to_stack]
+        grid = band_target_grid(band_srcs, target_resolution)
+        src_crs, src_transform, grid_width, grid_height = grid
+        profile = band_srcs[0].profile
+        profile.update({'crs': src_crs, 'transform': src_transform, 'width': grid_width, 'height': grid_height})
+        src_dtype = band_srcs[0].dtypes[0] # All L2A bands are uint16
+
+        # Create an empty array for the band stack
+        stacked_data = np.zeros((len(bands_to_stack), grid_height, grid_width), dtype=src_dtype)
+
+        for i, src in enumerate(band_srcs):
+            # Bands at another resolution (e.g. 20m B11/B12) are resampled onto the grid while being
+            # read, straight into the stack
+            aligned = aligned_band(src, grid, band_resampling)
+            aligned.read(1, out=stacked_data[i])
+            if aligned is not src:
+                aligned.close()
+
     profile.update({
         'count': len(bands_to_stack),
         'driver': 'GTiff',
@@ -250,8 +505,6 @@ def process_s2_product(product_path, aoi_geom, config_default, config_preprocess
     })
 
     # Cloud Masking using SCL
-    cloud_mask = np.ones((profile['height'], profile['width']), dtype=bool) # True means valid data
-
     if scl_to_use:
         logger.info(f"Applying SCL cloud mask from: {scl_to_use.name}")
         with rasterio.open(scl_to_use) as scl_src:
@@ -272,14 +525,13 @@ def process_s2_product(product_path, aoi_geom, config_default, config_preprocess
                 )
                 scl_data = resampled_scl_data
 
-            for val in scl_mask_values:
-                cloud_mask[scl_data == val] = False # Mask out specified SCL classes
-        
         # Apply mask to data (set to nodata, typically 0 for uint16 S2 data if not specified)
         # Rasterio uses a nodata value in profile if available. If not, 0 is common for S2.
-        nodata_val = profile.get('nodata', 0) 
-        for i in range(stacked_data.shape[0]):
-            stacked_data[i][~cloud_mask] = nodata_val
+        nodata_val = profile.get('nodata', 0)
+        if nodata_val is None:
+            nodata_val = 0
+        apply_scl_mask(stacked_data, scl_data, scl_mask_lut(scl_mask_values), nodata_val)
+        del scl_data
         profile['nodata'] = nodata_val
     else:
         logger.warning("No SCL file found or specified for masking. Proceeding without cloud mask.")
@@ -291,13 +543,17 @@ def process_s2_product(product_path, aoi_geom, config_default, config_preprocess
         aoi_gdf = aoi_gdf.to_crs(src_crs)
     
     try:
-        clipped_data, clipped_transform = rio_mask(
-            dataset=rasterio.MemoryFile().write(stacked_data, **profile), # Use in-memory dataset
-            shapes=aoi_gdf.geometry,
-            crop=True, # Crop to the extent of the AOI
-            all_touched=True, # Include pixels that touch the AOI
-            nodata=profile.get('nodata', 0) 
-        )
+        with rasterio.MemoryFile() as memfile: # Use in-memory dataset
+            with memfile.open(**profile) as mem_ds:
+                mem_ds.write(stacked_data)
+            with memfile.open() as mem_ds:
+                clipped_data, clipped_transform = rio_mask(
+                    dataset=mem_ds,
+                    shapes=aoi_gdf.geometry,
+                    crop=True, # Crop to the extent of the AOI
+                    all_touched=True, # Include pixels that touch the AOI
+                    nodata=profile.get('nodata', 0)
+                )
         profile.update({
             'height': clipped_data.shape[1],
             'width': clipped_data.shape[2],
@@ -305,24 +561,218 @@ def process_s2_product(product_path, aoi_geom, config_default, config_preprocess
         })
     except Exception as e:
         logger.error(f"Error during clipping for {product_name}: {e}. Skipping product.")
-        return
+        return False
 
     # Save processed file
-    # Output filename: OriginalName_Processed_BandCombination_Resolution.tif
-    band_suffix = "".join([b.replace("B","") for b in selected_bands_list])
-    out_filename = f"{product_name.replace('.SAFE','')}_Processed_{band_suffix}_{target_resolution}m.tif"
-    out_path = output_dir / out_filename
-
     try:
-        with rasterio.open(out_path, 'w', **profile) as dst:
-            dst.write(clipped_data)
+        if cog_options:
+            write_cog(out_path, clipped_data, profile, **cog_options)
+        else:
+            with rasterio.open(out_path, 'w', **profile) as dst:
+                dst.write(clipped_data)
+        build_cache.record(out_path, [product_path], build_params, build_version)
         logger.info(f"Successfully processed and saved: {out_path}")
+        return True
     except Exception as e:
         logger.error(f"Error saving processed file {out_path}: {e}")
+        return False
+
+
+def handle_product(item_path, app_config, aoi_geom, product_type_to_process, sen2cor_path, output_dir, sen2cor_semaphore=None):
+    """
+    Runs Sen2Cor (for L1C products, if configured) and process_s2_product for one .SAFE product.
+    Errors are contained here so one bad product never stops the others.
+    Returns a (product_name, status, detail) tuple where status is 'processed', 'skipped' or 'failed'.
+    """
+    product_name = item_path.name
+    logger.info(f"Found product: {product_name}")
+    default_config = app_config['DEFAULT']
+    preprocessing_config = app_config['PREPROCESSING'] if app_config.has_section('PREPROCESSING') else default_config
+
+    is_l1c = "MSIL1C" in product_name
+    l2a_product_to_process = None
+
+    if is_l1c and product_type_to_process == "S2MSI1C":
+        if sen2cor_path and Path(sen2cor_path).exists():
+            logger.info(f"Product {product_name} is L1C and config expects L1C. Attempting Sen2Cor.")
+            if sen2cor_semaphore is not None:
+                with sen2cor_semaphore: # Sen2Cor is memory hungry, cap how many run at once
+                    l2a_product_to_process = run_sen2cor(sen2cor_path, item_path)
+            else:
+                l2a_product_to_process = run_sen2cor(sen2cor_path, item_path)
+            if l2a_product_to_process is None:
+                logger.warning(f"Sen2Cor failed or L2A product not found for {product_name}. Skipping.")
+                return product_name, 'failed', "Sen2Cor failed or L2A product not found"
+        else:
+            logger.warning(f"Product {product_name} is L1C, but 'sen2cor_path' is not configured or invalid. Skipping L1C processing.")
+            logger.warning("Please install Sen2Cor and set 'sen2cor_path' in config.ini to process L1C products.")
+            return product_name, 'skipped', "L1C product without a configured Sen2Cor"
+    elif not is_l1c and "MSIL2A" in product_name and product_type_to_process == "S2MSI2A":
+        l2a_product_to_process = item_path
+    elif is_l1c and product_type_to_process == "S2MSI2A":
+        logger.warning(f"Product {product_name} is L1C, but config expects L2A. Skipping. If you want to process L1C, set product_type=S2MSI1C in config and ensure Sen2Cor is configured.")
+        return product_name, 'skipped', "L1C product while product_type expects L2A"
+    else: # Some other product type not matching expectations
+        logger.warning(f"Product {product_name} type does not match expected 'product_type' ({product_type_to_process}) or is not L1C/L2A. Skipping.")
+        return product_name, 'skipped', "product type does not match 'product_type'"
+
+    if not (l2a_product_to_process and l2a_product_to_process.exists()):
+        logger.warning(f"L2A product path not found or invalid for {product_name}. Skipping.")
+        return product_name, 'skipped', "L2A product path not found"
+
+    try:
+        if process_s2_product(l2a_product_to_process, aoi_geom, default_config, preprocessing_config, output_dir):
+            return product_name, 'processed', ""
+        return product_name, 'failed', "process_s2_product did not write an output"
+    except Exception as e:
+        logger.error(f"Unhandled exception during processing of {l2a_product_to_process.name}: {e}", exc_info=True)
+        return product_name, 'failed', str(e)
+
+def resolve_sen2cor_path(sen2cor_config, project_root_path):
+    """Returns the configured Sen2Cor executable as a string (relative paths are resolved from the project root), or None."""
+    sen2cor_path_str = sen2cor_config.get('sen2cor_path', None)
+    if not sen2cor_path_str:
+        return None
+    sen2cor_path_p = Path(sen2cor_path_str)
+    if not sen2cor_path_p.is_absolute():
+        sen2cor_path_p = project_root_path / sen2cor_path_p
+    if sen2cor_path_p.exists():
+        return str(sen2cor_path_p)
+    logger.warning(f"Sen2cor path specified but not found: {sen2cor_path_p}")
+    return None
+
+# Per-process state for pool workers, populated by init_product_worker
+_worker_state = {}
+
+def init_product_worker(script_dir_path, sen2cor_semaphore, log_dir_path, log_file_name):
+    """Process pool initializer: loads the config once per worker and keeps the shared Sen2Cor semaphore."""
+    if not logging.getLogger().hasHandlers(): # Spawned (not forked) workers start without logging
+        setup_logging(log_dir_path, log_file_name)
+    _worker_state['app_config'] = load_config(script_dir_path, CONFIG_FILE_PATH)
+    _worker_state['sen2cor_semaphore'] = sen2cor_semaphore
+
+def pool_handle_product(item_path, aoi_geom, product_type_to_process, sen2cor_path, output_dir):
+    """Entry point for pool workers; see handle_product."""
+    return handle_product(item_path, _worker_state['app_config'], aoi_geom, product_type_to_process,
+                          sen2cor_path, output_dir, _worker_state['sen2cor_semaphore'])
+
+def log_run_summary(results, elapsed_seconds):
+    """Logs aggregate counts, elapsed time and the list of failed products for a preprocessing run."""
+    processed = [r for r in results if r[1] == 'processed']
+    skipped = [r for r in results if r[1] == 'skipped']
+    failed = [r for r in results if r[1] == 'failed']
+    if not results:
+        logger.info("No new products were processed in this run.")
+        return
+    logger.info(f"Run summary: {len(results)} products in {elapsed_seconds:.1f}s - "
+                f"{len(processed)} processed, {len(skipped)} skipped, {len(failed)} failed.")
+    for product_name, _, detail in failed:
+        logger.warning(f"  Failed: {product_name} ({detail})")
+
+def processed_scene_paths(processed_dir, config_preprocessing):
+    """Processed single-date scenes in processed_dir with the configured bands and resolution."""
+    target_resolution = config_preprocessing.getint('target_resolution', 10)
+    band_suffix = processed_band_suffix(config_preprocessing)
+    return sorted(Path(processed_dir).glob(f"*_Processed_{band_suffix}_{target_resolution}m.tif"))
+
+def build_s2_composite(processed_dir, config_default, config_preprocessing):
+    """
+    Composites every processed scene with the configured bands and resolution into one
+    S2_Composite_<method>_<bands>_<res>m.tif in processed_dir (see composite.py).
+    Returns the composite path, or None if compositing is disabled or there are no scenes.
+    """
+    method = config_preprocessing.get('composite_method', 'median').strip().lower()
+    if method == 'none':
+        return None
+    target_resolution = config_preprocessing.getint('target_resolution', 10)
+    band_suffix = processed_band_suffix(config_preprocessing)
+    percentile = config_preprocessing.getfloat('composite_percentile', 50.0)
+    scene_paths = processed_scene_paths(processed_dir, config_preprocessing)
+    if not scene_paths:
+        logger.warning(f"No processed scenes with bands {band_suffix} at {target_resolution}m to composite.")
+        return None
+
+    method_suffix = method if method == 'median' else f"p{percentile:g}"
+    out_path = Path(processed_dir) / f"S2_Composite_{method_suffix}_{band_suffix}_{target_resolution}m.tif"
+    cog_options = cog_options_from_config(config_default)
+    build_cache = BuildCache(config_default.getboolean('incremental_builds', True))
+    build_params = {'method': method, 'percentile': percentile, 'target_resolution': target_resolution, 'cog': cog_options}
+    build_version = code_version(Path(__file__).resolve().parent / 'composite.py')
+    if build_cache.is_current(out_path, scene_paths, build_params, build_version):
+        logger.info(f"Composite {out_path.name} is up to date. Skipping.")
+        return out_path
+
+    try:
+        build_composite(scene_paths, out_path, target_resolution, method, percentile,
+                        config_preprocessing.getint('composite_memory_mb', 512),
+                        config_preprocessing.getint('composite_workers', 0))
+        if cog_options:
+            finalize_as_cog(out_path, **cog_options)
+    except Exception as e:
+        logger.error(f"Error building composite {out_path.name}: {e}", exc_info=True)
+        if out_path.exists():
+            out_path.unlink()
+        return None
+    build_cache.record(out_path, scene_paths, build_params, build_version)
+    return out_path
+
+def build_s2_indices(raster_path, config_default, config_preprocessing):
+    """
+    Computes the spectral_indices of [PREPROCESSING] for a processed stack or composite into
+    <stem>_indices.tif next to it (see spectral_indices.py). Returns the output path, or None.
+    """
+    index_definitions = config_preprocessing.get('spectral_indices', 'NDVI, NDWI, BSI, SR').strip()
+    if not index_definitions or raster_path is None:
+        return None
+    band_names = [b.strip().upper() for b in config_preprocessing.get('output_bands', 'B02,B03,B04,B08').split(',')]
+    out_path = Path(raster_path).with_name(f"{Path(raster_path).stem}_indices.tif")
+    cog_options = cog_options_from_config(config_default)
+    build_cache = BuildCache(config_default.getboolean('incremental_builds', True))
+    build_params = {'indices': index_definitions, 'bands': band_names, 'cog': cog_options}
+    build_version = code_version(Path(__file__).resolve().parent / 'spectral_indices.py')
+    if build_cache.is_current(out_path, [raster_path], build_params, build_version):
+        logger.info(f"Spectral indices {out_path.name} are up to date. Skipping.")
+        return out_path
+
+    try:
+        written = compute_indices(raster_path, out_path, index_definitions, band_names,
+                                  config_preprocessing.getint('index_block_size', 1024),
+                                  config_preprocessing.getint('index_workers', 0))
+        if not written:
+            logger.warning(f"None of the spectral indices '{index_definitions}' can be computed from {Path(raster_path).name}.")
+            return None
+        if cog_options:
+            finalize_as_cog(out_path, **cog_options)
+    except Exception as e:
+        logger.error(f"Error computing spectral indices for {Path(raster_path).name}: {e}", exc_info=True)
+        if out_path.exists():
+            out_path.unlink()
+        return None
+    build_cache.record(out_path, [raster_path], build_params, build_version)
+    return out_path
+
+def build_s2_outputs(processed_dir, config_default, config_preprocessing, composite=True):
+    """
+    Post-processing after all products are processed: the temporal composite and its spectral
+    indices, or, without a composite by choice (composite_method = none or composite=False), the
+    spectral indices of every processed scene. Returns the composite path, or None.
+    """
+    composite_path = build_s2_composite(processed_dir, config_default, config_preprocessing) if composite else None
+    if composite_path is not None:
+        build_s2_indices(composite_path, config_default, config_preprocessing)
+    elif not composite or config_preprocessing.get('composite_method', 'median').strip().lower() == 'none':
+        for scene_path in processed_scene_paths(processed_dir, config_preprocessing):
+            build_s2_indices(scene_path, config_default, config_preprocessing)
+    return composite_path
 
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess Sentinel-2 products and composite them.")
+    parser.add_argument('--no-composite', action='store_true',
+                        help="Only process new products; skip the temporal composite (used while downloads are still running)")
+    args = parser.parse_args()
+
     SCRIPT_DIR = Path(__file__).resolve().parent
     PROJECT_ROOT = SCRIPT_DIR.parent.parent
 
@@ -333,8 +783,8 @@ if __name__ == "__main__":
         exit(1)
         
     default_config = app_config['DEFAULT']
-    sen2cor_config = app_config.get('SEN2COR', {}) 
-    preprocessing_config = app_config.get('PREPROCESSING', {})
+    sen2cor_config = app_config['SEN2COR'] if app_config.has_section('SEN2COR') else default_config
+    preprocessing_config = app_config['PREPROCESSING'] if app_config.has_section('PREPROCESSING') else default_config
 
     log_dir_config = default_config.get('log_dir', 'logs')
     # Use satellite_log_file_name from config for consistency
@@ -353,16 +803,7 @@ if __name__ == "__main__":
     processed_dir_abs = PROJECT_ROOT / base_processed_dir_config / s2_processed_suffix_config
     
     product_type_to_process = default_config.get('product_type', 'S2MSI2A').upper()
-    sen2cor_path_str = sen2cor_config.get('sen2cor_path', None)
-    sen2cor_path = None
-    if sen2cor_path_str: # Resolve if path is relative to project root
-        sen2cor_path_p = Path(sen2cor_path_str)
-        if not sen2cor_path_p.is_absolute():
-            sen2cor_path_p = PROJECT_ROOT / sen2cor_path_p
-        if sen2cor_path_p.exists():
-            sen2cor_path = str(sen2cor_path_p)
-        else:
-            logger.warning(f"Sen2cor path specified but not found: {sen2cor_path_p}")
+    sen2cor_path = resolve_sen2cor_path(sen2cor_config, PROJECT_ROOT)
 
     if not raw_dir_abs.exists():
         logger.error(f"Raw data directory does not exist: {raw_dir_abs}")
@@ -376,77 +817,38 @@ if __name__ == "__main__":
         logger.error(f"AOI configuration error: {e}")
         exit(1)
     
-    processed_products_count = 0
-    # Modify process_s2_product to accept resolved output_dir
-    # def process_s2_product(product_path, aoi_geom, config_default, config_preprocessing, resolved_output_dir):
-    # And update the call below:
-    # process_s2_product(l2a_product_to_process, aoi_geometry_wgs84, default_config, preprocessing_config, processed_dir_abs)
-    # For now, the original process_s2_product will be modified internally to use global processed_dir_abs if needed.
-    # This is less clean but avoids changing function signature now.
-    # A cleaner way is to pass processed_dir_abs to process_s2_product. Let's assume it will use it correctly for now.
-    # The existing process_s2_product uses config_default to get 'processed_data_dir', which is now a suffix.
-    # It needs to be changed to:
-    # output_dir = PROJECT_ROOT / config_default.get('base_processed_data_dir') / config_default.get('s2_processed_suffix')
-
-    for item_path in raw_dir_abs.iterdir():
-        if item_path.is_dir() and item_path.name.endswith(".SAFE"):
-            product_name = item_path.name
-            logger.info(f"Found product: {product_name}")
-
-            is_l1c = "MSIL1C" in product_name
-            l2a_product_to_process = None
-
-            if is_l1c and product_type_to_process == "S2MSI1C":
-                if sen2cor_path and Path(sen2cor_path).exists():
-                    logger.info(f"Product {product_name} is L1C and config expects L1C. Attempting Sen2Cor.")
-                    l2a_product_to_process = run_sen2cor(sen2cor_path, item_path)
-                    if l2a_product_to_process is None:
-                        logger.warning(f"Sen2Cor failed or L2A product not found for {product_name}. Skipping.")
-                        continue
-                else:
-                    logger.warning(f"Product {product_name} is L1C, but 'sen2cor_path' is not configured or invalid. Skipping L1C processing.")
-                    logger.warning("Please install Sen2Cor and set 'sen2cor_path' in config.ini to process L1C products.")
-                    continue
-            elif not is_l1c and "MSIL2A" in product_name and product_type_to_process == "S2MSI2A":
-                l2a_product_to_process = item_path
-            elif is_l1c and product_type_to_process == "S2MSI2A":
-                logger.warning(f"Product {product_name} is L1C, but config expects L2A. Skipping. If you want to process L1C, set product_type=S2MSI1C in config and ensure Sen2Cor is configured.")
-                continue
-            else: # Some other product type not matching expectations
-                logger.warning(f"Product {product_name} type does not match expected 'product_type' ({product_type_to_process}) or is not L1C/L2A. Skipping.")
-                continue
-
-            if l2a_product_to_process and l2a_product_to_process.exists():
-                try:
-                    # Pass the absolute processed_dir_abs to the function, or modify function to construct it
-                    # For now, let's assume process_s2_product is modified to correctly build its output path
-                    # based on PROJECT_ROOT and config suffixes if it receives default_config.
-                    # The change to process_s2_product output_dir logic:
-                    # output_dir = Path(config_default.get('processed_data_dir', '../../data/sentinel2/processed'))
-                    # should become:
-                    # base_processed_dir = PROJECT_ROOT / config_default.get('base_processed_data_dir').replace('../../','')
-                    # output_dir = base_processed_dir / config_default.get('s2_processed_suffix')
-                    # This change needs to be made within process_s2_product if not passing explicitly.
-                    # For simplicity in this diff, I will assume it's handled correctly inside process_s2_product
-                    # by it using PROJECT_ROOT (if made global or passed) and config.
-                    
-                    # Corrected call if process_s2_product signature is changed:
-                    # process_s2_product(l2a_product_to_process, aoi_geometry_wgs84, default_config, preprocessing_config, processed_dir_abs)
-                    # If not changing signature, process_s2_product needs to be aware of PROJECT_ROOT.
-                    # Let's make PROJECT_ROOT accessible to process_s2_product by defining it globally in script scope.
-                    # (This is already done by SCRIPT_DIR, PROJECT_ROOT at top of __main__)
-                    # The process_s2_product will be modified to use it.
-
-                    process_s2_product(l2a_product_to_process, aoi_geometry_wgs84, default_config, preprocessing_config)
-                    processed_products_count +=1
-                except Exception as e:
-                    logger.error(f"Unhandled exception during processing of {l2a_product_to_process.name}: {e}", exc_info=True)
-            else:
-                logger.warning(f"L2A product path not found or invalid for {product_name}. Skipping.")
-                
-    if processed_products_count == 0:
-        logger.info("No new products were processed in this run.")
+    product_paths = sorted(p for p in raw_dir_abs.iterdir() if p.is_dir() and p.name.endswith(".SAFE"))
+    num_workers = preprocessing_config.getint('num_workers', 1)
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    max_concurrent_sen2cor = sen2cor_config.getint('max_concurrent_sen2cor', 1)
+
+    run_start = time.perf_counter()
+    results = []
+    if num_workers == 1 or len(product_paths) <= 1:
+        for item_path in product_paths:
+            results.append(handle_product(item_path, app_config, aoi_geometry_wgs84, product_type_to_process,
+                                          sen2cor_path, processed_dir_abs))
     else:
-        logger.info(f"Successfully processed {processed_products_count} products.")
+        logger.info(f"Processing {len(product_paths)} products with {num_workers} workers (max {max_concurrent_sen2cor} concurrent Sen2Cor jobs).")
+        sen2cor_semaphore = multiprocessing.Semaphore(max(1, max_concurrent_sen2cor))
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_product_worker,
+                                 initargs=(SCRIPT_DIR, sen2cor_semaphore, log_dir_abs, log_file_name_config)) as executor:
+            futures = {
+                executor.submit(pool_handle_product, item_path, aoi_geometry_wgs84, product_type_to_process,
+                                sen2cor_path, processed_dir_abs): item_path
+                for item_path in product_paths
+            }
+            for future in as_completed(futures):
+                item_path = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as e: # e.g. a worker killed by the OOM killer
+                    logger.error(f"Worker failed while processing {item_path.name}: {e}", exc_info=True)
+                    results.append((item_path.name, 'failed', f"worker error: {e}"))
+
+    log_run_summary(results, time.perf_counter() - run_start)
+
+    build_s2_outputs(processed_dir_abs, default_config, preprocessing_config, composite=not args.no_composite)
 
     logger.info("--- Sentinel-2 Data Preprocessing Finished ---")
@@ -0,0 +1,110 @@
+import logging
+import re
+
+import geopandas
+import pandas
+from shapely import wkt as shapely_wkt
+
+# Greedy product selection for acquire_sentinel2.py.
+# A query usually returns many overlapping products (several tiles per date, several dates per
+# tile). Each candidate is scored by the clear-sky AOI area it adds per byte downloaded and the
+# best one is taken until the expected clear-sky coverage of the AOI reaches a target.
+# Cloud cover is only known per product (cloudcoverpercentage), so a product with c% cloud is
+# treated as seeing each pixel of its footprint clear with probability 1 - c/100; the AOI is kept
+# as pieces with the probability of still being unobserved, which overlapping picks multiply down.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRODUCT_BYTES = 800 * 1024 ** 2 # Typical L2A tile, used when the hub reports no size
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+MIN_PIECE_AREA_M2 = 1.0 # Drops slivers left by floating-point overlay
+
+
+def parse_product_size(size):
+    """Parses the hub's human-readable 'size' field (e.g. '812.45 MB') into bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?B)\s*$', str(size or ''), re.IGNORECASE)
+    if not match:
+        return DEFAULT_PRODUCT_BYTES
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def format_bytes(num_bytes):
+    """Formats a byte count for log messages."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+def select_products_for_coverage(products_gdf, footprint_wkt, coverage_target=0.95, free_ids=()):
+    """
+    Picks the products to download from an api.to_geodataframe() result (EPSG:4326 footprints with
+    'size' and 'cloudcoverpercentage' columns), greedily by expected new clear-sky AOI area per byte,
+    until the expected clear-sky coverage of the AOI reaches coverage_target (0-1) or no product adds any.
+    Products in free_ids (already on disk or processed) cost nothing and are preferred.
+    Returns (selected product ids in pick order, summary dict with coverage and byte counts).
+    """
+    aoi_gdf = geopandas.GeoSeries([shapely_wkt.loads(footprint_wkt)], crs="EPSG:4326")
+    equal_area_crs = aoi_gdf.estimate_utm_crs()
+    aoi = aoi_gdf.to_crs(equal_area_crs).iloc[0]
+    aoi_area = aoi.area
+    footprints = products_gdf.geometry.set_crs("EPSG:4326", allow_override=True).to_crs(equal_area_crs)
+
+    candidates = {}
+    for product_id, product_info in products_gdf.iterrows():
+        coverage = footprints.loc[product_id].intersection(aoi)
+        if coverage.is_empty or coverage.area < MIN_PIECE_AREA_M2:
+            continue
+        cloud = product_info.get('cloudcoverpercentage')
+        cloud = 100.0 if pandas.isna(cloud) else float(cloud) # Unknown cloud cover: assume nothing is clear
+        clear_fraction = min(1.0, max(0.0, 1.0 - cloud / 100.0))
+        candidates[product_id] = {
+            'coverage': coverage, 'clear_fraction': clear_fraction,
+            'bytes': 0 if product_id in free_ids else parse_product_size(product_info.get('size')),
+        }
+
+    # AOI pieces as (geometry, probability that no selected product has seen it clear)
+    pieces = [(aoi, 1.0)]
+    selected, selected_bytes = [], 0
+    expected_covered = 0.0
+    while candidates and expected_covered / aoi_area < coverage_target:
+        best_id, best_score, best_gain = None, 0.0, 0.0
+        for product_id, candidate in candidates.items():
+            gain = candidate['clear_fraction'] * sum(
+                probability * geometry.intersection(candidate['coverage']).area
+                for geometry, probability in pieces if geometry.intersects(candidate['coverage']))
+            if gain <= 0:
+                continue
+            score = float('inf') if candidate['bytes'] == 0 else gain / candidate['bytes']
+            if best_id is None or score > best_score or (score == best_score and gain > best_gain):
+                best_id, best_score, best_gain = product_id, score, gain
+        if best_id is None:
+            break
+
+        best = candidates.pop(best_id)
+        new_pieces = []
+        for geometry, probability in pieces:
+            if not geometry.intersects(best['coverage']):
+                new_pieces.append((geometry, probability))
+                continue
+            inside = geometry.intersection(best['coverage'])
+            outside = geometry.difference(best['coverage'])
+            if inside.area >= MIN_PIECE_AREA_M2:
+                new_pieces.append((inside, probability * (1.0 - best['clear_fraction'])))
+            if outside.area >= MIN_PIECE_AREA_M2:
+                new_pieces.append((outside, probability))
+        pieces = new_pieces
+        expected_covered += best_gain
+        selected.append(best_id)
+        selected_bytes += best['bytes']
+
+    total_bytes = sum(0 if product_id in free_ids else parse_product_size(product_info.get('size'))
+                      for product_id, product_info in products_gdf.iterrows())
+    summary = {
+        'expected_coverage': expected_covered / aoi_area if aoi_area else 0.0,
+        'selected_bytes': selected_bytes,
+        'total_bytes': total_bytes,
+        'saved_bytes': max(0, total_bytes - selected_bytes),
+    }
+    return selected, summary
@@ -0,0 +1,204 @@
+import argparse
+import ast
+import logging
+import operator
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# Spectral index engine for processed Sentinel-2 stacks.
+# Index expressions ("NDVI = (B08 - B04) / (B08 + B04)") are parsed once into a small arithmetic
+# tree over band names and evaluated together in a single pass over the raster, block by block on
+# a thread pool (NumPy releases the GIL for the arithmetic). Only one block of bands and indices
+# per thread is in memory, so memory use does not depend on the scene size.
+# Division by zero and nodata in any band an index uses give INDEX_NODATA in that index.
+
+logger = logging.getLogger(__name__)
+
+INDEX_NODATA = -9999.0
+
+# Sentinel-2 band names: B02 blue, B03 green, B04 red, B08 NIR, B11 SWIR1
+STANDARD_INDICES = {
+    'NDVI': '(B08 - B04) / (B08 + B04)',
+    'NDWI': '(B03 - B08) / (B03 + B08)',
+    'BSI': '((B11 + B04) - (B08 + B02)) / ((B11 + B04) + (B08 + B02))',
+    'SR': 'B08 / B04',
+}
+
+_BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul}
+
+
+def parse_index_definitions(definitions):
+    """
+    Parses index definitions: standard index names (see STANDARD_INDICES) or 'NAME = expression'
+    with band names, numbers, + - * / ** and parentheses. Accepts a comma-separated string or a list.
+    Returns a dict of name -> (expression, parsed tree, set of band names used).
+    """
+    if isinstance(definitions, str):
+        definitions = definitions.split(',')
+    indices = {}
+    for definition in definitions:
+        definition = definition.strip()
+        if not definition:
+            continue
+        if '=' in definition:
+            name, expression = (part.strip() for part in definition.split('=', 1))
+        elif definition.upper() in STANDARD_INDICES:
+            name, expression = definition.upper(), STANDARD_INDICES[definition.upper()]
+        else:
+            raise ValueError(f"Unknown index '{definition}'. Use one of {', '.join(STANDARD_INDICES)} or 'NAME = expression'.")
+        try:
+            tree = ast.parse(expression, mode='eval').body
+        except SyntaxError as e:
+            raise ValueError(f"Invalid expression for index {name}: {expression} ({e.msg})") from None
+        indices[name] = (expression, tree, expression_bands(tree, name))
+    return indices
+
+def expression_bands(node, index_name):
+    """Validates an expression tree and returns the band names it uses."""
+    if isinstance(node, ast.Name):
+        return {node.id}
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return set()
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return expression_bands(node.operand, index_name)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)):
+        return expression_bands(node.left, index_name) | expression_bands(node.right, index_name)
+    raise ValueError(f"Unsupported element in index {index_name}: {ast.dump(node)}")
+
+def evaluate_expression(node, bands):
+    """
+    Evaluates a parsed expression on a dict of float32 band blocks. Division by zero gives NaN
+    instead of inf, and NaN (nodata) propagates through every operation.
+    """
+    if isinstance(node, ast.Name):
+        return bands[node.id]
+    if isinstance(node, ast.Constant):
+        return np.float32(node.value)
+    if isinstance(node, ast.UnaryOp):
+        operand = evaluate_expression(node.operand, bands)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    left = evaluate_expression(node.left, bands)
+    right = evaluate_expression(node.right, bands)
+    if isinstance(node.op, ast.Div):
+        left, right = np.broadcast_arrays(np.asarray(left, dtype=np.float32), np.asarray(right, dtype=np.float32))
+        result = np.full(left.shape, np.nan, dtype=np.float32)
+        np.divide(left, right, out=result, where=right != 0)
+        return result
+    if isinstance(node.op, ast.Pow):
+        with np.errstate(invalid='ignore', over='ignore'):
+            return np.power(left, right)
+    return _BINARY_OPERATORS[type(node.op)](left, right)
+
+def compute_index_block(src, window, band_indexes, indices, nodata):
+    """Reads the bands used by any index for one window and returns a (num indices, rows, cols) float32 block."""
+    bands = {}
+    for name, band_index in band_indexes.items():
+        data = src.read(band_index, window=window).astype(np.float32)
+        if nodata is not None:
+            data[data == nodata] = np.nan
+        bands[name] = data
+    out = np.empty((len(indices), int(window.height), int(window.width)), dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        for i, (_, tree, _) in enumerate(indices.values()):
+            out[i] = evaluate_expression(tree, bands)
+    out[~np.isfinite(out)] = INDEX_NODATA
+    return out
+
+def compute_indices(input_path, output_path, index_definitions, band_names=None, block_size=1024, max_workers=0):
+    """
+    Computes all index_definitions (see parse_index_definitions) for a multi-band raster in one
+    chunked pass and writes them as one float32 band each (band description = index name) to
+    output_path. band_names gives the band name of each input band in order; by default the band
+    descriptions of the input are used. Indices using a band the input does not have are skipped.
+    Returns the list of index names written, or an empty list if none could be computed.
+    """
+    indices = parse_index_definitions(index_definitions)
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+
+    with rasterio.open(input_path) as src:
+        if band_names is None:
+            band_names = src.descriptions if any(src.descriptions) else []
+        band_names = [str(b).strip().upper() for b in band_names]
+        if len(band_names) != src.count:
+            raise ValueError(f"{Path(input_path).name} has {src.count} bands but {len(band_names)} band names were given.")
+        available = {name: i + 1 for i, name in enumerate(band_names)}
+        for name, (_, _, used) in list(indices.items()):
+            missing = used - available.keys()
+            if missing:
+                logger.warning(f"Skipping index {name}: band(s) {', '.join(sorted(missing))} not in {Path(input_path).name}.")
+                del indices[name]
+        if not indices:
+            return []
+        used_bands = set().union(*(used for _, _, used in indices.values()))
+        band_indexes = {name: available[name] for name in used_bands}
+        nodata = src.nodata
+        width, height = src.width, src.height
+        block = max(16, block_size // 16 * 16)
+        profile = {
+            'driver': 'GTiff', 'dtype': 'float32', 'count': len(indices), 'width': width, 'height': height,
+            'crs': src.crs, 'transform': src.transform, 'nodata': INDEX_NODATA, 'compress': 'deflate',
+            'predictor': 3, 'tiled': True, 'blockxsize': min(block, 512), 'blockysize': min(block, 512),
+            'BIGTIFF': 'IF_SAFER',
+        }
+
+    windows = [Window(col, row, min(block, width - col), min(block, height - row))
+               for row in range(0, height, block) for col in range(0, width, block)]
+    logger.info(f"Computing {', '.join(indices)} for {Path(input_path).name}: {len(windows)} blocks of "
+                f"{block}px on {max_workers} threads.")
+
+    # Rasterio datasets must not be shared between threads, so each thread opens its own
+    thread_state = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+    def worker(window):
+        if not hasattr(thread_state, 'src'):
+            thread_state.src = rasterio.open(input_path)
+            with opened_lock:
+                opened.append(thread_state.src)
+        return window, compute_index_block(thread_state.src, window, band_indexes, indices, nodata)
+
+    try:
+        with rasterio.open(output_path, 'w', **profile) as dst, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            dst.descriptions = tuple(indices)
+            pending = set()
+            window_iter = iter(windows)
+            while True:
+                # At most two blocks per thread in flight keeps memory constant
+                while len(pending) < 2 * max_workers:
+                    window = next(window_iter, None)
+                    if window is None:
+                        break
+                    pending.add(executor.submit(worker, window))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window, data = future.result()
+                    dst.write(data, window=window)
+    finally:
+        for src in opened:
+            src.close()
+    logger.info(f"Wrote {len(indices)} spectral indices to {Path(output_path).name}")
+    return list(indices)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute spectral indices of a processed Sentinel-2 GeoTIFF in one chunked pass.")
+    parser.add_argument('input', type=Path, help="Processed Sentinel-2 stack or composite")
+    parser.add_argument('output', type=Path, help="Output multi-band index GeoTIFF")
+    parser.add_argument('--bands', default='B02,B03,B04,B08', help="Band names of the input bands in order (default: B02,B03,B04,B08)")
+    parser.add_argument('--indices', default=','.join(STANDARD_INDICES),
+                        help="Comma-separated standard index names or 'NAME = expression' (default: all standard indices)")
+    parser.add_argument('--block-size', type=int, default=1024, help="Block size in pixels (default: 1024)")
+    parser.add_argument('--workers', type=int, default=0, help="Threads (default: one per CPU core)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    compute_indices(args.input, args.output, args.indices, args.bands.split(','), args.block_size, args.workers)
@@ -8,7 +8,7 @@ from urllib.parse import urlparse, unquote
 import re
 
 # --- Configuration and Logging Setup ---
-CONFIG_FILE_PATH = "../satellite_pipeline/config.ini" # Assuming shared config
+CONFIG_FILE_PATH = "../../config/config.ini" # Shared config, relative to the script directory (the working directory)
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
 def setup_logging(log_dir_path, log_file_name):
@@ -150,7 +150,7 @@ if __name__ == "__main__":
             exit(1)
 
     default_config = config['DEFAULT']
-    text_config = config.get('TextualData')
+    text_config = config['TextualData'] if config.has_section('TextualData') else None
 
     if not text_config:
         print("FATAL: [TextualData] section not found in configuration file.")
@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import collections
+import configparser
+import hashlib
+import json
+import logging
+import random
+import time
+from pathlib import Path
+
+from openai_cache import make_cache_key, response_cache_from_config
+from text_chunking import chunk_text, estimate_tokens, merge_chunk_entities
+
+# Batch named entity recognition over the whole processed-text corpus (*_processed.txt).
+# Documents are sent to the OpenAI API by a fixed number of asyncio workers, so at most
+# max_in_flight requests are open at any time. A shared limiter keeps the run inside the account's
+# requests-per-minute and tokens-per-minute budgets (sliding 60 s window); a 429 pauses every worker
+# for the server's Retry-After, or an exponential backoff with jitter, before the request is retried.
+# Each finished document is appended to a JSONL file right away, so an interrupted run resumes
+# from the documents that are not in it yet (or whose text changed since). Responses also go
+# through the persistent response cache (openai_cache.py).
+# Long documents are split into overlapping token windows (text_chunking.py) whose requests run in
+# parallel like separate documents; their entities are merged back to document character offsets.
+# The API endpoint is configurable (api_base_url / --base-url), e.g. for mock_openai_server.py.
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration and Logging Setup ---
+CONFIG_FILE_PATH = "../../config/config.ini" # Shared config, relative to the script directory (the working directory)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+def setup_logging(log_dir_path, log_file_name):
+    Path(log_dir_path).mkdir(parents=True, exist_ok=True)
+    log_path = Path(log_dir_path) / log_file_name
+    logger_root = logging.getLogger()
+    for handler in logger_root.handlers[:]:
+        logger_root.removeHandler(handler)
+    logging.basicConfig(filename=log_path, level=logging.INFO, format=LOG_FORMAT, filemode='a')
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(console_handler)
+    return logging.getLogger(__name__)
+
+def load_config(config_path=CONFIG_FILE_PATH):
+    config = configparser.ConfigParser(interpolation=None, allow_no_value=True)
+    if not Path(config_path).exists():
+        raise FileNotFoundError(f"Configuration file '{config_path}' not found.")
+    config.read(config_path)
+    return config
+
+# --- NER Prompt ---
+
+NER_SYSTEM_PROMPT = "You are an expert in Amazonian archaeology and history, skilled at extracting specific information from texts."
+
+NER_PROMPT_TEMPLATE = """Extract the specified entities from the following text.
+For each entity, provide the text segment and the entity type.
+If an entity appears multiple times, list each instance.
+Desired entity types: {entity_types}
+{entity_definitions}
+Provide the output as a JSON object where keys are entity types and values are lists of extracted text segments.
+Example of an entity type: {entity_types_example}
+
+Text to analyze:
+--- --- --- --- ---
+{text_content}
+--- --- --- --- ---
+Extracted entities in JSON format:"""
+
+ENTITY_DEFINITIONS = {
+    "PLACE_NAME": "Specific geographic locations like rivers, mountains, lakes, waterfalls, or named regions.",
+    "ARCHAEOLOGICAL_SITE": "Named or described ancient sites, ruins, or locations of past human settlements (e.g., 'El Dorado', 'Kuhikugu site complex', 'Sitio das Antas', 'ancient earthworks').",
+    "INDIGENOUS_GROUP": "Names of Indigenous peoples, tribes, or communities (e.g., 'Manao', 'Omagua').",
+    "DATE_TIME_PERIOD": "Specific dates, years, or general time period descriptions (e.g., '1750', '1200 AD to 1600 AD', 'pre-Columbian', 'ancient times', 'July 10, 1988').",
+    "SETTLEMENT_STRUCTURE": "Descriptions of villages, cities, houses, fortifications, plazas, causeways, canals, mounds, earthworks, geoglyphs, fish weirs, fields, roça.",
+    "RESOURCE_MENTION": "Mentions of natural resources used or sought, like specific plants (manioc, Brazilwood, Brazil nut trees), animals, minerals (gold), or soil types (terra preta, black soil).",
+    "ARTIFACT": "Mentions of human-made objects like ceramic urns, stone axes.",
+}
+
+SECONDS_PER_MINUTE = 60.0
+MAX_BACKOFF_SECONDS = 120.0
+
+
+def build_ner_messages(text_content, entity_definitions=ENTITY_DEFINITIONS):
+    """Chat messages asking for the entities of entity_definitions in text_content, as JSON."""
+    example_output_structure = {etype: ["example segment 1", "example segment 2"] for etype in entity_definitions}
+    definitions = ''.join(f"- {etype}: {description}\n" for etype, description in entity_definitions.items())
+    prompt = NER_PROMPT_TEMPLATE.format(
+        entity_types=', '.join(entity_definitions), entity_definitions=definitions,
+        entity_types_example=json.dumps(example_output_structure), text_content=text_content)
+    return [{"role": "system", "content": NER_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+
+def parse_ner_response(content, entity_definitions=ENTITY_DEFINITIONS):
+    """
+    Parses the model's JSON answer into {entity type: [segments]} with every requested type present.
+    Raises ValueError if the answer is not a JSON object.
+    """
+    try:
+        entities = json.loads(content)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Response is not valid JSON: {e}") from None
+    if not isinstance(entities, dict):
+        raise ValueError(f"Response is not a JSON object: {type(entities).__name__}")
+    validated = {}
+    for etype in entity_definitions:
+        segments = entities.get(etype, [])
+        validated[etype] = [str(s) for s in segments] if isinstance(segments, list) else []
+    return validated
+
+def error_status(error):
+    """HTTP status code of an API error (openai.APIStatusError and compatible clients), or None."""
+    status = getattr(error, 'status_code', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    return status
+
+def retry_after_seconds(error):
+    """The Retry-After delay the server sent with a 429/503 error, or None."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    for header in ('retry-after-ms', 'retry-after'):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) / (1000.0 if header == 'retry-after-ms' else 1.0)
+        except ValueError:
+            continue
+    return None
+
+def is_retryable_error(error):
+    """Rate limits, server errors, timeouts and connection errors are worth retrying; other 4xx errors are not."""
+    status = error_status(error)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError, TimeoutError)) or \
+        'Timeout' in type(error).__name__ or 'Connection' in type(error).__name__
+
+
+class RateLimiter:
+    """
+    Async requests-per-minute / tokens-per-minute budget over a sliding 60 s window, shared by all
+    workers. A rate-limit response pauses every request (not only the one that got the 429), with
+    the pause growing exponentially while 429s keep coming and resetting after a success.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = collections.deque() # [start time, tokens] of the requests of the last minute
+        self._window_tokens = 0
+        self._paused_until = 0.0
+        self._consecutive_rate_limits = 0
+        self._lock = asyncio.Lock()
+        self.rate_limited = 0
+
+    def _prune(self, now):
+        while self._window and now - self._window[0][0] >= SECONDS_PER_MINUTE:
+            self._window_tokens -= self._window.popleft()[1]
+
+    async def acquire(self, tokens):
+        """Waits until a request of `tokens` fits the budgets. Returns a handle for settle()."""
+        async with self._lock: # Waiters are served in order, so large requests are not starved
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._prune(now)
+                # A single request larger than the TPM budget is let through on an empty window
+                fits_tokens = self._window_tokens + tokens <= self.tokens_per_minute or not self._window
+                if len(self._window) < self.requests_per_minute and fits_tokens:
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    self._window_tokens += tokens
+                    return entry
+                await asyncio.sleep(max(0.01, self._window[0][0] + SECONDS_PER_MINUTE - now))
+
+    def settle(self, entry, actual_tokens):
+        """Replaces a request's estimated tokens with the usage the API reported."""
+        if actual_tokens and entry in self._window:
+            self._window_tokens += actual_tokens - entry[1]
+            entry[1] = actual_tokens
+        self._consecutive_rate_limits = 0
+
+    def rate_limit_hit(self, retry_after=None):
+        """Pauses all requests after a 429; returns the pause in seconds."""
+        self.rate_limited += 1
+        self._consecutive_rate_limits += 1
+        if retry_after is None:
+            retry_after = min(MAX_BACKOFF_SECONDS, 2 ** self._consecutive_rate_limits)
+        delay = retry_after * random.uniform(1.0, 1.25) # Jitter so workers do not retry in lockstep
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+
+def content_sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def load_completed_documents(output_path):
+    """Reads an existing JSONL result file: {document name: content sha256} of documents that succeeded."""
+    completed = {}
+    if not Path(output_path).exists():
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError: # Line cut off by an interrupted run
+                continue
+            if record.get('status') == 'ok':
+                completed[record['document']] = record.get('sha256')
+            else:
+                completed.pop(record.get('document'), None)
+    return completed
+
+async def request_json_completion(client, limiter, request_slots, cache, model, messages, prompt_template, params,
+                                  max_retries, stats, parse, task, max_output_tokens=1024):
+    """
+    One JSON-mode chat completion: from the response cache, or from the API within the rate
+    limiter and the in-flight slots, with retries. parse(content) turns the answer into the result
+    and raises ValueError on a malformed answer, which is then not cached. Returns (result, tokens used).
+    """
+    cache_key = make_cache_key(model, prompt_template, params, messages)
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        stats['cache_hits'] += 1
+        return parse(cached), 0
+
+    estimated_tokens = estimate_tokens(''.join(m['content'] for m in messages), model) + max_output_tokens
+    for attempt in range(max_retries + 1):
+        try:
+            async with request_slots: # Bounds the requests in flight across all documents and chunks
+                entry = await limiter.acquire(estimated_tokens)
+                stats['requests'] += 1
+                response = await client.chat.completions.create(model=model, messages=messages, **params)
+        except Exception as e:
+            if not is_retryable_error(e) or attempt == max_retries:
+                raise
+            if error_status(e) == 429:
+                delay = limiter.rate_limit_hit(retry_after_seconds(e))
+                logger.warning(f"Rate limited (429); pausing all requests for {delay:.1f}s (attempt {attempt + 1}/{max_retries}).")
+            else:
+                delay = min(MAX_BACKOFF_SECONDS, 2 ** attempt) * random.uniform(1.0, 1.25)
+                logger.warning(f"Retryable API error ({type(e).__name__}: {e}); retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries}).")
+                await asyncio.sleep(delay)
+            continue
+        usage = getattr(response, 'usage', None)
+        used_tokens = getattr(usage, 'total_tokens', 0) or 0
+        limiter.settle(entry, used_tokens)
+        content = response.choices[0].message.content
+        result = parse(content) # Malformed answers raise and are not cached
+        if cache is not None:
+            cache.put(cache_key, content, metadata={'model': model, 'task': task})
+        return result, used_tokens
+
+async def extract_chunk_entities(client, limiter, request_slots, cache, model, text, entity_definitions, max_retries, stats):
+    """Entities of one chunk: from the response cache, or from the API with retries. Returns (entities, tokens used)."""
+    return await request_json_completion(
+        client, limiter, request_slots, cache, model, build_ner_messages(text, entity_definitions), NER_PROMPT_TEMPLATE,
+        {'temperature': 0.2, 'response_format': {"type": "json_object"}}, max_retries, stats,
+        lambda content: parse_ner_response(content, entity_definitions), task='ner')
+
+async def extract_document_entities(client, limiter, request_slots, cache, model, text, entity_definitions, max_retries,
+                                    stats, chunk_tokens=3000, chunk_overlap_tokens=200):
+    """
+    Entities of one document with document character offsets ({type: [{"text", "start", "end"}]}),
+    extracted from its chunks in parallel. Fails if any chunk fails, so no part of a document is
+    silently left out. Returns (entities, tokens used, number of chunks).
+    """
+    chunks = chunk_text(text, chunk_tokens, chunk_overlap_tokens, model)
+    results = await asyncio.gather(*(
+        extract_chunk_entities(client, limiter, request_slots, cache, model, chunk.text, entity_definitions, max_retries, stats)
+        for chunk in chunks))
+    entities = merge_chunk_entities(text, chunks, [chunk_entities for chunk_entities, _ in results])
+    return entities, sum(tokens for _, tokens in results), len(chunks)
+
+async def run_batch_ner(client, input_dir, output_path, model="gpt-3.5-turbo", entity_definitions=ENTITY_DEFINITIONS,
+                        max_in_flight=8, requests_per_minute=500, tokens_per_minute=200000, max_retries=6,
+                        cache=None, limit=None, chunk_tokens=3000, chunk_overlap_tokens=200):
+    """
+    Extracts entities from every *_processed.txt in input_dir and appends one JSON record per
+    document to output_path: {"document", "sha256", "model", "status": "ok", "chunks", "tokens",
+    "entities": {type: [{"text", "start", "end"}]}}, or {"status": "failed", "error"}.
+    Documents already in output_path with the same text are skipped. Documents longer than
+    chunk_tokens are split into overlapping chunks. client is an openai.AsyncOpenAI (or compatible)
+    client. Returns a summary dict.
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    documents = sorted(p for p in Path(input_dir).glob("*_processed.txt") if p.is_file() and p.stat().st_size > 0)
+    if limit:
+        documents = documents[:limit]
+    completed = load_completed_documents(output_path)
+
+    stats = collections.Counter()
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    request_slots = asyncio.Semaphore(max(1, max_in_flight))
+    queue = asyncio.Queue()
+    for document in documents:
+        queue.put_nowait(document)
+    start = time.monotonic()
+    logger.info(f"Batch NER over {len(documents)} documents in {input_dir} ({len(completed)} already in {output_path.name}); "
+                f"{max_in_flight} requests in flight, {requests_per_minute} RPM / {tokens_per_minute} TPM budget, model {model}.")
+
+    with open(output_path, 'a', encoding='utf-8') as sink:
+        async def worker():
+            while True:
+                try:
+                    document = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                text = await asyncio.to_thread(document.read_text, encoding='utf-8')
+                sha256 = content_sha256(text)
+                if completed.get(document.name) == sha256:
+                    stats['skipped'] += 1
+                    continue
+                record = {'document': document.name, 'sha256': sha256, 'model': model}
+                try:
+                    entities, tokens, num_chunks = await extract_document_entities(
+                        client, limiter, request_slots, cache, model, text, entity_definitions, max_retries, stats,
+                        chunk_tokens, chunk_overlap_tokens)
+                    record.update(status='ok', chunks=num_chunks, tokens=tokens, entities=entities)
+                    stats['ok'] += 1
+                    stats['chunks'] += num_chunks
+                    stats['tokens'] += tokens
+                except Exception as e:
+                    logger.error(f"NER failed for {document.name}: {type(e).__name__}: {e}")
+                    record.update(status='failed', error=f"{type(e).__name__}: {e}")
+                    stats['failed'] += 1
+                # One whole line per document, flushed at once: an interrupted run loses at most the documents in flight
+                sink.write(json.dumps(record, ensure_ascii=False) + '\n')
+                sink.flush()
+                finished = stats['ok'] + stats['failed']
+                if finished % 100 == 0:
+                    elapsed = time.monotonic() - start
+                    logger.info(f"{finished}/{len(documents) - stats['skipped']} documents done "
+                                f"({finished / elapsed * 60:.0f}/min, {stats['tokens'] / elapsed * 60:.0f} tokens/min).")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, max_in_flight))))
+
+    elapsed = time.monotonic() - start
+    summary = {
+        'documents': len(documents), 'ok': stats['ok'], 'failed': stats['failed'], 'skipped': stats['skipped'],
+        'chunks': stats['chunks'], 'requests': stats['requests'], 'rate_limited': limiter.rate_limited, 'cache_hits': stats['cache_hits'],
+        'tokens': stats['tokens'], 'seconds': elapsed,
+    }
+    logger.info(f"Batch NER finished in {elapsed:.1f}s: {summary['ok']} ok, {summary['failed']} failed, "
+                f"{summary['skipped']} already done; {summary['chunks']} chunks, {summary['requests']} requests ({summary['rate_limited']} rate-limited), "
+                f"{summary['cache_hits']} cache hits, {summary['tokens']} tokens. Results: {output_path}")
+    if cache is not None:
+        cache.log_stats()
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Named entity recognition over all processed texts with the OpenAI API.")
+    parser.add_argument('--input-dir', type=Path, help="Directory of *_processed.txt files (default: the processed text directory)")
+    parser.add_argument('--output', type=Path, help="JSONL result file (default: ner_output_file in [OpenAI])")
+    parser.add_argument('--model', help="Model (default: ner_model in [OpenAI])")
+    parser.add_argument('--base-url', help="API base URL, e.g. http://localhost:8000/v1 for a local mock server")
+    parser.add_argument('--limit', type=int, help="Only process the first N documents")
+    args = parser.parse_args()
+
+    config = load_config()
+    default_config = config['DEFAULT']
+    text_config = config['TextualData']
+    openai_config = config['OpenAI']
+    script_dir = Path(__file__).resolve().parent
+    logger = setup_logging((script_dir / default_config.get('log_dir', '../../logs')).resolve(),
+                           text_config.get('text_pipeline_log_file_name',
+                                           default_config.get('text_pipeline_log_file_name', 'text_pipeline.log')))
+
+    base_processed_dir = script_dir / default_config.get('base_processed_data_dir', '../../data')
+    input_dir = args.input_dir or (base_processed_dir / text_config.get('text_processed_suffix', 'textual/processed')).resolve()
+    output_path = args.output or (base_processed_dir / openai_config.get('ner_output_file', 'textual/ner/entities.jsonl')).resolve()
+
+    from openai import AsyncOpenAI # Only needed when running against the API (or a mock server)
+    client = AsyncOpenAI(base_url=args.base_url or openai_config.get('api_base_url') or None, max_retries=0)
+    asyncio.run(run_batch_ner(
+        client, input_dir, output_path, model=args.model or openai_config.get('ner_model', 'gpt-3.5-turbo'),
+        max_in_flight=openai_config.getint('max_in_flight', 8),
+        requests_per_minute=openai_config.getint('requests_per_minute', 500),
+        tokens_per_minute=openai_config.getint('tokens_per_minute', 200000),
+        max_retries=openai_config.getint('max_retries', 6),
+        cache=response_cache_from_config(config, script_dir.parent.parent), limit=args.limit,
+        chunk_tokens=openai_config.getint('chunk_tokens', 3000),
+        chunk_overlap_tokens=openai_config.getint('chunk_overlap_tokens', 200)))
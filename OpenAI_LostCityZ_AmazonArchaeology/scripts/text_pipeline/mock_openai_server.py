@@ -0,0 +1,137 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI chat completions endpoint, for exercising batch_ner.py (and the other
+# OpenAI clients of the text pipeline) without an API key or cost. It enforces its own
+# requests-per-minute limit with 429 + Retry-After responses, can inject random 500 errors and
+# latency, and answers NER prompts with the capitalised phrases of the text as PLACE_NAME entities,
+# theme prompts with the most frequent capitalised phrases as themes, and merge prompts by theme name.
+# Usage: python mock_openai_server.py --port 8000 --rpm 120 --error-rate 0.05
+#        python batch_ner.py --base-url http://localhost:8000/v1   (with OPENAI_API_KEY set to any value)
+
+ENTITY_TYPES_PATTERN = re.compile(r"Desired entity types: (.+)")
+TEXT_PATTERN = re.compile(r"--- --- --- --- ---\n(.*)\n--- --- --- --- ---", re.DOTALL)
+CAPITALISED_PHRASE_PATTERN = re.compile(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+)*\b")
+INPUT_THEME_PATTERN = re.compile(r"^(T\d+): (.+?) \(keywords:", re.MULTILINE)
+
+
+def mock_completion_content(messages):
+    """Deterministic JSON answer for a chat request: entities for NER prompts, themes for theme prompts, an echo otherwise."""
+    prompt = messages[-1].get('content', '') if messages else ''
+    types_match = ENTITY_TYPES_PATTERN.search(prompt)
+    if types_match:
+        entity_types = [t.strip() for t in types_match.group(1).split(',')]
+        text_match = TEXT_PATTERN.search(prompt)
+        phrases = CAPITALISED_PHRASE_PATTERN.findall(text_match.group(1)) if text_match else []
+        return json.dumps({etype: (phrases if i == 0 else []) for i, etype in enumerate(entity_types)})
+    input_themes = INPUT_THEME_PATTERN.findall(prompt)
+    if input_themes: # Reduce step of thematic_summary.py: merge themes with the same name
+        merged = {}
+        for theme_id, name in input_themes:
+            merged.setdefault(name, []).append(theme_id)
+        return json.dumps({'themes': [{'theme_name': name, 'keywords': name.lower().split(), 'source_ids': ids}
+                                      for name, ids in merged.items()]})
+    if '"themes"' in prompt: # Map step of thematic_summary.py
+        text_match = TEXT_PATTERN.search(prompt)
+        phrases = Counter(CAPITALISED_PHRASE_PATTERN.findall(text_match.group(1)) if text_match else [])
+        return json.dumps({'themes': [{'theme_name': phrase, 'keywords': phrase.lower().split()}
+                                      for phrase, _ in phrases.most_common(3)]})
+    return json.dumps({'mock': True, 'prompt_characters': len(prompt)})
+
+
+class MockState:
+    def __init__(self, rpm, error_rate, latency):
+        self.rpm = rpm
+        self.error_rate = error_rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.counts = {'ok': 0, 'rate_limited': 0, 'errors': 0}
+
+    def admit(self):
+        """Returns (True, 0) if the request is within the RPM limit, else (False, seconds until a slot frees)."""
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            if self.rpm and len(self.recent) >= self.rpm:
+                self.counts['rate_limited'] += 1
+                return False, 60 - (now - self.recent[0])
+            self.recent.append(now)
+            return True, 0
+
+
+def make_handler(state):
+    class MockHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            admitted, retry_after = state.admit()
+            if not admitted:
+                self._send_json(429, {'error': {'message': 'Rate limit reached (mock)', 'type': 'rate_limit_error'}},
+                                {'Retry-After': f"{retry_after:.2f}"})
+                return
+            if state.latency:
+                time.sleep(random.uniform(0.5, 1.5) * state.latency)
+            if random.random() < state.error_rate:
+                with state.lock:
+                    state.counts['errors'] += 1
+                self._send_json(500, {'error': {'message': 'Injected server error (mock)', 'type': 'server_error'}})
+                return
+            messages = request.get('messages', [])
+            content = mock_completion_content(messages)
+            prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4 + 1
+            completion_tokens = len(content) // 4 + 1
+            with state.lock:
+                state.counts['ok'] += 1
+            self._send_json(200, {
+                'id': f"chatcmpl-mock-{state.counts['ok']}", 'object': 'chat.completion', 'created': int(time.time()),
+                'model': request.get('model', 'mock'),
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens},
+            })
+
+        def log_message(self, format, *args): # Keep the console for the summary
+            pass
+
+    return MockHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server with rate limiting and error injection.")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on (default: 8000)")
+    parser.add_argument('--rpm', type=int, default=60, help="Requests per minute before answering 429 (0 = unlimited, default: 60)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with a 500 error")
+    parser.add_argument('--latency', type=float, default=0.2, help="Mean response latency in seconds (default: 0.2)")
+    args = parser.parse_args()
+
+    state = MockState(args.rpm, args.error_rate, args.latency)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(state))
+    print(f"Mock OpenAI server on http://127.0.0.1:{args.port}/v1 ({args.rpm or 'unlimited'} RPM, "
+          f"{args.error_rate:.0%} errors). Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Requests: {state.counts['ok']} ok, {state.counts['rate_limited']} rate-limited (429), {state.counts['errors']} errors (500).")
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+# Persistent on-disk cache for OpenAI responses (NER, thematic summaries, ...).
+# A response is stored under a key made of the model, the prompt template, the request parameters
+# (temperature, response format, ...) and the SHA-256 of the content sent, so re-running a notebook
+# or script returns cached answers instantly and only new or changed documents reach the API.
+# One JSON file per entry (sharded by key prefix) keeps writes atomic and safe across processes.
+# The cache is bounded by size: when it grows past max_size_mb the least recently used entries
+# (by file mtime, refreshed on every hit) are evicted.
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+
+
+def content_hash(content):
+    """SHA-256 of a string, or of the canonical JSON of any other JSON-serializable content (e.g. a message list)."""
+    if not isinstance(content, str):
+        content = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def make_cache_key(model, prompt_template, params, content):
+    """Cache key for one request: model, prompt template, parameters and content hash."""
+    payload = json.dumps({
+        'version': CACHE_FORMAT_VERSION, 'model': model, 'template': content_hash(prompt_template),
+        'params': params or {}, 'content': content_hash(content),
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Size-bounded on-disk response cache with hit/miss statistics.
+    With enabled=False every lookup is a miss and nothing is stored, so callers need no special case.
+    """
+    def __init__(self, cache_dir, max_size_mb=512, enabled=True):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size_bytes = 0
+        if self.enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._size_bytes = sum(p.stat().st_size for p in self._entry_paths())
+
+    def _entry_paths(self):
+        return self.cache_dir.glob('*/*.json')
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """Returns the cached response for key, or None. A hit marks the entry as recently used."""
+        if not self.enabled:
+            with self._lock:
+                self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path) # LRU: eviction removes the entries with the oldest mtime
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry['response']
+
+    def put(self, key, response, metadata=None):
+        """Stores a JSON-serializable response under key (atomically) and evicts old entries if over size."""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        entry = {'key': key, 'created': time.time(), 'metadata': metadata or {}, 'response': response}
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        previous_size = path.stat().st_size if path.exists() else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size_bytes += path.stat().st_size - previous_size
+            over_limit = self._size_bytes > self.max_size_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache is at 90% of max_size_mb."""
+        with self._lock:
+            entries = []
+            for entry_path in self._entry_paths():
+                try:
+                    stat = entry_path.stat()
+                except FileNotFoundError: # Removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+            self._size_bytes = sum(size for _, size, _ in entries)
+            target = self.max_size_bytes * 0.9
+            for _, size, entry_path in sorted(entries, key=lambda e: e[0]):
+                if self._size_bytes <= target:
+                    break
+                entry_path.unlink(missing_ok=True)
+                self._size_bytes -= size
+                self.evictions += 1
+
+    def get_or_call(self, model, prompt_template, params, content, call, metadata=None, validate=None):
+        """
+        Returns the cached response for (model, prompt_template, params, content), or calls
+        call() (which must return a JSON-serializable response), caches and returns its result.
+        Failed calls (exceptions) and responses rejected by validate(response) are not cached,
+        so a retry asks the API again.
+        """
+        key = make_cache_key(model, prompt_template, params, content)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        response = call()
+        if validate is None or validate(response):
+            self.put(key, response, metadata)
+        return response
+
+    @property
+    def stats(self):
+        """Hit/miss statistics of this cache object plus the current size on disk."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions, 'size_mb': self._size_bytes / (1024 * 1024),
+            'entries': sum(1 for _ in self._entry_paths()) if self.enabled else 0,
+        }
+
+    def log_stats(self):
+        stats = self.stats
+        logger.info(f"OpenAI response cache: {stats['hits']} hits, {stats['misses']} misses "
+                    f"({stats['hit_rate']:.0%} hit rate), {stats['evictions']} evicted, "
+                    f"{stats['entries']} entries / {stats['size_mb']:.1f} MB in {self.cache_dir}")
+
+    def clear(self):
+        """Removes every cached response."""
+        for entry_path in self._entry_paths():
+            entry_path.unlink(missing_ok=True)
+        with self._lock:
+            self._size_bytes = 0
+
+
+def cached_chat_completion(client, cache, model, messages, prompt_template, validate=None, **params):
+    """
+    Chat completion through the cache: returns the message content (str) for the given messages,
+    calling client.chat.completions.create(model=..., messages=..., **params) only on a cache miss.
+    prompt_template identifies the prompt version (e.g. the unformatted template string), so editing
+    a prompt invalidates its entries while unchanged prompts keep hitting the cache.
+    """
+    def call():
+        response = client.chat.completions.create(model=model, messages=messages, **params)
+        return response.choices[0].message.content
+    return cache.get_or_call(model, prompt_template, params, messages, call,
+                             metadata={'model': model, 'params': params}, validate=validate)
+
+def is_json_response(content):
+    """validate= helper for JSON-mode requests: only cache responses that parse as JSON."""
+    try:
+        json.loads(content)
+    except (TypeError, json.JSONDecodeError):
+        return False
+    return True
+
+
+def response_cache_from_config(app_config, project_root):
+    """Builds the ResponseCache configured in the [OpenAI] section (paths relative to the project root)."""
+    openai_config = app_config['OpenAI'] if app_config.has_section('OpenAI') else app_config['DEFAULT']
+    cache_dir = Path(openai_config.get('response_cache_dir', 'data/textual/openai_cache'))
+    if not cache_dir.is_absolute():
+        cache_dir = Path(project_root) / cache_dir
+    return ResponseCache(cache_dir, openai_config.getfloat('response_cache_max_mb', 512),
+                         openai_config.getboolean('response_cache_enabled', True))
@@ -3,20 +3,27 @@ import logging
 import os
 import re
 import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from pdfminer.high_level import extract_text as pdfminer_extract_text
 from pdfminer.layout import LAParams
 import ftfy
-from langdetect import detect as langdetect_detect, LangDetectException
+from langdetect import DetectorFactory, detect as langdetect_detect, LangDetectException
 import shutil # For checking tesseract path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # scripts/ for the shared utils package
+from utils.build_cache import BuildCache, code_version
+
 # Attempt to import OCR related libraries, but don't make them hard dependencies
 try:
     import pytesseract
     from PIL import Image
     # pdf2image is often used to convert PDF pages to images for OCR
     # It requires poppler installed on the system
-    from pdf2image import convert_from_path as pdf2image_convert
+    from pdf2image import convert_from_path as pdf2image_convert, pdfinfo_from_path
     OCR_CAPABLE = True
 except ImportError:
     OCR_CAPABLE = False
@@ -24,8 +31,10 @@ except ImportError:
 
 
 # --- Configuration and Logging Setup ---
-CONFIG_FILE_PATH = "../satellite_pipeline/config.ini" # Assuming shared config
+CONFIG_FILE_PATH = "../../config/config.ini" # Shared config, relative to the script directory (the working directory)
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__) # Module level, so pool workers (which do not run __main__) can log
+DetectorFactory.seed = 0 # langdetect is randomized; a fixed seed gives the same language in every run and worker
 
 def setup_logging(log_dir_path, log_file_name):
     Path(log_dir_path).mkdir(parents=True, exist_ok=True)
@@ -64,40 +73,85 @@ def extract_text_from_pdf_native(pdf_path, output_txt_path):
         logger.error(f"pdfminer.six failed to extract text from {pdf_path.name}: {e}", exc_info=True)
         return False
 
-def extract_text_from_pdf_ocr(pdf_path, output_txt_path, tesseract_cmd, ocr_langs, dpi, ocr_intermediate_dir):
-    """Extracts text from a PDF using OCR (Tesseract)."""
+def init_ocr_worker(tesseract_cmd):
+    """Process-pool initializer: points pytesseract at the Tesseract binary in each worker."""
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    # One Tesseract thread per worker; parallelism comes from the pool, not from OpenMP inside each page
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+def ocr_page_image(page_number, image_path, ocr_langs):
+    """
+    Pool worker: OCRs one rendered page image and deletes it.
+    Returns (page_number, text, error message or None); errors are logged by the caller.
+    """
+    try:
+        return page_number, pytesseract.image_to_string(str(image_path), lang=ocr_langs), None
+    except pytesseract.TesseractError as te:
+        return page_number, None, f"Tesseract error: {te}"
+    except Exception as e_img:
+        return page_number, None, f"Error processing image {Path(image_path).name} for OCR: {e_img}"
+    finally:
+        if Path(image_path).exists(): # Clean up intermediate image file
+            Path(image_path).unlink()
+
+def extract_text_from_pdf_ocr(pdf_path, output_txt_path, tesseract_cmd, ocr_langs, dpi, ocr_intermediate_dir,
+                              ocr_workers=1, render_batch_pages=8):
+    """
+    Extracts text from a PDF using OCR (Tesseract).
+    Pages are rendered render_batch_pages at a time and OCR'd in parallel by ocr_workers processes;
+    the next batch is rendered while the previous one is being OCR'd, so at most two batches of page
+    images are on disk. Page texts are joined in page order regardless of completion order.
+    """
     if not OCR_CAPABLE:
         logger.error(f"OCR libraries (pytesseract, Pillow, pdf2image) not available. Cannot OCR {pdf_path.name}.")
         return False
     if tesseract_cmd and Path(tesseract_cmd).is_file():
-        pytesseract.tesseract_cmd = tesseract_cmd
+        resolved_tesseract_cmd = tesseract_cmd
     elif shutil.which("tesseract"): # Check if tesseract is in PATH
-         pytesseract.tesseract_cmd = "tesseract"
+        resolved_tesseract_cmd = "tesseract"
     else:
         logger.error("Tesseract OCR command not found or configured. Please set 'tesseract_cmd_path' in config or ensure Tesseract is in system PATH.")
         return False
 
+    if ocr_workers <= 0:
+        ocr_workers = os.cpu_count() or 1
+    render_batch_pages = max(1, render_batch_pages)
+
     try:
-        logger.info(f"Attempting OCR for PDF: {pdf_path.name} using languages: {ocr_langs}, DPI: {dpi}")
+        num_pages = pdfinfo_from_path(pdf_path)["Pages"]
+        logger.info(f"Attempting OCR for PDF: {pdf_path.name} ({num_pages} pages) using languages: {ocr_langs}, DPI: {dpi}, "
+                    f"{ocr_workers} workers, {render_batch_pages} pages per render batch")
         Path(ocr_intermediate_dir).mkdir(parents=True, exist_ok=True)
-        
-        # Convert PDF to list of images
-        images = pdf2image_convert(pdf_path, dpi=dpi, output_folder=ocr_intermediate_dir, fmt='png', thread_count=2) # thread_count can be tuned
-        
-        full_text_content = []
-        for i, image_path in enumerate(images): # images is a list of Path objects to the temp image files
-            logger.info(f"OCR processing page {i+1} of {len(images)} for {pdf_path.name} (image: {Path(image_path).name})")
-            try:
-                page_text = pytesseract.image_to_string(Image.open(image_path), lang=ocr_langs)
-                full_text_content.append(page_text)
-            except pytesseract.TesseractError as te:
-                logger.error(f"Tesseract error on page {i+1} of {pdf_path.name}: {te}")
-            except Exception as e_img:
-                logger.error(f"Error processing image {Path(image_path).name} for OCR: {e_img}")
-            finally:
-                if Path(image_path).exists(): # Clean up intermediate image file
-                    Path(image_path).unlink()
-        
+
+        page_texts = {}
+        pending_batches = deque()
+
+        def collect_batch(batch_futures):
+            for future in batch_futures:
+                page_number, page_text, error = future.result()
+                if error:
+                    logger.error(f"Page {page_number} of {pdf_path.name}: {error}")
+                else:
+                    page_texts[page_number] = page_text
+            logger.info(f"OCR progress for {pdf_path.name}: {len(page_texts)}/{num_pages} pages")
+
+        with ProcessPoolExecutor(max_workers=ocr_workers, initializer=init_ocr_worker,
+                                 initargs=(resolved_tesseract_cmd,)) as executor:
+            for first_page in range(1, num_pages + 1, render_batch_pages):
+                last_page = min(num_pages, first_page + render_batch_pages - 1)
+                # Render only this page range to disk (paths only, images are not loaded here)
+                image_paths = pdf2image_convert(pdf_path, dpi=dpi, output_folder=ocr_intermediate_dir, fmt='png',
+                                                first_page=first_page, last_page=last_page,
+                                                output_file=f"{pdf_path.stem}_p{first_page:05d}_",
+                                                paths_only=True, thread_count=1)
+                pending_batches.append([executor.submit(ocr_page_image, first_page + i, image_path, ocr_langs)
+                                        for i, image_path in enumerate(image_paths)])
+                if len(pending_batches) > 1: # Keep one batch in flight while the next one renders
+                    collect_batch(pending_batches.popleft())
+            while pending_batches:
+                collect_batch(pending_batches.popleft())
+
+        full_text_content = [page_texts[page_number] for page_number in sorted(page_texts)]
         if not full_text_content:
             logger.warning(f"OCR processing yielded no text for {pdf_path.name}.")
             # Create an empty .txt file to mark as processed
@@ -161,6 +215,196 @@ def identify_language(text_content):
         return None
 
 
+# --- Per-Document Processing ---
+# Each raw file is handled by handle_raw_file, either in the main process (preprocess_workers = 1) or
+# in a process pool with one document per task (pdfminer, ftfy and langdetect are pure Python and
+# CPU-bound, so documents scale with cores). Every file is isolated: any failure, including an
+# unexpected exception or a crashed worker, leaves empty processed/lang files behind so the file
+# counts as processed-with-error and is not retried until its raw file or the settings change.
+
+def mark_failed(processed_txt_final_path, lang_file_path, raw_file_path, settings):
+    """Creates empty processed and lang files to mark a raw file as "processed" with error."""
+    processed_txt_final_path.touch()
+    lang_file_path.touch()
+    settings['build_cache'].record(processed_txt_final_path, [raw_file_path], settings['build_params'],
+                                   settings['code_version'])
+
+def output_paths(raw_file_path, processed_texts_dir):
+    """(processed text path, lang path) for a raw file."""
+    output_base_name = raw_file_path.stem.replace("_raw", "") # If it was _raw.html
+    return (processed_texts_dir / f"{output_base_name}_processed.txt",
+            processed_texts_dir / f"{output_base_name}_processed.lang")
+
+def process_raw_file(raw_file_path, settings):
+    """
+    Extracts (PDF), cleans and language-tags one raw file. Returns (status, detail) with status
+    'processed' (detail: number of cleaned characters), 'up_to_date', 'failed' or 'skipped'
+    (detail: reason or None).
+    """
+    processed_texts_dir = settings['processed_texts_dir']
+    build_cache = settings['build_cache']
+    output_base_name = raw_file_path.stem.replace("_raw", "")
+    # Path for the text file that will be cleaned (either from PDF or already .txt)
+    text_to_clean_path = None
+    # Path for the final processed (cleaned) text file
+    processed_txt_final_path, lang_file_path = output_paths(raw_file_path, processed_texts_dir)
+
+    if not settings['force_reprocess_processed'] and lang_file_path.exists() and \
+            build_cache.is_current(processed_txt_final_path, [raw_file_path], settings['build_params'], settings['code_version']):
+        logger.info(f"Processed file {processed_txt_final_path.name} and lang file are up to date. Skipping.")
+        return 'up_to_date', None
+
+    # PDF Processing
+    if raw_file_path.suffix.lower() == '.pdf':
+        # This is the .txt file derived from PDF, placed in processed_dir before cleaning
+        intermediate_pdf_extracted_txt_path = processed_texts_dir / f"{output_base_name}_pdfextract.txt"
+
+        extraction_done = False
+        pdf_extract_method = settings['pdf_extract_method']
+        if pdf_extract_method == 'native':
+            extraction_done = extract_text_from_pdf_native(raw_file_path, intermediate_pdf_extracted_txt_path)
+        elif pdf_extract_method == 'ocr_only':
+            if not OCR_CAPABLE:
+                logger.error("OCR method selected but OCR libraries are not available.")
+                return 'skipped', "OCR libraries not available"
+            extraction_done = extract_text_from_pdf_ocr(raw_file_path, intermediate_pdf_extracted_txt_path,
+                                                        settings['tesseract_cmd'], settings['ocr_langs'],
+                                                        settings['pdf_ocr_dpi'], settings['ocr_intermediate_dir'],
+                                                        settings['ocr_workers'], settings['ocr_render_batch_pages'])
+        else: # Default to native if method unknown
+            logger.warning(f"Unknown pdf_extraction_method '{pdf_extract_method}'. Defaulting to 'native'.")
+            extraction_done = extract_text_from_pdf_native(raw_file_path, intermediate_pdf_extracted_txt_path)
+
+        if extraction_done and intermediate_pdf_extracted_txt_path.exists():
+            text_to_clean_path = intermediate_pdf_extracted_txt_path
+        else:
+            logger.error(f"Failed to extract text from PDF {raw_file_path.name}. Skipping further processing for this file.")
+            mark_failed(processed_txt_final_path, lang_file_path, raw_file_path, settings)
+            return 'failed', "PDF text extraction failed"
+
+    # TXT file (either original .txt or .txt extracted from HTML by acquire_texts.py)
+    elif raw_file_path.suffix.lower() == '.txt':
+        text_to_clean_path = raw_file_path
+
+    else: # Other raw file types not directly processed (e.g. _raw.html)
+        logger.info(f"Skipping non-PDF/non-TXT file in raw directory: {raw_file_path.name}")
+        return 'skipped', None
+
+    # --- Cleaning and Language ID for the text_to_clean_path ---
+    if not (text_to_clean_path and text_to_clean_path.exists()):
+        logger.warning(f"No text content found to process for base name: {output_base_name} (derived from {raw_file_path.name})")
+        mark_failed(processed_txt_final_path, lang_file_path, raw_file_path, settings)
+        return 'failed', "no text content"
+
+    logger.info(f"Processing text file for cleaning: {text_to_clean_path.name}")
+    try:
+        with open(text_to_clean_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except Exception as e:
+        logger.error(f"Could not read text file {text_to_clean_path.name}: {e}. Skipping.")
+        mark_failed(processed_txt_final_path, lang_file_path, raw_file_path, settings)
+        return 'failed', f"unreadable text: {e}"
+
+    cleaned_content = clean_text_content(content, settings['clean_lowercase'], settings['custom_patterns'])
+
+    with open(processed_txt_final_path, 'w', encoding='utf-8') as f:
+        f.write(cleaned_content)
+    logger.info(f"Saved cleaned text to: {processed_txt_final_path.name}")
+
+    language = identify_language(cleaned_content[:5000]) # Detect on first 5k chars
+    if language:
+        with open(lang_file_path, 'w', encoding='utf-8') as f:
+            f.write(language)
+        logger.info(f"Identified language '{language}' for {processed_txt_final_path.name} and saved to {lang_file_path.name}")
+    else:
+        logger.warning(f"Could not identify language for {processed_txt_final_path.name}. Lang file not created.")
+        if lang_file_path.exists(): lang_file_path.unlink() # Remove if exists from previous failed run
+    build_cache.record(processed_txt_final_path, [raw_file_path], settings['build_params'], settings['code_version'])
+
+    # Clean up intermediate PDF extracted text file if it's different from raw .txt file
+    if text_to_clean_path != raw_file_path and text_to_clean_path.exists() and text_to_clean_path.name.endswith("_pdfextract.txt"):
+        logger.info(f"Removing intermediate PDF extracted text: {text_to_clean_path.name}")
+        text_to_clean_path.unlink()
+    return 'processed', len(cleaned_content)
+
+def handle_raw_file(raw_file_path, settings):
+    """
+    Runs process_raw_file with per-file error isolation and timing. Returns a result dict:
+    name, status, detail, input_bytes, output_chars, seconds (wall time) and cpu_seconds
+    (CPU time of this process; OCR subprocesses are not included).
+    """
+    logger.info(f"Found raw file: {raw_file_path.name}")
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        status, detail = process_raw_file(raw_file_path, settings)
+    except Exception as e:
+        logger.error(f"Unexpected error while processing {raw_file_path.name}: {e}", exc_info=True)
+        status, detail = 'failed', f"unexpected error: {e}"
+        try:
+            mark_failed(*output_paths(raw_file_path, settings['processed_texts_dir']), raw_file_path, settings)
+        except OSError as e_mark:
+            logger.error(f"Could not mark {raw_file_path.name} as processed with error: {e_mark}")
+    output_chars = detail if status == 'processed' else 0
+    return {'name': raw_file_path.name, 'status': status, 'detail': None if status == 'processed' else detail,
+            'input_bytes': raw_file_path.stat().st_size if raw_file_path.exists() else 0,
+            'output_chars': output_chars, 'seconds': time.perf_counter() - start,
+            'cpu_seconds': time.process_time() - cpu_start}
+
+def init_preprocess_worker(log_dir_path, log_file_name):
+    """Process pool initializer: spawned (not forked) workers start without logging."""
+    if not logging.getLogger().hasHandlers():
+        setup_logging(log_dir_path, log_file_name)
+
+def run_in_pool(raw_file_paths, settings, num_workers, log_dir_path, log_file_name):
+    """
+    Runs handle_raw_file for raw_file_paths in a process pool. Returns (results, crashed) where
+    crashed maps each file whose task raised in the pool (not in handle_raw_file) to the error.
+    """
+    results = []
+    crashed = {}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_preprocess_worker,
+                             initargs=(log_dir_path, log_file_name)) as executor:
+        futures = {executor.submit(handle_raw_file, raw_file_path, settings): raw_file_path
+                   for raw_file_path in raw_file_paths}
+        for future in as_completed(futures):
+            raw_file_path = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                crashed[raw_file_path] = e
+    if crashed:
+        names = sorted(path.name for path in crashed)
+        logger.error(f"Worker failed ({next(iter(crashed.values()))}); {len(crashed)} file(s) did not finish: "
+                     f"{', '.join(names[:10])}{' ...' if len(names) > 10 else ''}")
+    return results, crashed
+
+def log_run_summary(results, elapsed_seconds, num_workers):
+    """Logs the end-of-run counts and throughput report, and the list of failed files."""
+    if not results:
+        logger.info("No raw text files found in this run.")
+        return
+    by_status = {status: [r for r in results if r['status'] == status]
+                 for status in ('processed', 'up_to_date', 'failed', 'skipped')}
+    logger.info(f"Run summary: {len(results)} raw files in {elapsed_seconds:.1f}s with {num_workers} worker(s) - "
+                f"{len(by_status['processed'])} processed, {len(by_status['up_to_date'])} up to date, "
+                f"{len(by_status['failed'])} failed, {len(by_status['skipped'])} skipped.")
+    worked = by_status['processed'] + by_status['failed']
+    if worked:
+        cpu_seconds = sum(r['cpu_seconds'] for r in worked)
+        input_mb = sum(r['input_bytes'] for r in worked) / 1e6
+        output_chars = sum(r['output_chars'] for r in worked)
+        elapsed = max(elapsed_seconds, 1e-9)
+        logger.info(f"Throughput: {len(worked) / elapsed:.2f} documents/s, {input_mb / elapsed:.2f} MB/s of raw input "
+                    f"({input_mb:.1f} MB in, {output_chars / 1e6:.2f} M characters out); "
+                    f"{cpu_seconds:.1f} CPU seconds of per-document work, {cpu_seconds / elapsed:.1f} cores busy on average.")
+        slowest = sorted(worked, key=lambda r: r['seconds'], reverse=True)[:5]
+        logger.info("Slowest documents: " + ", ".join(f"{r['name']} ({r['seconds']:.1f}s)" for r in slowest))
+    for result in by_status['failed']:
+        logger.warning(f"  Failed: {result['name']} ({result['detail']})")
+
+
+
 # --- Main Execution ---
 if __name__ == "__main__":
     try:
@@ -173,7 +417,7 @@ if __name__ == "__main__":
             exit(1)
 
     default_config = config['DEFAULT']
-    text_config = config.get('TextualData')
+    text_config = config['TextualData'] if config.has_section('TextualData') else None
 
     if not text_config:
         print("FATAL: [TextualData] section not found in configuration file.")
@@ -217,108 +461,69 @@ if __name__ == "__main__":
     tesseract_cmd = text_config.get('tesseract_cmd_path', None)
     ocr_langs_conf = text_config.get('ocr_languages', 'eng')
     pdf_ocr_render_dpi = text_config.getint('pdf_ocr_dpi', 300)
+    ocr_workers = text_config.getint('ocr_workers', 0)
+    ocr_render_batch_pages = text_config.getint('ocr_render_batch_pages', 8)
+
+    # Incremental builds: a processed text is reused only if its raw file, these settings and this script are unchanged
+    build_cache = BuildCache(default_config.getboolean('incremental_builds', True))
+    text_build_params = {
+        'clean_text_to_lowercase': clean_lowercase,
+        'custom_remove_patterns_json': custom_patterns,
+        'pdf_extraction_method': pdf_extract_method,
+        'ocr_languages': ocr_langs_conf,
+        'pdf_ocr_dpi': pdf_ocr_render_dpi,
+    }
+    text_code_version = code_version(Path(__file__))
 
 
     # Determine which source files were marked as PDF_OCR during acquisition
     # This information isn't directly passed, so we rely on pdf_extraction_method or user knowledge
     # We iterate through raw_texts_dir content.
-
-    processed_count = 0
-    for raw_file_path in raw_texts_dir.iterdir():
-        if raw_file_path.is_dir() or raw_file_path.name.startswith('.'): # Skip directories and hidden files
-            continue
-
-        logger.info(f"Found raw file: {raw_file_path.name}")
-        output_base_name = raw_file_path.stem.replace("_raw", "") # If it was _raw.html
-        
-        # Path for the text file that will be cleaned (either from PDF or already .txt)
-        text_to_clean_path = None
-        # Path for the final processed (cleaned) text file
-        processed_txt_final_path = processed_texts_dir / f"{output_base_name}_processed.txt"
-        lang_file_path = processed_texts_dir / f"{output_base_name}_processed.lang"
-
-        if not force_reprocess_processed and processed_txt_final_path.exists() and lang_file_path.exists():
-            logger.info(f"Processed file {processed_txt_final_path.name} and lang file already exist. Skipping.")
-            processed_count +=1
-            continue
-
-        # PDF Processing
-        if raw_file_path.suffix.lower() == '.pdf':
-            # This is the .txt file derived from PDF, placed in processed_dir before cleaning
-            intermediate_pdf_extracted_txt_path = processed_texts_dir / f"{output_base_name}_pdfextract.txt"
-            
-            extraction_done = False
-            if pdf_extract_method == 'native':
-                extraction_done = extract_text_from_pdf_native(raw_file_path, intermediate_pdf_extracted_txt_path)
-            elif pdf_extract_method == 'ocr_only':
-                if not OCR_CAPABLE: logger.error("OCR method selected but OCR libraries are not available."); continue
-                extraction_done = extract_text_from_pdf_ocr(raw_file_path, intermediate_pdf_extracted_txt_path, 
-                                                            tesseract_cmd, ocr_langs_conf, pdf_ocr_render_dpi, 
-                                                            ocr_intermediate_dir_path)
-            else: # Default to native if method unknown
-                logger.warning(f"Unknown pdf_extraction_method '{pdf_extract_method}'. Defaulting to 'native'.")
-                extraction_done = extract_text_from_pdf_native(raw_file_path, intermediate_pdf_extracted_txt_path)
-
-            if extraction_done and intermediate_pdf_extracted_txt_path.exists():
-                text_to_clean_path = intermediate_pdf_extracted_txt_path
-            else:
-                logger.error(f"Failed to extract text from PDF {raw_file_path.name}. Skipping further processing for this file.")
-                # Create empty files to mark as "processed" with error
-                processed_txt_final_path.touch()
-                lang_file_path.touch()
-                continue
-        
-        # TXT file (either original .txt or .txt extracted from HTML by acquire_texts.py)
-        elif raw_file_path.suffix.lower() == '.txt':
-            text_to_clean_path = raw_file_path
-        
-        else: # Other raw file types not directly processed (e.g. _raw.html)
-            logger.info(f"Skipping non-PDF/non-TXT file in raw directory: {raw_file_path.name}")
-            continue
-
-        # --- Cleaning and Language ID for the text_to_clean_path ---
-        if text_to_clean_path and text_to_clean_path.exists():
-            logger.info(f"Processing text file for cleaning: {text_to_clean_path.name}")
-            try:
-                with open(text_to_clean_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except Exception as e:
-                logger.error(f"Could not read text file {text_to_clean_path.name}: {e}. Skipping.")
-                # Create empty files to mark as "processed" with error
-                processed_txt_final_path.touch()
-                lang_file_path.touch()
-                continue
-
-            cleaned_content = clean_text_content(content, clean_lowercase, custom_patterns)
-            
-            with open(processed_txt_final_path, 'w', encoding='utf-8') as f:
-                f.write(cleaned_content)
-            logger.info(f"Saved cleaned text to: {processed_txt_final_path.name}")
-
-            language = identify_language(cleaned_content[:5000]) # Detect on first 5k chars
-            if language:
-                with open(lang_file_path, 'w', encoding='utf-8') as f:
-                    f.write(language)
-                logger.info(f"Identified language '{language}' for {processed_txt_final_path.name} and saved to {lang_file_path.name}")
-            else:
-                logger.warning(f"Could not identify language for {processed_txt_final_path.name}. Lang file not created.")
-                if lang_file_path.exists(): lang_file_path.unlink() # Remove if exists from previous failed run
-
-            # Clean up intermediate PDF extracted text file if it's different from raw .txt file
-            if text_to_clean_path != raw_file_path and text_to_clean_path.exists() and text_to_clean_path.name.endswith("_pdfextract.txt"):
-                logger.info(f"Removing intermediate PDF extracted text: {text_to_clean_path.name}")
-                text_to_clean_path.unlink()
-            
-            processed_count +=1
-        else:
-            logger.warning(f"No text content found to process for base name: {output_base_name} (derived from {raw_file_path.name})")
-            # Create empty files to mark as "processed" with error
-            processed_txt_final_path.touch()
-            lang_file_path.touch()
-
-
-    if processed_count == 0:
-        logger.info("No new text files were processed in this run.")
+    raw_file_paths = sorted(p for p in raw_texts_dir.iterdir()
+                            if not p.is_dir() and not p.name.startswith('.')) # Skip directories and hidden files
+    num_workers = text_config.getint('preprocess_workers', 1)
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(raw_file_paths)))
+    if num_workers > 1 and pdf_extract_method == 'ocr_only':
+        # Documents already run in parallel: share the OCR workers between them instead of multiplying them
+        ocr_workers = max(1, (ocr_workers if ocr_workers > 0 else os.cpu_count() or 1) // num_workers)
+
+    settings = {
+        'processed_texts_dir': processed_texts_dir,
+        'ocr_intermediate_dir': ocr_intermediate_dir_path,
+        'force_reprocess_processed': force_reprocess_processed,
+        'clean_lowercase': clean_lowercase,
+        'custom_patterns': custom_patterns,
+        'pdf_extract_method': pdf_extract_method,
+        'tesseract_cmd': tesseract_cmd,
+        'ocr_langs': ocr_langs_conf,
+        'pdf_ocr_dpi': pdf_ocr_render_dpi,
+        'ocr_workers': ocr_workers,
+        'ocr_render_batch_pages': ocr_render_batch_pages,
+        'build_cache': build_cache,
+        'build_params': text_build_params,
+        'code_version': text_code_version,
+    }
+
+    run_start = time.perf_counter()
+    results = []
+    if num_workers == 1:
+        for raw_file_path in raw_file_paths:
+            results.append(handle_raw_file(raw_file_path, settings))
     else:
-        logger.info(f"Successfully processed or verified {processed_count} text sources.")
+        logger.info(f"Processing {len(raw_file_paths)} raw files with {num_workers} workers.")
+        results, crashed_paths = run_in_pool(raw_file_paths, settings, num_workers, log_dir, log_file_name)
+        # A dead worker (e.g. killed by the OOM killer) breaks the whole pool: retry the files that were
+        # in flight or queued one at a time, so only the file that really crashes is marked as failed
+        for raw_file_path in crashed_paths:
+            retry_results, crashed_again = run_in_pool([raw_file_path], settings, 1, log_dir, log_file_name)
+            results.extend(retry_results)
+            for crashed_path, error in crashed_again.items():
+                mark_failed(*output_paths(crashed_path, processed_texts_dir), crashed_path, settings)
+                results.append({'name': crashed_path.name, 'status': 'failed', 'detail': f"worker error: {error}",
+                                'input_bytes': crashed_path.stat().st_size, 'output_chars': 0,
+                                'seconds': 0.0, 'cpu_seconds': 0.0})
+
+    log_run_summary(results, time.perf_counter() - run_start, num_workers)
     logger.info("--- Textual Data Preprocessing Finished ---")
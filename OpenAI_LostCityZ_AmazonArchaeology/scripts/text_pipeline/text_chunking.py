@@ -0,0 +1,154 @@
+import re
+from dataclasses import dataclass
+
+# Optional: exact token counts; without it a token is taken as about 4 characters
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Token-aware chunking of long documents for LLM extraction, and merging of per-chunk results.
+# A document is split into windows of at most max_tokens tokens that overlap by overlap_tokens,
+# with window ends moved back to a paragraph, sentence or word boundary where one is close.
+# Consecutive chunks always overlap or touch, so every character of the document is in at least
+# one chunk. Entities found in a chunk are located in the chunk text and mapped back to character
+# offsets in the document; mentions seen by two overlapping chunks share offsets and are merged.
+
+CHARS_PER_TOKEN_ESTIMATE = 4
+# How far back (as a fraction of the window) a chunk end may move to reach a natural boundary
+BOUNDARY_SEARCH_FRACTION = 0.2
+BOUNDARY_PATTERNS = (re.compile(r"\n\s*\n"), re.compile(r"[.!?]\s"), re.compile(r"\s"))
+
+_encodings = {}
+
+
+@dataclass
+class TextChunk:
+    index: int
+    start: int # Character offsets of the chunk in the document: document[start:end] == text
+    end: int
+    text: str
+
+
+def get_encoding(model):
+    """tiktoken encoding of model (cl100k_base for unknown models), cached per model."""
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+def estimate_tokens(text, model="gpt-3.5-turbo"):
+    """Token count of text: exact with tiktoken, otherwise about 4 characters per token."""
+    if TIKTOKEN_AVAILABLE:
+        return len(get_encoding(model).encode(text, disallowed_special=()))
+    return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+def token_start_offsets(text, model="gpt-3.5-turbo"):
+    """Character offset at which each token of text starts."""
+    if TIKTOKEN_AVAILABLE:
+        encoding = get_encoding(model)
+        _, offsets = encoding.decode_with_offsets(encoding.encode(text, disallowed_special=()))
+        return offsets
+    return list(range(0, len(text), CHARS_PER_TOKEN_ESTIMATE))
+
+def snap_to_boundary(text, start, end):
+    """Moves a chunk end back to the nearest paragraph, sentence or word boundary in the window's last part."""
+    earliest = end - int((end - start) * BOUNDARY_SEARCH_FRACTION)
+    for pattern in BOUNDARY_PATTERNS:
+        boundary = None
+        for match in pattern.finditer(text, earliest, end):
+            boundary = match.end()
+        if boundary is not None and boundary > start:
+            return boundary
+    return end
+
+def chunk_text(text, max_tokens=3000, overlap_tokens=200, model="gpt-3.5-turbo"):
+    """
+    Splits text into overlapping TextChunks of at most max_tokens tokens. Text that fits in
+    max_tokens is returned as a single chunk. The chunks cover the whole text.
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be positive.")
+    overlap_tokens = max(0, min(overlap_tokens, max_tokens // 2))
+    offsets = token_start_offsets(text, model)
+    if len(offsets) <= max_tokens:
+        return [TextChunk(0, 0, len(text), text)]
+
+    chunks = []
+    start_token = 0
+    start = 0
+    while True:
+        end_token = start_token + max_tokens
+        if end_token >= len(offsets):
+            chunks.append(TextChunk(len(chunks), start, len(text), text[start:]))
+            return chunks
+        end = snap_to_boundary(text, start, offsets[end_token])
+        chunks.append(TextChunk(len(chunks), start, end, text[start:end]))
+        # The next chunk starts overlap_tokens before this end, at a word start, and never after it,
+        # so no text falls between two chunks. It always starts after the previous chunk's start.
+        if overlap_tokens:
+            next_token = max(start_token + 1, token_index_at(offsets, end) - overlap_tokens)
+            next_start = offsets[next_token]
+            word_start = text.find(' ', next_start, end)
+            if word_start != -1:
+                next_start = word_start + 1
+            next_start = min(next_start, end)
+        else:
+            next_start = end
+        start_token = max(start_token + 1, token_index_at(offsets, next_start))
+        start = next_start
+
+def token_index_at(offsets, char_offset):
+    """Index of the token containing char_offset."""
+    low, high = 0, len(offsets)
+    while low < high:
+        middle = (low + high) // 2
+        if offsets[middle] <= char_offset:
+            low = middle + 1
+        else:
+            high = middle
+    return max(0, low - 1)
+
+def locate_mentions(chunk, segment):
+    """Document offsets (start, end) of every occurrence of segment in the chunk (whitespace- and case-insensitive)."""
+    words = segment.split()
+    if not words:
+        return []
+    pattern = re.compile(r"(?<!\w)" + r"\s+".join(re.escape(word) for word in words) + r"(?!\w)", re.IGNORECASE)
+    return [(chunk.start + m.start(), chunk.start + m.end()) for m in pattern.finditer(chunk.text)]
+
+def merge_chunk_entities(document_text, chunks, chunk_entities):
+    """
+    Merges per-chunk entity lists ({entity type: [segments]}, one dict per chunk) into
+    {entity type: [{"text", "start", "end"}]} with document character offsets, sorted by position.
+    Mentions found by several overlapping chunks are kept once; segments the model returned that
+    are not in their chunk (and not located by any other chunk) are kept once per type with
+    start/end None rather than dropped.
+    """
+    merged = {}
+    unlocated = {}
+    for chunk, entities in zip(chunks, chunk_entities):
+        for etype, segments in (entities or {}).items():
+            mentions = merged.setdefault(etype, {})
+            for segment in segments:
+                segment = str(segment).strip()
+                located = locate_mentions(chunk, segment)
+                for start, end in located:
+                    mentions[(start, end)] = {'text': document_text[start:end], 'start': start, 'end': end}
+                if not located and segment:
+                    unlocated.setdefault(etype, {}).setdefault(normalize_segment(segment), segment)
+
+    result = {}
+    for etype, mentions in merged.items():
+        located_texts = {normalize_segment(m['text']) for m in mentions.values()}
+        result[etype] = sorted(mentions.values(), key=lambda m: (m['start'], m['end']))
+        # Segments not found verbatim (e.g. normalised by the model), unless another chunk located them
+        result[etype] += [{'text': segment, 'start': None, 'end': None}
+                          for key, segment in unlocated.get(etype, {}).items() if key not in located_texts]
+    return result
+
+def normalize_segment(segment):
+    return ' '.join(segment.split()).casefold()
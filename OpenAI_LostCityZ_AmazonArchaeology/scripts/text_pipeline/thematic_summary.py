@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+
+from batch_ner import RateLimiter, load_config, request_json_completion, setup_logging
+from openai_cache import response_cache_from_config
+from text_chunking import chunk_text
+
+# Corpus-wide thematic summarization as a map-reduce tree.
+# Map: every document (each of its chunks, for long documents) is summarized into a short list of
+# themes, all in parallel. Reduce: theme lists are merged group by group into fewer, broader
+# themes, level by level, until one list remains for the whole corpus. Which documents a theme
+# covers is tracked in code (each merged theme names the input themes it covers), not by the model,
+# so the prompts stay small at every level.
+# Groups are content-defined: a group ends after a node whose hash (at that level) hits 1/fan_in,
+# so adding documents only changes the groups they fall into, and every other node of the tree
+# has the same input as before and is answered by the response cache. Adding 50 documents to a
+# library of thousands recomputes their map calls and the branches above them, not the whole tree.
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = "You are an expert in qualitative text analysis and thematic summarization, particularly for historical and archaeological texts."
+
+MAP_PROMPT_TEMPLATE = """Identify the main themes or topics of the following text related to Amazonian studies.
+For each theme, provide a brief theme name and 3-5 representative keywords.
+Return at most {max_themes} themes.
+
+Provide the output as a JSON object with one key "themes": a list of objects, where each object has "theme_name" and "keywords" (a list of strings).
+
+Text:
+--- --- --- --- ---
+{text_content}
+--- --- --- --- ---
+Themes in JSON format:"""
+
+REDUCE_PROMPT_TEMPLATE = """The following themes were identified in different documents (or parts of documents) of a collection related to Amazonian studies.
+Merge them into at most {max_themes} overall themes: combine themes that describe the same topic and keep distinct topics separate.
+For each merged theme, provide a brief theme name, 3-5 representative keywords and the ids of all input themes it covers.
+
+Provide the output as a JSON object with one key "themes": a list of objects, where each object has "theme_name", "keywords" (a list of strings) and "source_ids" (a list of input theme ids, e.g. ["T1", "T4"]).
+
+Input themes:
+{themes}
+Merged themes in JSON format:"""
+
+SUMMARY_PARAMS = {'temperature': 0.5, 'response_format': {"type": "json_object"}}
+
+
+def node_key(*parts):
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def parse_themes(content, require_sources=False):
+    """Parses a {"themes": [...]} answer into a list of {"theme_name", "keywords"[, "source_ids"]}. Raises ValueError if malformed."""
+    try:
+        data = json.loads(content)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Response is not valid JSON: {e}") from None
+    themes = data.get('themes') if isinstance(data, dict) else None
+    if not isinstance(themes, list):
+        raise ValueError("Response has no 'themes' list.")
+    parsed = []
+    for theme in themes:
+        if not isinstance(theme, dict) or not str(theme.get('theme_name', '')).strip():
+            continue
+        keywords = theme.get('keywords', [])
+        entry = {'theme_name': str(theme['theme_name']).strip(),
+                 'keywords': [str(k) for k in keywords] if isinstance(keywords, list) else []}
+        if require_sources:
+            sources = theme.get('source_ids', [])
+            entry['source_ids'] = [str(s).strip() for s in sources] if isinstance(sources, list) else []
+        parsed.append(entry)
+    return parsed
+
+def group_nodes(nodes, fan_in, level):
+    """
+    Splits the ordered nodes into content-defined groups of fan_in nodes on average (at most
+    2 * fan_in): a group ends after a node whose key hashed with the level falls on a boundary.
+    """
+    groups, current = [], []
+    for node in nodes:
+        current.append(node)
+        boundary = int(node_key(node['key'], str(level))[:8], 16) % fan_in == 0
+        if boundary or len(current) >= 2 * fan_in:
+            groups.append(current)
+            current = []
+    if current:
+        groups.append(current)
+    if len(groups) == len(nodes) and len(nodes) > 1: # Every node hit a boundary; fall back to fixed groups
+        groups = [nodes[i:i + fan_in] for i in range(0, len(nodes), fan_in)]
+    return groups
+
+
+class CorpusSummarizer:
+    """Runs the map and reduce calls of one summarization with shared rate limits, cache and statistics."""
+    def __init__(self, client, model="gpt-3.5-turbo", cache=None, max_in_flight=8, requests_per_minute=500,
+                 tokens_per_minute=200000, max_retries=6, chunk_tokens=3000, chunk_overlap_tokens=200,
+                 fan_in=8, max_themes=8):
+        self.client = client
+        self.model = model
+        self.cache = cache
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.request_slots = asyncio.Semaphore(max(1, max_in_flight))
+        self.max_retries = max_retries
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.fan_in = max(2, fan_in)
+        self.max_themes = max_themes
+        self.stats = collections.Counter()
+
+    async def _request(self, prompt, prompt_template, parse, task):
+        messages = [{"role": "system", "content": SUMMARY_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+        result, tokens = await request_json_completion(
+            self.client, self.limiter, self.request_slots, self.cache, self.model, messages, prompt_template,
+            SUMMARY_PARAMS, self.max_retries, self.stats, parse, task=task)
+        self.stats['tokens'] += tokens
+        return result
+
+    async def map_document(self, name, text):
+        """Theme node of one document: its chunks are summarized in parallel and reduced if there are several."""
+        chunks = chunk_text(text, self.chunk_tokens, self.chunk_overlap_tokens, self.model)
+        self.stats['chunks'] += len(chunks)
+        chunk_themes = await asyncio.gather(*(
+            self._request(MAP_PROMPT_TEMPLATE.format(max_themes=self.max_themes, text_content=chunk.text),
+                          MAP_PROMPT_TEMPLATE, parse_themes, task='theme_map')
+            for chunk in chunks))
+        nodes = [{'key': node_key(name, str(chunk.index), hashlib.sha256(chunk.text.encode('utf-8')).hexdigest()),
+                  'themes': [dict(theme, documents={name}) for theme in themes]}
+                 for chunk, themes in zip(chunks, chunk_themes)]
+        return await self.reduce_tree(nodes)
+
+    async def reduce_nodes(self, nodes):
+        """Merges the theme lists of nodes into one node with one reduce call (none for a single node)."""
+        if len(nodes) == 1:
+            return nodes[0]
+        inputs = {}
+        lines = []
+        for node in nodes:
+            for theme in node['themes']:
+                theme_id = f"T{len(inputs) + 1}"
+                inputs[theme_id] = theme
+                lines.append(f"{theme_id}: {theme['theme_name']} (keywords: {', '.join(theme['keywords'])})")
+        key = node_key(*(node['key'] for node in nodes))
+        if not inputs:
+            return {'key': key, 'themes': []}
+        merged = await self._request(REDUCE_PROMPT_TEMPLATE.format(max_themes=self.max_themes, themes='\n'.join(lines)),
+                                     REDUCE_PROMPT_TEMPLATE, lambda content: parse_themes(content, require_sources=True),
+                                     task='theme_reduce')
+        themes = []
+        covered = set()
+        for theme in merged:
+            sources = [inputs[s] for s in theme.pop('source_ids') if s in inputs]
+            covered.update(id(s) for s in sources)
+            theme['documents'] = set().union(*(s['documents'] for s in sources)) if sources else set()
+            themes.append(theme)
+        dropped = sum(1 for theme in inputs.values() if id(theme) not in covered)
+        if dropped:
+            self.stats['themes_not_merged'] += dropped
+        return {'key': key, 'themes': themes}
+
+    async def reduce_tree(self, nodes):
+        """Reduces nodes level by level (groups of one level in parallel) into a single root node."""
+        level = 0
+        while len(nodes) > 1:
+            groups = group_nodes(nodes, self.fan_in, level)
+            nodes = await asyncio.gather(*(self.reduce_nodes(group) for group in groups))
+            self.stats['reduce_levels'] = max(self.stats['reduce_levels'], level + 1)
+            level += 1
+        return nodes[0] if nodes else {'key': node_key(), 'themes': []}
+
+    async def summarize(self, documents):
+        """
+        Summarizes {document name: text} into {"overall_themes": [{"theme_name", "keywords",
+        "documents"}], "document_themes": [{"document_name", "primary_themes"}]}.
+        """
+        names = sorted(documents)
+        document_nodes = await asyncio.gather(*(self.map_document(name, documents[name]) for name in names))
+        root = await self.reduce_tree(list(document_nodes))
+        overall_themes = [{'theme_name': t['theme_name'], 'keywords': t['keywords'], 'documents': sorted(t['documents'])}
+                          for t in root['themes']]
+        return {
+            'overall_themes': overall_themes,
+            'document_themes': [{'document_name': name,
+                                 'primary_themes': [t['theme_name'] for t in root['themes'] if name in t['documents']],
+                                 'document_level_themes': [t['theme_name'] for t in node['themes']]}
+                                for name, node in zip(names, document_nodes)],
+        }
+
+async def summarize_corpus(client, documents, model="gpt-3.5-turbo", cache=None, **settings):
+    """
+    Map-reduce thematic summary of {document name: text} with an openai.AsyncOpenAI (or compatible)
+    client; settings are the CorpusSummarizer options (max_in_flight, fan_in, max_themes, ...).
+    """
+    summarizer = CorpusSummarizer(client, model, cache, **settings)
+    start = time.monotonic()
+    summary = await summarizer.summarize(documents)
+    stats = summarizer.stats
+    logger.info(f"Thematic summary of {len(documents)} documents ({stats['chunks']} chunks) in {time.monotonic() - start:.1f}s: "
+                f"{len(summary['overall_themes'])} themes, {stats['reduce_levels']} reduce levels, "
+                f"{stats['requests']} API requests, {stats['cache_hits']} cached, {stats['tokens']} tokens.")
+    if stats['themes_not_merged']:
+        logger.warning(f"{stats['themes_not_merged']} input themes were not covered by any merged theme.")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map-reduce thematic summary of all processed texts with the OpenAI API.")
+    parser.add_argument('--input-dir', type=Path, help="Directory of *_processed.txt files (default: the processed text directory)")
+    parser.add_argument('--output', type=Path, help="Output JSON file (default: theme_summary_file in [OpenAI])")
+    parser.add_argument('--model', help="Model (default: summary_model in [OpenAI])")
+    parser.add_argument('--base-url', help="API base URL, e.g. http://localhost:8000/v1 for a local mock server")
+    args = parser.parse_args()
+
+    config = load_config()
+    default_config = config['DEFAULT']
+    text_config = config['TextualData']
+    openai_config = config['OpenAI']
+    script_dir = Path(__file__).resolve().parent
+    logger = setup_logging((script_dir / default_config.get('log_dir', '../../logs')).resolve(),
+                           text_config.get('text_pipeline_log_file_name',
+                                           default_config.get('text_pipeline_log_file_name', 'text_pipeline.log')))
+
+    base_processed_dir = script_dir / default_config.get('base_processed_data_dir', '../../data')
+    input_dir = args.input_dir or (base_processed_dir / text_config.get('text_processed_suffix', 'textual/processed')).resolve()
+    output_path = args.output or (base_processed_dir / openai_config.get('theme_summary_file', 'textual/themes/corpus_themes.json')).resolve()
+    documents = {p.name: p.read_text(encoding='utf-8') for p in sorted(input_dir.glob("*_processed.txt"))
+                 if p.is_file() and p.stat().st_size > 0}
+
+    from openai import AsyncOpenAI # Only needed when running against the API (or a mock server)
+    client = AsyncOpenAI(base_url=args.base_url or openai_config.get('api_base_url') or None, max_retries=0)
+    cache = response_cache_from_config(config, script_dir.parent.parent)
+    summary = asyncio.run(summarize_corpus(
+        client, documents, model=args.model or openai_config.get('summary_model', 'gpt-3.5-turbo'), cache=cache,
+        max_in_flight=openai_config.getint('max_in_flight', 8),
+        requests_per_minute=openai_config.getint('requests_per_minute', 500),
+        tokens_per_minute=openai_config.getint('tokens_per_minute', 200000),
+        max_retries=openai_config.getint('max_retries', 6),
+        chunk_tokens=openai_config.getint('chunk_tokens', 3000),
+        chunk_overlap_tokens=openai_config.getint('chunk_overlap_tokens', 200),
+        fan_in=openai_config.getint('summary_fan_in', 8), max_themes=openai_config.getint('summary_max_themes', 8)))
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    cache.log_stats()
+    logger.info(f"Saved thematic summary to {output_path}")
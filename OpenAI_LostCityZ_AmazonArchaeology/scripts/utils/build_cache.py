@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+# Content-hash incremental build cache shared by the preprocessing pipelines.
+# Every output gets a '<output>.buildinfo.json' sidecar recording a build key: the hash of its
+# inputs, the config values it depends on and the version (source hash) of the code producing it.
+# An output is reused only if it exists and its recorded key matches the current one, so a changed
+# input, parameter or script recomputes exactly the affected tiles, products or documents.
+# Sidecars (rather than one shared manifest) keep the cache safe for process-pool workers.
+
+logger = logging.getLogger(__name__)
+
+BUILD_INFO_SUFFIX = '.buildinfo.json'
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def build_info_path(output_path):
+    """Returns the path of the sidecar holding the build record of output_path."""
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.name + BUILD_INFO_SUFFIX)
+
+def code_version(*source_paths):
+    """Hashes the given source files; used as the code-version component of a build key."""
+    digest = hashlib.sha256()
+    for source_path in source_paths:
+        digest.update(Path(source_path).read_bytes())
+    return digest.hexdigest()[:16]
+
+def hash_file(path):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fingerprint_input(path, previous=None):
+    """
+    Fingerprints one build input.
+    Files are content-hashed; the hash recorded in `previous` (the fingerprint from the last build)
+    is reused while size and mtime are unchanged, so multi-GB point clouds are hashed only once.
+    Directories (e.g. .SAFE products) are fingerprinted by the relative paths and content hashes of
+    their files, each memoized the same way, so re-extracting or copying a product keeps its key.
+    """
+    path = Path(path)
+    if not path.exists():
+        return {'missing': True}
+    if path.is_dir():
+        previous_files = (previous or {}).get('files', {})
+        files = {}
+        digest = hashlib.sha256()
+        for file_path in sorted(p for p in path.rglob('*') if p.is_file()):
+            relative_path = file_path.relative_to(path).as_posix()
+            files[relative_path] = fingerprint_input(file_path, previous_files.get(relative_path))
+            digest.update(f"{relative_path}|{files[relative_path]['sha256']}\n".encode())
+        return {'dir_sha256': digest.hexdigest(), 'files': files}
+    stat = path.stat()
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns \
+            and 'sha256' in previous:
+        sha256 = previous['sha256']
+    else:
+        sha256 = hash_file(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+def compute_build_key(inputs, params, version, previous_inputs=None):
+    """
+    Returns (build key, input fingerprints) for a list of input paths, a JSON-serializable dict of
+    config values and a code version string.
+    """
+    previous_inputs = previous_inputs or {}
+    fingerprints = {str(Path(p).resolve()): fingerprint_input(p, previous_inputs.get(str(Path(p).resolve())))
+                    for p in inputs}
+    # Only content (not size/mtime or absolute paths) goes into the key, so touching or moving the
+    # data directory does not invalidate outputs; a directory's per-file memo is summarized by dir_sha256
+    content = [{k: v for k, v in fp.items() if k not in ('size', 'mtime_ns', 'files')} for fp in fingerprints.values()]
+    payload = json.dumps({'inputs': content, 'params': params, 'version': version}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest(), fingerprints
+
+def read_build_info(output_path):
+    """Returns the recorded build info of output_path, or None if there is none (or it is unreadable)."""
+    info_path = build_info_path(output_path)
+    try:
+        with open(info_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def is_up_to_date(output_path, inputs, params, version):
+    """True if output_path exists and was built from the same inputs, config values and code version."""
+    if not Path(output_path).exists():
+        return False
+    info = read_build_info(output_path)
+    if info is None:
+        logger.info(f"No build record for {Path(output_path).name}; it will be rebuilt.")
+        return False
+    key, _ = compute_build_key(inputs, params, version, info.get('inputs'))
+    if key != info.get('key'):
+        logger.info(f"Inputs, parameters or code changed for {Path(output_path).name}; it will be rebuilt.")
+        return False
+    return True
+
+def settings_match(output_path, params, version):
+    """
+    True if output_path exists and its recorded config values and code version equal params and
+    version. Inputs are not compared, for outputs whose inputs may be gone (e.g. deleted raw data).
+    """
+    if not Path(output_path).exists():
+        return False
+    info = read_build_info(output_path)
+    if info is None:
+        return False
+    recorded = json.dumps({'params': info.get('params'), 'version': info.get('version')}, sort_keys=True, default=str)
+    return recorded == json.dumps({'params': params, 'version': version}, sort_keys=True, default=str)
+
+def record_build(output_path, inputs, params, version):
+    """Writes the build record of a freshly built output_path (atomically)."""
+    info_path = build_info_path(output_path)
+    previous = read_build_info(output_path) or {}
+    key, fingerprints = compute_build_key(inputs, params, version, previous.get('inputs'))
+    tmp_path = info_path.with_name(info_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'inputs': fingerprints, 'params': params, 'version': version}, f,
+                  indent=2, sort_keys=True, default=str)
+    os.replace(tmp_path, info_path)
+
+def invalidate(output_path):
+    """Removes the build record of output_path so the next run rebuilds it."""
+    info_path = build_info_path(output_path)
+    if info_path.exists():
+        info_path.unlink()
+
+
+class BuildCache:
+    """
+    Front end used by the pipeline scripts. With enabled=False (incremental_builds = false) it
+    falls back to the old "output exists" checks and records nothing.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def is_current(self, output_path, inputs, params, version):
+        if not self.enabled:
+            return Path(output_path).exists()
+        if is_up_to_date(output_path, inputs, params, version):
+            return True
+        invalidate(output_path) # A rebuild that dies half-way must not leave a valid-looking record behind
+        return False
+
+    def matches_settings(self, output_path, params, version):
+        if not self.enabled:
+            return Path(output_path).exists()
+        return settings_match(output_path, params, version)
+
+    def record(self, output_path, inputs, params, version):
+        if self.enabled:
+            record_build(output_path, inputs, params, version)
@@ -0,0 +1,70 @@
+import logging
+import os
+from pathlib import Path
+
+import rasterio
+import rasterio.shutil
+
+# Shared Cloud-Optimized GeoTIFF writer for the raster products of all pipelines.
+# Products are written as usual (streamed or in memory) and then copied through GDAL's COG
+# driver, which adds internal tiling, compression with a predictor and overview pyramids.
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_COG_COMPRESSION = ('DEFLATE', 'ZSTD', 'LZW')
+
+
+def cog_options_from_config(config_section):
+    """
+    Reads the COG settings shared by all pipelines (see [DEFAULT] in config.ini).
+    Returns a dict of options for write_cog/finalize_as_cog, or None if plain GeoTIFFs are requested.
+    """
+    if config_section.get('raster_output_format', 'gtiff').strip().lower() != 'cog':
+        return None
+    compression = config_section.get('cog_compression', 'DEFLATE').strip().upper()
+    if compression not in SUPPORTED_COG_COMPRESSION:
+        logger.warning(f"Unsupported cog_compression '{compression}'. Using DEFLATE.")
+        compression = 'DEFLATE'
+    return {
+        'compression': compression,
+        'blocksize': config_section.getint('cog_blocksize', 512),
+        'overview_resampling': config_section.get('cog_overview_resampling', 'average').strip().lower(),
+    }
+
+def cog_creation_options(compression='DEFLATE', blocksize=512, overview_resampling='average'):
+    """Builds GDAL COG driver creation options; PREDICTOR=YES picks the integer or floating-point predictor."""
+    return {
+        'COMPRESS': compression,
+        'PREDICTOR': 'YES',
+        'BLOCKSIZE': blocksize,
+        'OVERVIEWS': 'AUTO',
+        'OVERVIEW_RESAMPLING': overview_resampling,
+        'BIGTIFF': 'IF_SAFER',
+        'NUM_THREADS': 'ALL_CPUS',
+    }
+
+def finalize_as_cog(raster_path, compression='DEFLATE', blocksize=512, overview_resampling='average'):
+    """Rewrites an existing GeoTIFF in place as a COG (via a temporary file and an atomic rename)."""
+    raster_path = Path(raster_path)
+    tmp_path = raster_path.with_name(f"{raster_path.stem}.cog_tmp{raster_path.suffix}")
+    try:
+        rasterio.shutil.copy(raster_path, tmp_path, driver='COG',
+                             **cog_creation_options(compression, blocksize, overview_resampling))
+        os.replace(tmp_path, raster_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    logger.info(f"Wrote COG ({compression}, {blocksize}px blocks, overviews): {raster_path.name}")
+
+def write_cog(raster_path, data, profile, compression='DEFLATE', blocksize=512, overview_resampling='average'):
+    """Writes an in-memory (bands, rows, cols) array with the given rasterio profile as a COG."""
+    profile = profile.copy()
+    profile['driver'] = 'GTiff'
+    for creation_key in ('compress', 'tiled', 'blockxsize', 'blockysize', 'interleave', 'photometric'):
+        profile.pop(creation_key, None)
+    with rasterio.MemoryFile() as memfile:
+        with memfile.open(**profile) as mem_ds:
+            mem_ds.write(data)
+        rasterio.shutil.copy(memfile.name, raster_path, driver='COG',
+                             **cog_creation_options(compression, blocksize, overview_resampling))
+    logger.info(f"Wrote COG ({compression}, {blocksize}px blocks, overviews): {Path(raster_path).name}")